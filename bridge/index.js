@@ -30,6 +30,20 @@ app.use(bodyParser.json());
 
 // Receive full WhatsApp payload from bot, translate, and send to UI
 app.post("/send-to-emulator", (req, res) => {
+  forwardToEmulator(req, res, () => ({ status: "ok", message: "Message sent to emulator" }));
+});
+
+// Graph API compatible endpoint, lets the bot's Graph client target the bridge
+// (whatsapp_graph_base_url = "http://localhost:3001/v18.0")
+app.post("/:version/:phoneId/messages", (req, res) => {
+  forwardToEmulator(req, res, () => ({
+    messaging_product: "whatsapp",
+    contacts: [{ input: req.body.to, wa_id: req.body.to }],
+    messages: [{ id: `wamid.emulator.${Date.now()}.${Math.random().toString(36).slice(2, 10)}` }],
+  }));
+});
+
+function forwardToEmulator(req, res, buildResponse) {
   try {
     const fullPayload = req.body;
     console.log(
@@ -46,12 +60,12 @@ app.post("/send-to-emulator", (req, res) => {
     io.emit("ui_message", simpleMessage);
     console.log("📤 Sent to UI clients");
 
-    res.status(200).json({ status: "ok", message: "Message sent to emulator" });
+    res.status(200).json(buildResponse());
   } catch (error) {
     console.error("❌ Error processing payload:", error);
     res.status(500).json({ status: "error", message: error.message });
   }
-});
+}
 
 // Socket.io: Listen for replies from UI, translate, and POST to bot
 io.on("connection", (socket) => {
@@ -31,7 +31,7 @@ def whatsapp_session_hook():
             raw_payload = frappe.request.data
 
             if not verify_webhook_signature(frappe.request):
-                logger.warning(f"WhatsApp hook signature failed: %s", raw_payload)
+                logger.warning("WhatsApp hook signature failed: %s", raw_payload)
                 return
         
             webhook_data = json.loads(raw_payload.decode('utf-8'))
@@ -0,0 +1,34 @@
+"""
+Micro benchmarks against a real site
+
+Run with:
+
+    bench --site <site> execute frappe_pywce.benchmarks.<module>.run
+
+Benchmarks write their own fixtures and remove them afterwards.
+"""
+
+import time
+from contextlib import contextmanager
+
+import frappe
+
+
+@contextmanager
+def measure():
+    """Yield a dict that gets `seconds` and `queries` (number of frappe.db.sql calls) on exit"""
+    result = {"seconds": 0.0, "queries": 0}
+    original_sql = frappe.db.sql
+
+    def counting_sql(*args, **kwargs):
+        result["queries"] += 1
+        return original_sql(*args, **kwargs)
+
+    frappe.db.sql = counting_sql
+    start = time.perf_counter()
+
+    try:
+        yield result
+    finally:
+        result["seconds"] = time.perf_counter() - start
+        frappe.db.sql = original_sql
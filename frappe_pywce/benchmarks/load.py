@@ -0,0 +1,370 @@
+"""
+End-to-end load generation against the webhook endpoint
+
+    bench --site <site> pywce-bench --users 50 --messages 20
+
+N virtual users each post Meta-shaped webhook payloads to
+`frappe_pywce.webhook.webhook` in-process and wait for the bot's reply
+before sending the next one. The mix covers text messages, button and list
+replies, delivery / read statuses and batched entries (several messages in
+one payload), shaped like the bridge's webhookConstructor.js.
+
+Replies are captured by a sink listening on the emulator URL
+(`LOCAL_EMULATOR_URL`, stop the bridge first) which also answers the Graph
+style `/<version>/<phone_id>/messages` route. The site must be in emulator
+mode (ChatBot Config env "local"), nothing is sent to Meta.
+
+Reported:
+
+- p50 / p95 / p99 end-to-end latency, from posting the webhook to the first
+  reply reaching the sink
+- messages / second over the whole run
+- DB queries and Redis round trips per message, counted in the webhook
+  request. With `process_in_background` on or stream ingress the processing
+  runs in workers and only the ingress is counted
+"""
+
+import hashlib
+import hmac
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import frappe
+import frappe.utils
+from werkzeug.test import EnvironBuilder
+
+from frappe_pywce.benchmarks import measure
+from frappe_pywce.config import LOCAL_EMULATOR_URL
+from frappe_pywce.inbox import INGRESS_MODE_STREAM
+from frappe_pywce.tracing import install_redis_counter, redis_command_count
+
+# E.164 country code 999 is unassigned, bench users never collide with real ones
+BENCH_WA_ID_PREFIX = "999"
+BENCH_MESSAGE_PREFIX = "wamid.load."
+
+DEFAULT_MIX = {"text": 50, "button_reply": 20, "list_reply": 15, "status": 10, "batch": 5}
+BATCH_SIZE = 3
+REPLY_TIMEOUT_IN_SEC = 10
+
+
+class ReplySink:
+    """HTTP server standing in for the emulator bridge, records every send per recipient"""
+
+    def __init__(self, port: int):
+        self.replies: Dict[str, List] = {}
+        self.condition = threading.Condition()
+        self.total = 0
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    payload = {}
+
+                message_id = sink.record(payload.get("to"))
+
+                body = json.dumps({
+                    "messaging_product": "whatsapp",
+                    "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+                    "messages": [{"id": message_id}]
+                }).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def record(self, recipient: Optional[str]) -> str:
+        now = time.perf_counter()
+
+        with self.condition:
+            self.total += 1
+            message_id = f"{BENCH_MESSAGE_PREFIX}out.{self.total}"
+            self.replies.setdefault(recipient or "", []).append((now, message_id))
+            self.condition.notify_all()
+
+        return message_id
+
+    def count(self, recipient: str) -> int:
+        with self.condition:
+            return len(self.replies.get(recipient, ()))
+
+    def wait(self, recipient: str, seen: int, timeout: float) -> Optional[float]:
+        """perf_counter time of the first reply to `recipient` after its `seen` earlier ones"""
+        with self.condition:
+            if self.condition.wait_for(lambda: len(self.replies.get(recipient, ())) > seen, timeout):
+                return self.replies[recipient][seen][0]
+
+        return None
+
+    def last_message_id(self, recipient: str) -> Optional[str]:
+        with self.condition:
+            replies = self.replies.get(recipient)
+            return replies[-1][1] if replies else None
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _message(wa_id: str, message_id: str, kind: str, sequence: int, text: str) -> Dict:
+    message = {"from": wa_id, "id": message_id, "timestamp": str(int(time.time()))}
+
+    if kind == "button_reply":
+        message["type"] = "interactive"
+        message["interactive"] = {
+            "type": "button_reply",
+            "button_reply": {"id": f"bench-button-{sequence % 3}", "title": f"Option {sequence % 3}"}
+        }
+
+    elif kind == "list_reply":
+        message["type"] = "interactive"
+        message["interactive"] = {
+            "type": "list_reply",
+            "list_reply": {"id": f"bench-row-{sequence % 5}", "title": f"Row {sequence % 5}", "description": None}
+        }
+
+    else:
+        message["type"] = "text"
+        message["text"] = {"body": text}
+
+    return message
+
+
+def build_payload(wa_id: str, kind: str, sequence: int, text: str = "hi",
+                  context_message_id: Optional[str] = None) -> Dict:
+    """
+    Webhook payload of one bench user.
+
+    `status` reports the bot's last message to the user delivered and read,
+    `batch` carries BATCH_SIZE text messages in one payload.
+    """
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": "PHONE_NUMBER_ID"},
+        "contacts": [{"profile": {"name": f"Bench {wa_id}"}, "wa_id": wa_id}]
+    }
+
+    if kind == "status":
+        message_id = context_message_id or f"{BENCH_MESSAGE_PREFIX}out.unknown"
+        value["statuses"] = [
+            {"id": message_id, "status": status, "timestamp": str(int(time.time())), "recipient_id": wa_id}
+            for status in ("delivered", "read")
+        ]
+
+    else:
+        count = BATCH_SIZE if kind == "batch" else 1
+        value["messages"] = [
+            _message(wa_id, f"{BENCH_MESSAGE_PREFIX}{wa_id}.{sequence}.{i}", kind, sequence, text)
+            for i in range(count)
+        ]
+
+        if context_message_id and kind in ("button_reply", "list_reply"):
+            value["messages"][0]["context"] = {"id": context_message_id}
+
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "WHATSAPP_BUSINESS_ACCOUNT_ID", "changes": [{"value": value, "field": "messages"}]}]
+    }
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Nearest rank percentile"""
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(max(math.ceil(p / 100 * len(values)) - 1, 0), len(values) - 1)]
+
+
+def _post_webhook(body: bytes, app_secret: Optional[str]):
+    from frappe_pywce.webhook import webhook
+
+    headers = {"Content-Type": "application/json"}
+
+    if app_secret:
+        signature = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+        headers["X-Hub-Signature-256"] = f"sha256={signature}"
+
+    frappe.local.request = EnvironBuilder(
+        method="POST", path="/api/method/frappe_pywce.webhook.webhook", data=body, headers=headers
+    ).get_request()
+
+    try:
+        webhook()
+        frappe.db.commit()
+
+    except Exception:
+        frappe.db.rollback()
+        raise
+
+    finally:
+        frappe.local.request = None
+
+
+def _virtual_user(site: str, user: int, stats: Dict, sink: ReplySink, messages: int, mix: Dict,
+                  text: str, reply_timeout: float, app_secret: Optional[str], stats_lock: threading.Lock):
+    wa_id = f"{BENCH_WA_ID_PREFIX}{user:09d}"
+    kinds, weights = list(mix), list(mix.values())
+    rng = random.Random(user)
+
+    frappe.init(site=site)
+    frappe.connect()
+
+    latencies, errors, timeouts, sent, queries, redis_calls = [], 0, 0, 0, 0, 0
+
+    try:
+        for sequence in range(messages):
+            # a conversation starts with text, statuses follow a reply
+            kind = rng.choices(kinds, weights)[0] if sequence else "text"
+            context_message_id = sink.last_message_id(wa_id)
+
+            if kind == "status" and context_message_id is None:
+                kind = "text"
+
+            body = json.dumps(build_payload(wa_id, kind, sequence, text, context_message_id)).encode()
+            seen = sink.count(wa_id)
+            redis_before = redis_command_count()
+            start = time.perf_counter()
+
+            try:
+                with measure() as m:
+                    _post_webhook(body, app_secret)
+
+            except Exception:
+                errors += 1
+                continue
+
+            sent += BATCH_SIZE if kind == "batch" else (0 if kind == "status" else 1)
+            queries += m["queries"]
+            redis_calls += redis_command_count() - redis_before
+
+            if kind == "status":
+                continue
+
+            replied_at = sink.wait(wa_id, seen, reply_timeout)
+
+            if replied_at is None:
+                timeouts += 1
+            else:
+                latencies.append(replied_at - start)
+
+    finally:
+        frappe.destroy()
+
+        with stats_lock:
+            stats["latencies"].extend(latencies)
+            stats["errors"] += errors
+            stats["timeouts"] += timeouts
+            stats["messages"] += sent
+            stats["payloads"] += messages
+            stats["queries"] += queries
+            stats["redis_calls"] += redis_calls
+
+
+def _cleanup() -> None:
+    frappe.db.delete("WhatsApp Chat Message", {"phone_number": ["like", f"{BENCH_WA_ID_PREFIX}%"]})
+    frappe.db.delete("WhatsApp Conversation", {"name": ["like", f"{BENCH_WA_ID_PREFIX}%"]})
+    frappe.db.commit()
+
+
+def run(users: int = 20, messages: int = 20, mix: Optional[Dict] = None, text: str = "hi",
+        reply_timeout: float = REPLY_TIMEOUT_IN_SEC, sink_port: Optional[int] = None):
+    users, messages = int(users), int(messages)
+    mix = {kind: float(weight) for kind, weight in (mix or DEFAULT_MIX).items() if float(weight) > 0}
+
+    unknown = set(mix) - set(DEFAULT_MIX)
+    if unknown:
+        frappe.throw(f"Unknown message kinds {', '.join(sorted(unknown))}, use {', '.join(DEFAULT_MIX)}")
+
+    settings = frappe.get_cached_doc("ChatBot Config")
+
+    if settings.env != "local":
+        frappe.throw("pywce-bench needs the emulator mode (ChatBot Config env 'local'), it would message real users")
+
+    app_secret = settings.get_password("app_secret", raise_exception=False)
+    inline = not frappe.utils.cint(settings.process_in_background) and settings.ingress_mode != INGRESS_MODE_STREAM
+    site = frappe.local.site
+
+    install_redis_counter()
+    _cleanup()
+
+    stats = {"latencies": [], "errors": 0, "timeouts": 0, "messages": 0, "payloads": 0, "queries": 0, "redis_calls": 0}
+    stats_lock = threading.Lock()
+
+    try:
+        with ReplySink(int(sink_port or urlparse(LOCAL_EMULATOR_URL).port)) as sink:
+            threads = [
+                threading.Thread(
+                    target=_virtual_user,
+                    args=(site, user, stats, sink, messages, mix, text, float(reply_timeout), app_secret, stats_lock),
+                    daemon=True
+                )
+                for user in range(users)
+            ]
+
+            start = time.perf_counter()
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            elapsed = time.perf_counter() - start
+            replies = sink.total
+
+    finally:
+        _cleanup()
+
+    latencies = stats["latencies"]
+    per_message = max(stats["messages"], 1)
+
+    result = {
+        "users": users,
+        "payloads": stats["payloads"],
+        "messages": stats["messages"],
+        "replies": replies,
+        "errors": stats["errors"],
+        "reply_timeouts": stats["timeouts"],
+        "seconds": round(elapsed, 2),
+        "messages_per_second": round(stats["messages"] / elapsed, 1) if elapsed else None,
+        "latency_seconds": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+        "processing": "inline" if inline else "ingress only, processed by workers",
+        "queries_per_message": round(stats["queries"] / per_message, 1),
+        "redis_calls_per_message": round(stats["redis_calls"] / per_message, 1),
+    }
+
+    result["latency_seconds"] = {
+        p: round(value, 4) if value is not None else None for p, value in result["latency_seconds"].items()
+    }
+
+    print(frappe.as_json(result))
+    return result
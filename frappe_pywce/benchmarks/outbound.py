@@ -0,0 +1,64 @@
+"""
+Sustained outbound throughput against the emulator bridge
+
+Start the bridge (`cd bridge && npm start`) then:
+
+    bench --site <site> execute frappe_pywce.benchmarks.outbound.run --kwargs "{'messages': 2000, 'recipients': 500}"
+
+Messages go through the real dispatcher and Redis rate limiter, sent by a
+GraphClient pointed at the bridge's Graph compatible endpoint.
+"""
+
+import time
+
+import frappe
+
+from frappe_pywce.graph_client import GraphClient
+from frappe_pywce.outbound import LANE_BULK, LANE_INTERACTIVE, OutboundDispatcher
+
+BRIDGE_BASE_URL = "http://localhost:3001/v18.0"
+BENCH_PHONE_ID = "bench-phone"
+
+
+def run(messages: int = 2000, recipients: int = 500, interactive_every: int = 10, base_url: str = BRIDGE_BASE_URL):
+    messages, recipients, interactive_every = int(messages), int(recipients), int(interactive_every)
+    client = GraphClient(base_url=base_url)
+    latencies = {LANE_INTERACTIVE: [], LANE_BULK: []}
+
+    def sender(entry):
+        client.send_message(entry["phone_id"], "bench-token", entry["payload"])
+        latencies[entry["lane"]].append(time.time() - entry["enqueued_at"])
+
+    dispatcher = OutboundDispatcher(sender)
+
+    for i in range(messages):
+        lane = LANE_INTERACTIVE if interactive_every and i % interactive_every == 0 else LANE_BULK
+        dispatcher.enqueue(
+            BENCH_PHONE_ID,
+            {
+                "messaging_product": "whatsapp",
+                "to": f"26377{i % recipients:07d}",
+                "type": "text",
+                "text": {"body": f"bench {i}"}
+            },
+            lane=lane
+        )
+
+    start = time.perf_counter()
+    dispatcher.run(burst=True)
+    elapsed = time.perf_counter() - start
+
+    def p50(values):
+        return round(sorted(values)[len(values) // 2], 3) if values else None
+
+    result = {
+        "messages": messages,
+        "recipients": recipients,
+        "seconds": round(elapsed, 2),
+        "messages_per_second": round(dispatcher.stats["sent"] / elapsed, 1) if elapsed else None,
+        "p50_queue_latency": {lane: p50(values) for lane, values in latencies.items()},
+        **dispatcher.stats,
+    }
+
+    print(frappe.as_json(result))
+    return result
@@ -0,0 +1,84 @@
+"""
+Replay a large webhook payload through the batched persistence path
+
+    bench --site <site> execute frappe_pywce.benchmarks.persistence.run --kwargs "{'entries': 500}"
+"""
+
+import time
+
+import frappe
+
+from frappe_pywce.benchmarks import measure
+from frappe_pywce.conversation_summary import CONVERSATION_DOCTYPE
+from frappe_pywce.persistence import CHAT_MESSAGE_DOCTYPE, save_webhook_payload
+
+BENCH_MESSAGE_PREFIX = "wamid.bench."
+BENCH_WA_ID_PREFIX = "26377"
+
+
+def build_payload(entries: int = 500, statuses_per_entry: int = 1) -> dict:
+    """Webhook payload with `entries` incoming messages, each followed by status updates of earlier messages"""
+    now = int(time.time())
+    entry_list = []
+
+    for i in range(entries):
+        wa_id = f"{BENCH_WA_ID_PREFIX}{i % 50:07d}"
+
+        entry_list.append({
+            "id": "bench",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "contacts": [{"wa_id": wa_id, "profile": {"name": f"Bench {i % 50}"}}],
+                    "messages": [{
+                        "from": wa_id,
+                        "id": f"{BENCH_MESSAGE_PREFIX}{i}",
+                        "timestamp": str(now),
+                        "type": "text",
+                        "text": {"body": f"benchmark message {i}"}
+                    }],
+                    "statuses": [
+                        {"id": f"{BENCH_MESSAGE_PREFIX}{max(i - s - 1, 0)}", "status": "read"}
+                        for s in range(statuses_per_entry)
+                    ]
+                }
+            }]
+        })
+
+    return {"object": "whatsapp_business_account", "entry": entry_list}
+
+
+def _cleanup():
+    frappe.db.delete(CHAT_MESSAGE_DOCTYPE, {"message_id": ["like", f"{BENCH_MESSAGE_PREFIX}%"]})
+    frappe.db.delete(CONVERSATION_DOCTYPE, {"name": ["like", f"{BENCH_WA_ID_PREFIX}%"]})
+    frappe.db.commit()
+
+
+def run(entries: int = 500):
+    entries = int(entries)
+    payload = build_payload(entries)
+
+    _cleanup()
+
+    try:
+        with measure() as first:
+            inserted, updated = save_webhook_payload(payload)
+
+        # redelivery of the same payload, everything is deduplicated
+        with measure() as replay:
+            save_webhook_payload(payload)
+
+    finally:
+        _cleanup()
+
+    result = {
+        "entries": entries,
+        "inserted": inserted,
+        "status_updates": updated,
+        "first_delivery": first,
+        "redelivery": replay,
+    }
+
+    print(frappe.as_json(result))
+    return result
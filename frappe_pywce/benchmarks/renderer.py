@@ -0,0 +1,76 @@
+"""
+Render a 50 template flow, naive per string rendering vs the cached renderer
+
+    bench --site <site> execute frappe_pywce.benchmarks.renderer.run
+"""
+
+import time
+
+import frappe
+
+from frappe_pywce import template_renderer
+
+
+def build_flow(templates: int = 50, dynamic_every: int = 3) -> list:
+    """Templates where every `dynamic_every`th one has Jinja in its body and buttons"""
+    flow = []
+
+    for i in range(templates):
+        dynamic = i % dynamic_every == 0
+        flow.append({
+            "id": f"t{i}",
+            "kind": "button",
+            "message": {
+                "title": f"Step {i}",
+                "body": "Hi {{ name }}, order {{ doc_name }} is {{ status | upper }}" if dynamic else f"Static body {i}",
+                "footer": "Powered by pywce",
+                "buttons": ["{% if paid %}Receipt{% else %}Pay{% endif %}", "Back"] if dynamic else ["Next", "Back"],
+            },
+            "settings": {"message_level": str(i), "delay": 0, "tags": ["a", "b", "c"]},
+            "routes": [{"pattern": f"opt{j}", "isRegex": False, "connectedTo": f"t{j}"} for j in range(4)],
+        })
+
+    return flow
+
+
+def _naive(value, context):
+    if isinstance(value, str):
+        return frappe.render_template(value, context)
+    if isinstance(value, dict):
+        return {k: _naive(v, context) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_naive(v, context) for v in value]
+    return value
+
+
+def _time(fn, flow, rounds):
+    start = time.perf_counter()
+    for r in range(rounds):
+        context = {"name": f"user{r}", "doc_name": f"SO-{r}", "status": "open", "paid": r % 2}
+        for template in flow:
+            fn(template, context)
+    return time.perf_counter() - start
+
+
+def run(templates: int = 50, rounds: int = 20):
+    flow = build_flow(int(templates))
+    rounds = int(rounds)
+
+    naive = _time(_naive, flow, rounds)
+
+    template_renderer._compiled.clear()
+    template_renderer._plans.clear()
+    template_renderer.warm(flow)
+    cached = _time(template_renderer.render_template_dict, flow, rounds)
+
+    result = {
+        "templates": len(flow),
+        "renders": len(flow) * rounds,
+        "naive_ms_per_render": round(naive * 1000 / (len(flow) * rounds), 4),
+        "cached_ms_per_render": round(cached * 1000 / (len(flow) * rounds), 4),
+        "speedup": round(naive / cached, 1) if cached else None,
+        "cache": template_renderer.get_cache_stats(),
+    }
+
+    print(frappe.as_json(result))
+    return result
@@ -0,0 +1,140 @@
+"""
+Chat message search: LIKE scan against the FULLTEXT index
+
+    bench --site <site> execute frappe_pywce.benchmarks.search.run --kwargs "{'rows': 1000000}"
+    bench --site <site> execute frappe_pywce.benchmarks.search.run --kwargs "{'rows': 10000000}"
+
+Seeds `rows` synthetic messages with INSERT ... SELECT (one statement and
+commit per million rows), times each query both ways and removes the rows.
+"""
+
+import time
+
+import frappe
+
+from frappe_pywce.benchmarks import measure
+from frappe_pywce.message_search import CHAT_MESSAGE_DOCTYPE, add_fulltext_index, search
+
+BENCH_NAME_PREFIX = "bench-search-"
+SEED_CHUNK = 1_000_000
+DELETE_CHUNK = 100_000
+
+WORDS = [
+    ["order", "invoice", "payment", "delivery", "refund", "account", "balance", "statement",
+     "ticket", "booking", "voucher", "receipt", "policy", "claim", "quote", "parcel",
+     "meter", "token", "bundle", "airtime", "transfer", "deposit", "loan"],
+    ["status", "number", "update", "request", "problem", "question", "confirmation", "reminder",
+     "cancellation", "extension", "approval", "schedule", "summary", "history", "details",
+     "balance", "limit", "renewal", "issue", "complaint", "feedback", "change", "copy",
+     "document", "address", "location", "contact", "option", "menu"],
+    ["today", "tomorrow", "yesterday", "please", "urgent", "again", "thanks", "asap", "now",
+     "later", "morning", "evening", "weekend", "monday", "friday", "soon", "still", "already",
+     "twice", "pending", "missing", "wrong", "late", "failed", "received", "sent", "paid",
+     "unpaid", "closed", "open", "hello"]
+]
+
+QUERIES = ["refund", "invoice reminder", "airtime failed", "deliv"]
+
+
+def _elt(words, expression: str) -> str:
+    return "ELT(1 + ({}) %% {}, {})".format(expression, len(words), ", ".join(f"'{w}'" for w in words))
+
+
+def _seed(rows: int) -> None:
+    frappe.db.sql("CREATE TEMPORARY TABLE IF NOT EXISTS `tmp_pywce_seq` (`n` INT NOT NULL PRIMARY KEY)")
+    frappe.db.sql("DELETE FROM `tmp_pywce_seq`")
+    frappe.db.sql("INSERT INTO `tmp_pywce_seq` (`n`) VALUES " + ", ".join(f"({i})" for i in range(1000)))
+
+    text = "CONCAT_WS(' ', {}, {}, {}, 'ref', id)".format(
+        _elt(WORDS[0], "id"), _elt(WORDS[1], "id DIV 23"), _elt(WORDS[2], "id DIV 667")
+    )
+
+    for offset in range(0, rows, SEED_CHUNK):
+        frappe.db.sql(
+            f"""
+            INSERT INTO `tab{CHAT_MESSAGE_DOCTYPE}`
+                (`name`, `phone_number`, `direction`, `status`, `message_type`, `message_text`,
+                 `timestamp`, `creation`, `modified`, `owner`, `modified_by`, `docstatus`)
+            SELECT
+                CONCAT(%(prefix)s, id), CONCAT('26377', LPAD(id %% 50000, 7, '0')),
+                IF(id %% 2, 'Incoming', 'Outgoing'), 'read', 'text', {text},
+                NOW() - INTERVAL id SECOND, NOW(), NOW(), 'Administrator', 'Administrator', 0
+            FROM (
+                SELECT %(offset)s + a.n * 1000 + b.n AS id
+                FROM `tmp_pywce_seq` a CROSS JOIN `tmp_pywce_seq` b
+            ) seq
+            WHERE id < %(rows)s
+            """,
+            {"prefix": BENCH_NAME_PREFIX, "offset": offset, "rows": rows}
+        )
+        frappe.db.commit()
+
+    frappe.db.sql("DROP TEMPORARY TABLE `tmp_pywce_seq`")
+
+
+def _cleanup() -> None:
+    while True:
+        frappe.db.sql(
+            f"DELETE FROM `tab{CHAT_MESSAGE_DOCTYPE}` WHERE `name` LIKE %s LIMIT {DELETE_CHUNK}",
+            (f"{BENCH_NAME_PREFIX}%",)
+        )
+        deleted = frappe.db.sql("SELECT ROW_COUNT()")[0][0]
+        frappe.db.commit()
+
+        if deleted < DELETE_CHUNK:
+            return
+
+
+def _like(query: str):
+    conditions = " AND ".join(["`message_text` LIKE %s"] * len(query.split()))
+
+    return frappe.db.sql(
+        f"""
+        SELECT `name`, `phone_number`, `message_text`, `timestamp`
+        FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+        WHERE {conditions}
+        ORDER BY `timestamp` DESC
+        LIMIT 20
+        """,
+        [f"%{word}%" for word in query.split()]
+    )
+
+
+def run(rows: int = 1_000_000):
+    rows = int(rows)
+    add_fulltext_index()
+
+    _cleanup()
+
+    start = time.perf_counter()
+    _seed(rows)
+    seed_seconds = time.perf_counter() - start
+
+    results = {}
+
+    try:
+        for query in QUERIES:
+            with measure() as like:
+                like_hits = len(_like(query))
+
+            with measure() as fulltext:
+                fulltext_hits = len(search(query)["results"])
+
+            with measure() as conversation:
+                search(query, phone_number="263770000042")
+
+            results[query] = {
+                "like_seconds": round(like["seconds"], 4),
+                "fulltext_seconds": round(fulltext["seconds"], 4),
+                "fulltext_one_conversation_seconds": round(conversation["seconds"], 4),
+                "like_hits": like_hits,
+                "fulltext_hits": fulltext_hits,
+            }
+
+    finally:
+        _cleanup()
+
+    result = {"rows": rows, "seed_seconds": round(seed_seconds, 1), "queries": results}
+
+    print(frappe.as_json(result))
+    return result
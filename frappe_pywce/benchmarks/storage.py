@@ -0,0 +1,67 @@
+"""
+Per call latency of FrappeStorageManager.get, validating on every call vs the cached model
+
+    bench --site <site> execute frappe_pywce.benchmarks.storage.run
+"""
+
+import time
+
+import frappe
+from pywce import template
+
+from frappe_pywce.managers import FrappeStorageManager
+
+
+def build_templates(count: int = 200) -> dict:
+    """Loaded-template dicts, alternating text and button templates with a few routes each"""
+    templates = {}
+
+    for i in range(count):
+        routes = [{"user_input": f"opt{j}", "next_stage": f"t{(i + j) % count}"} for j in range(3)]
+
+        if i % 2:
+            templates[f"t{i}"] = {
+                "kind": "button",
+                "message": {"title": f"Step {i}", "body": "Pick one", "buttons": ["opt0", "opt1", "opt2"]},
+                "routes": routes
+            }
+        else:
+            templates[f"t{i}"] = {"kind": "text", "message": f"Step {i}", "routes": routes}
+
+    return templates
+
+
+def _storage_manager(templates: dict) -> FrappeStorageManager:
+    # skip flow loading, the templates are already "loaded"
+    storage_manager = FrappeStorageManager.__new__(FrappeStorageManager)
+    storage_manager._TEMPLATES = templates
+    storage_manager._MODELS = {}
+    storage_manager._TRIGGERS = []
+    return storage_manager
+
+
+def _per_call_us(fn, names, rounds) -> float:
+    start = time.perf_counter()
+
+    for _ in range(rounds):
+        for name in names:
+            fn(name)
+
+    return (time.perf_counter() - start) * 1e6 / (rounds * len(names))
+
+
+def run(count: int = 200, rounds: int = 20):
+    templates = build_templates(int(count))
+    names = list(templates)
+    storage_manager = _storage_manager(templates)
+
+    result = {
+        "templates": len(names),
+        "validate_per_call_us": round(_per_call_us(lambda n: template.Template.as_model(templates[n]), names, int(rounds)), 2),
+        "cached_get_per_call_us": round(_per_call_us(storage_manager.get, names, int(rounds)), 2),
+    }
+
+    result["speedup"] = round(result["validate_per_call_us"] / result["cached_get_per_call_us"], 1)
+
+    print(frappe.as_json(result))
+    return result
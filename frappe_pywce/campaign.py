@@ -0,0 +1,453 @@
+"""
+Bulk template campaigns
+
+`send_template_campaign` queues a background job that fans a template
+message out to many recipients with an asyncio HTTP client:
+
+1. recipients are streamed from a DocType (keyset pages on name), a CSV File
+   or a plain list, never loaded all at once
+2. each batch is sent with bounded concurrency, within the shared bulk lane
+   rate limits, retrying 429 and connect errors with jittered backoff. A 5xx
+   or a timeout may come after Graph accepted the message, those sends are
+   recorded as failed instead of being repeated
+3. batch results are bulk inserted into `WhatsApp Chat Message`, committed,
+   and only then is the recipient cursor checkpointed
+
+Template components are given per recipient, as a mapping keyed by phone
+number, as components whose `{{ field }}` placeholders are filled from the
+recipient row, or by a method registered under the
+`pywce_campaign_components` hook and called with each row.
+
+Campaign state lives in the queue Redis, re-running the job with the same
+campaign id resumes after the last checkpoint. At most the batch in flight
+when a worker died is sent again.
+"""
+
+import asyncio
+import csv
+import itertools
+import json
+import random
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import frappe
+import httpx
+from frappe.utils.background_jobs import get_redis_conn
+
+from frappe_pywce.conversation_cursor import set_cursor
+from frappe_pywce.graph_client import (
+    RETRY_BACKOFF_FACTOR,
+    RETRY_TOTAL,
+    get_graph_client,
+)
+from frappe_pywce.outbound import LANE_BULK, RateLimiter
+from frappe_pywce.persistence import bulk_insert_messages, normalize_phone
+from frappe_pywce.util import CACHE_KEY_PREFIX
+from frappe_pywce.pywce_logger import app_logger as logger
+
+CAMPAIGN_BATCH_SIZE = 200
+CAMPAIGN_CONCURRENCY = 20
+CAMPAIGN_TTL_IN_SEC = 7 * 24 * 60 * 60
+CAMPAIGN_JOB_TIMEOUT = 6 * 60 * 60
+
+# raised before the request was sent, retrying cannot deliver a message twice
+RETRYABLE_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+COMPONENTS_HOOK = "pywce_campaign_components"
+_PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+CAMPAIGN_MESSAGE_FIELDS = (
+    "phone_number", "message_id", "timestamp", "direction", "message_type",
+    "message_text", "template_name", "status", "error_message", "metadata"
+)
+
+
+def _campaign_key(campaign_id: str) -> str:
+    return f"{CACHE_KEY_PREFIX}campaign:{frappe.local.site}:{campaign_id}"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class CampaignState:
+    """Spec, checkpoint and counters of one campaign in a Redis hash"""
+
+    def __init__(self, campaign_id: str, conn=None):
+        self.campaign_id = campaign_id
+        self.conn = conn or get_redis_conn()
+        self.key = _campaign_key(campaign_id)
+
+    def create(self, spec: Dict) -> None:
+        self.conn.hset(self.key, mapping={
+            "spec": json.dumps(spec),
+            "cursor": "",
+            "sent": 0,
+            "failed": 0,
+            "status": "Queued",
+            "created_at": frappe.utils.now()
+        })
+        self.conn.expire(self.key, CAMPAIGN_TTL_IN_SEC)
+
+    def load(self) -> Dict:
+        data = {_decode(k): _decode(v) for k, v in (self.conn.hgetall(self.key) or {}).items()}
+
+        if data.get("spec"):
+            data["spec"] = json.loads(data["spec"])
+
+        for counter in ("sent", "failed"):
+            data[counter] = frappe.utils.cint(data.get(counter))
+
+        return data
+
+    def checkpoint(self, cursor, sent: int, failed: int) -> None:
+        pipe = self.conn.pipeline()
+        pipe.hset(self.key, "cursor", json.dumps(cursor))
+        pipe.hincrby(self.key, "sent", sent)
+        pipe.hincrby(self.key, "failed", failed)
+        pipe.hset(self.key, "updated_at", frappe.utils.now())
+        pipe.expire(self.key, CAMPAIGN_TTL_IN_SEC)
+        pipe.execute()
+
+    def set_status(self, status: str) -> None:
+        self.conn.hset(self.key, "status", status)
+
+
+# Recipient sources, each yields (cursor, row) where row has at least `phone`.
+# Resuming with a cursor yields the rows after it.
+
+def _next_index(cursor) -> int:
+    return 0 if cursor is None else int(cursor) + 1
+
+
+def _iter_list(source: Dict, cursor) -> Iterator[Tuple[int, Dict]]:
+    start = _next_index(cursor)
+
+    for i, recipient in enumerate(source["recipients"][start:], start=start):
+        row = recipient if isinstance(recipient, dict) else {"phone": recipient}
+        yield i, row
+
+
+def _iter_csv(source: Dict, cursor) -> Iterator[Tuple[int, Dict]]:
+    file_doc = frappe.get_doc("File", {"file_url": source["file_url"]})
+    phone_column = source.get("phone_column") or "phone"
+    start = _next_index(cursor)
+
+    with open(file_doc.get_full_path(), newline="", encoding="utf-8-sig") as f:
+        for i, row in enumerate(itertools.islice(csv.DictReader(f), start, None), start=start):
+            yield i, {**row, "phone": row.get(phone_column)}
+
+
+def _iter_doctype(source: Dict, cursor) -> Iterator[Tuple[str, Dict]]:
+    phone_field = source.get("phone_field") or "phone"
+    fields = list(dict.fromkeys(["name", phone_field, *(source.get("fields") or [])]))
+    last_name = cursor
+
+    filters = source.get("filters") or []
+
+    # dict filters become list ones, the name cursor is appended to them
+    if isinstance(filters, dict):
+        filters = [
+            [field, *value] if isinstance(value, (list, tuple)) else [field, "=", value]
+            for field, value in filters.items()
+        ]
+
+    while True:
+        page_filters = list(filters)
+        if last_name:
+            page_filters.append(["name", ">", last_name])
+
+        page = frappe.get_all(
+            source["doctype"],
+            filters=page_filters,
+            fields=fields,
+            order_by="name asc",
+            limit=CAMPAIGN_BATCH_SIZE
+        )
+
+        for row in page:
+            last_name = row["name"]
+            yield last_name, {**row, "phone": row.get(phone_field)}
+
+        if len(page) < CAMPAIGN_BATCH_SIZE:
+            return
+
+
+def iter_recipients(source: Dict, cursor=None) -> Iterator[Tuple[object, Dict]]:
+    if source.get("doctype"):
+        return _iter_doctype(source, cursor)
+
+    if source.get("file_url"):
+        return _iter_csv(source, cursor)
+
+    return _iter_list(source, cursor)
+
+
+def components_method(path: str):
+    """Method registered under the `pywce_campaign_components` hook, nothing else is callable"""
+    if path not in frappe.get_hooks(COMPONENTS_HOOK):
+        frappe.throw(f"{path} is not registered under the {COMPONENTS_HOOK} hook")
+
+    return frappe.get_attr(path)
+
+
+def render_components(value: Any, row: Dict) -> Any:
+    """`value` with `{{ field }}` placeholders in its strings filled from the recipient row"""
+    if isinstance(value, str):
+        return _PLACEHOLDER.sub(lambda m: str(row.get(m.group(1)) or ""), value)
+
+    if isinstance(value, list):
+        return [render_components(item, row) for item in value]
+
+    if isinstance(value, dict):
+        return {key: render_components(item, row) for key, item in value.items()}
+
+    return value
+
+
+def _components(spec: Dict, row: Dict) -> Optional[List]:
+    if spec.get("components_method"):
+        return components_method(spec["components_method"])(row)
+
+    if spec.get("components_by_phone") is not None:
+        return spec["components_by_phone"].get(normalize_phone(row["phone"]))
+
+    return render_components(spec.get("components"), row)
+
+
+def _build_payload(spec: Dict, row: Dict) -> Dict:
+    template = {
+        "name": spec["template_name"],
+        "language": {"code": spec.get("language_code") or "en"}
+    }
+
+    components = _components(spec, row)
+
+    if components:
+        template["components"] = components
+
+    return {
+        "messaging_product": "whatsapp",
+        "recipient_type": "individual",
+        "to": row["phone"],
+        "type": "template",
+        "template": template
+    }
+
+
+class CampaignSender:
+    """Async fan-out of one batch with bounded concurrency"""
+
+    def __init__(self, phone_id: str, access_token: str, limiter: RateLimiter = None,
+                 concurrency: int = CAMPAIGN_CONCURRENCY, base_url: str = None):
+        self.phone_id = phone_id
+        self.access_token = access_token
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.url = f"{(base_url or get_graph_client().base_url).rstrip('/')}/{phone_id}/messages"
+
+    async def _wait_for_token(self, recipient: str) -> None:
+        if self.limiter is None:
+            return
+
+        while True:
+            # the limiter is a blocking Redis call, keep it off the event loop
+            wait, _ = await asyncio.to_thread(self.limiter.try_acquire, self.phone_id, recipient, LANE_BULK)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def _send_one(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, payload: Dict) -> Dict:
+        async with semaphore:
+            await self._wait_for_token(payload["to"])
+
+            for attempt in range(RETRY_TOTAL + 1):
+                try:
+                    response = await client.post(self.url, json=payload)
+
+                    # only a 429 certainly means the message was not accepted
+                    if response.status_code == 429 and attempt < RETRY_TOTAL:
+                        retry_after = frappe.utils.flt(response.headers.get("Retry-After"))
+                        await asyncio.sleep(retry_after or random.uniform(0, RETRY_BACKOFF_FACTOR * 2 ** attempt))
+                        continue
+
+                    response.raise_for_status()
+                    return {"message_id": response.json().get("messages", [{}])[0].get("id")}
+
+                except RETRYABLE_TRANSPORT_ERRORS as e:
+                    if attempt < RETRY_TOTAL:
+                        await asyncio.sleep(random.uniform(0, RETRY_BACKOFF_FACTOR * 2 ** attempt))
+                        continue
+                    return {"error": str(e)}
+
+                except httpx.HTTPError as e:
+                    return {"error": str(e)}
+
+            return {"error": "retries exhausted"}
+
+    async def _send_batch(self, payloads: List[Dict]) -> List[Dict]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=30) as client:
+            return await asyncio.gather(*(self._send_one(client, semaphore, p) for p in payloads))
+
+    def send_batch(self, payloads: List[Dict]) -> List[Dict]:
+        return asyncio.run(self._send_batch(payloads))
+
+
+def _record_batch(campaign_id: str, spec: Dict, rows: List[Dict], results: List[Dict]) -> Tuple[int, int]:
+    now = frappe.utils.now_datetime()
+    messages = []
+
+    for row, result in zip(rows, results):
+        error = result.get("error")
+        messages.append({
+            "phone_number": normalize_phone(row["phone"]),
+            "message_id": result.get("message_id"),
+            "timestamp": now,
+            "direction": "Outgoing",
+            "message_type": "template",
+            "message_text": f"Template: {spec['template_name']}",
+            "template_name": spec["template_name"],
+            "status": "failed" if error else "sent",
+            "error_message": error,
+            "metadata": json.dumps({"campaign": campaign_id})
+        })
+
+    bulk_insert_messages(messages, CAMPAIGN_MESSAGE_FIELDS)
+    frappe.db.commit()
+
+    sent = [m["phone_number"] for m in messages if m["status"] == "sent"]
+    for phone in sent:
+        # mirrors the rows just stored: a template send is not a flow template, no routing state
+        set_cursor(phone, template_id=None)
+
+    return len(sent), len(messages) - len(sent)
+
+
+def run_campaign(campaign_id: str) -> Dict:
+    """Background job, sends from the last checkpoint until the recipients run out"""
+    state = CampaignState(campaign_id)
+    data = state.load()
+
+    if not data.get("spec"):
+        frappe.throw(f"Unknown campaign {campaign_id}")
+
+    if data.get("status") == "Completed":
+        return data
+
+    spec = data["spec"]
+    cursor = json.loads(data["cursor"]) if data.get("cursor") else None
+
+    config = frappe.get_cached_doc("ChatBot Config")
+    sender = CampaignSender(config.phone_id, config.access_token, limiter=RateLimiter())
+
+    state.set_status("Running")
+    recipients = iter_recipients(spec["source"], cursor)
+
+    try:
+        while True:
+            batch = list(itertools.islice(recipients, CAMPAIGN_BATCH_SIZE))
+            if not batch:
+                break
+
+            rows = [row for _, row in batch if row.get("phone")]
+            results = sender.send_batch([_build_payload(spec, row) for row in rows])
+            sent, failed = _record_batch(campaign_id, spec, rows, results)
+
+            state.checkpoint(batch[-1][0], sent, failed)
+            logger.info("Campaign %s: batch sent=%s failed=%s", campaign_id, sent, failed)
+
+    except Exception:
+        state.set_status("Failed")
+        frappe.log_error(title="WhatsApp Campaign Error")
+        raise
+
+    state.set_status("Completed")
+    return state.load()
+
+
+def _enqueue_campaign(campaign_id: str) -> None:
+    frappe.enqueue(
+        "frappe_pywce.campaign.run_campaign",
+        queue="long",
+        timeout=CAMPAIGN_JOB_TIMEOUT,
+        job_id=f"{CACHE_KEY_PREFIX}campaign:{campaign_id}",
+        campaign_id=campaign_id
+    )
+
+
+@frappe.whitelist()
+def send_template_campaign(recipients, template_name, components_per_recipient=None, language_code="en"):
+    """Queue a template message to many recipients
+
+    Args:
+        recipients: list of phone numbers / dicts with `phone`, or a source dict
+            {"doctype": ..., "phone_field": ..., "filters": ..., "fields": [...]} or
+            {"file_url": <CSV File url>, "phone_column": ...}
+        template_name (str): Name of the approved template
+        components_per_recipient: per recipient template components, one of
+            - a dict of phone number -> components
+            - a components list, `{{ field }}` in its strings is filled from each recipient row
+            - the dotted path of a method registered under the `pywce_campaign_components`
+              hook, called with each recipient row and returning its components
+        language_code (str): Language code (default: 'en')
+
+    Returns:
+        dict with the campaign_id, pass it to get_campaign_status / resume_campaign
+    """
+    frappe.only_for("System Manager")
+
+    recipients = frappe.parse_json(recipients)
+    components = components_per_recipient
+
+    if isinstance(components, str):
+        try:
+            components = json.loads(components)
+        except ValueError:
+            # a method path, only registered ones are accepted
+            components_method(components)
+
+    source = recipients if isinstance(recipients, dict) else {"recipients": recipients}
+
+    spec = {
+        "source": source,
+        "template_name": template_name,
+        "language_code": language_code,
+        "components": components if isinstance(components, list) else None,
+        "components_by_phone": (
+            {normalize_phone(phone): value for phone, value in components.items()}
+            if isinstance(components, dict) else None
+        ),
+        "components_method": components if isinstance(components, str) else None
+    }
+
+    campaign_id = frappe.generate_hash(length=12)
+    CampaignState(campaign_id).create(spec)
+    _enqueue_campaign(campaign_id)
+
+    return {"campaign_id": campaign_id}
+
+
+@frappe.whitelist()
+def resume_campaign(campaign_id: str):
+    """Re-queue a stopped campaign, it continues after its last checkpoint"""
+    frappe.only_for("System Manager")
+
+    if not CampaignState(campaign_id).load().get("spec"):
+        frappe.throw(f"Unknown campaign {campaign_id}")
+
+    _enqueue_campaign(campaign_id)
+    return {"campaign_id": campaign_id}
+
+
+@frappe.whitelist()
+def get_campaign_status(campaign_id: str) -> Optional[Dict]:
+    frappe.only_for("System Manager")
+
+    data = CampaignState(campaign_id).load()
+    data.pop("spec", None)
+    return data
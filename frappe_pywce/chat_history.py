@@ -0,0 +1,99 @@
+"""
+Keyset paginated message history
+
+Pages are cut on (timestamp, name) instead of an OFFSET: the newest page
+comes first, `before` returns the messages just older than a cursor
+(scrolling back) and `after` the ones newer than it (new messages). Each page
+is an index range scan of its own size, however long the conversation.
+
+A cursor is "<timestamp>|<name>" of a message, pages are returned oldest
+first for display along with the cursors of their first and last message.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import frappe
+import frappe.utils
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+CURSOR_SEPARATOR = "|"
+
+
+def make_cursor(row: Dict) -> str:
+    return f"{row['timestamp']}{CURSOR_SEPARATOR}{row['name']}"
+
+
+def parse_cursor(cursor: str) -> Tuple:
+    timestamp, separator, name = (cursor or "").partition(CURSOR_SEPARATOR)
+
+    if not separator or not name:
+        frappe.throw(f"Invalid history cursor {cursor}")
+
+    return frappe.utils.get_datetime(timestamp), name
+
+
+def page_size(limit) -> int:
+    return min(max(frappe.utils.cint(limit) or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+
+
+def fetch_page(
+    doctype: str,
+    filters: Dict,
+    fields: Sequence[str],
+    limit: int = DEFAULT_PAGE_SIZE,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+) -> Dict:
+    """
+    One page of `doctype` rows matching the equality `filters`.
+
+    Returns:
+        {"messages": rows oldest first, "before": cursor of the first row,
+         "after": cursor of the last row, "has_more": more rows exist in the
+         direction paged (older ones unless `after` was given)}
+    """
+    conditions = [f"`{field}` = %s" for field in filters]
+    values: List = list(filters.values())
+
+    if after:
+        timestamp, name = parse_cursor(after)
+        conditions.append("(`timestamp` > %s OR (`timestamp` = %s AND `name` > %s))")
+        values.extend((timestamp, timestamp, name))
+        order = "ASC"
+
+    else:
+        if before:
+            timestamp, name = parse_cursor(before)
+            conditions.append("(`timestamp` < %s OR (`timestamp` = %s AND `name` < %s))")
+            values.extend((timestamp, timestamp, name))
+
+        order = "DESC"
+
+    columns = ", ".join(f"`{field}`" for field in dict.fromkeys(("name", "timestamp", *fields)))
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT {columns}
+        FROM `tab{doctype}`
+        WHERE {" AND ".join(conditions) or "1 = 1"}
+        ORDER BY `timestamp` {order}, `name` {order}
+        LIMIT %s
+        """,
+        (*values, limit + 1),
+        as_dict=True
+    )
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if order == "DESC":
+        rows.reverse()
+
+    return {
+        "messages": rows,
+        "before": make_cursor(rows[0]) if rows else before,
+        "after": make_cursor(rows[-1]) if rows else after,
+        "has_more": has_more
+    }
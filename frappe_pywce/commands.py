@@ -0,0 +1,76 @@
+import click
+
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("pywce-inbox-worker")
+@click.option("--partitions", help="Comma separated inbox partitions to drain, defaults to all. Each is drained by one worker at a time")
+@click.option("--consumer", help="Consumer name within the group, defaults to <hostname>:<pid>")
+@click.option("--burst", is_flag=True, default=False, help="Exit once the partitions are empty")
+@pass_context
+def inbox_worker(context, partitions=None, consumer=None, burst=False):
+    """Drain the Redis Streams webhook inbox of a site"""
+    from frappe_pywce.inbox import run_worker
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+
+    try:
+        run_worker(
+            partitions=[int(p) for p in partitions.split(",")] if partitions else None,
+            consumer=consumer,
+            burst=burst
+        )
+    finally:
+        frappe.destroy()
+
+
+@click.command("pywce-outbound-worker")
+@click.option("--burst", is_flag=True, default=False, help="Exit once the outbound queue is empty")
+@pass_context
+def outbound_worker(context, burst=False):
+    """Dispatch queued outbound WhatsApp messages of a site within Meta's rate limits"""
+    from frappe_pywce.outbound import run_worker
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+
+    try:
+        run_worker(burst=burst)
+    finally:
+        frappe.destroy()
+
+
+@click.command("pywce-bench")
+@click.option("--users", default=20, type=int, help="Concurrent virtual users")
+@click.option("--messages", default=20, type=int, help="Webhook payloads sent by each user")
+@click.option("--mix", help="Weighted payload kinds, e.g. text=50,button_reply=20,list_reply=15,status=10,batch=5")
+@click.option("--text", default="hi", help="Body of the text messages, pick one your flow answers")
+@click.option("--reply-timeout", default=10.0, type=float, help="Seconds to wait for the bot's reply")
+@click.option("--sink-port", type=int, help="Port of the reply sink, defaults to the emulator URL's")
+@pass_context
+def bench(context, users=20, messages=20, mix=None, text="hi", reply_timeout=10.0, sink_port=None):
+    """Load test the webhook with simulated users and report latency, throughput and DB / Redis calls per message"""
+    from frappe_pywce.benchmarks.load import run
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+
+    try:
+        run(
+            users=users,
+            messages=messages,
+            mix=dict(item.split("=", 1) for item in mix.split(",")) if mix else None,
+            text=text,
+            reply_timeout=reply_timeout,
+            sink_port=sink_port
+        )
+    finally:
+        frappe.destroy()
+
+
+commands = [inbox_worker, outbound_worker, bench]
@@ -1,8 +1,13 @@
-import time
+import hashlib
+import json
+import threading
 import frappe
 
+from frappe_pywce import pubsub, template_renderer
+from frappe_pywce.conversation_cursor import set_cursor
+from frappe_pywce.delayed_send import DeferringWhatsApp, defer_next_send
 from frappe_pywce.managers import FrappeRedisSessionManager, FrappeStorageManager
-from frappe_pywce.util import bot_settings, frappe_recursive_renderer
+from frappe_pywce.util import frappe_recursive_renderer
 from frappe_pywce.pywce_logger import app_logger
 
 from pywce import Engine, client, EngineConfig, HookArg
@@ -10,6 +15,15 @@ from pywce import Engine, client, EngineConfig, HookArg
 
 LOCAL_EMULATOR_URL = "http://localhost:3001/send-to-emulator"
 
+ENGINE_CACHE_TOPIC = "engine"
+
+# site -> (cache key, compiled engine), shared by all requests of this worker process
+_ENGINE_CACHE = {}
+_ENGINE_CACHE_LOCK = threading.RLock()
+_ENGINE_CACHE_STATS = {"hits": 0, "rebuilds": 0, "invalidations": 0}
+# (site, modified) -> flow_json digest, so the flow is only hashed once per saved version
+_FLOW_DIGESTS = {}
+
 def on_hook_listener(arg: HookArg) -> None:
     """Save hook to local and apply message controls (delay, typing, ack)
 
@@ -18,20 +32,7 @@ def on_hook_listener(arg: HookArg) -> None:
     Args:
         arg (HookArg): Hook argument
     """
-    app_logger.info("=" * 80)
-    app_logger.info("🎣 HOOK LISTENER TRIGGERED")
-    app_logger.info("=" * 80)
-    
-    # Log hook details
-    app_logger.info(f"Hook Type: {type(arg)}")
-    app_logger.info(f"Hook Attributes: {dir(arg)}")
-    
-    # Try to log specific hook data
-    try:
-        if hasattr(arg, '__dict__'):
-            app_logger.info(f"Hook Data: {arg.__dict__}")
-    except Exception as e:
-        app_logger.warning(f"Could not log hook data: {e}")
+    app_logger.debug("Hook listener triggered for %s", getattr(arg, 'template_name', None))
     
     # SAVE MESSAGE TO DATABASE BEFORE APPLYING CONTROLS
     try:
@@ -93,17 +94,22 @@ def on_hook_listener(arg: HookArg) -> None:
                 message_doc.insert(ignore_permissions=True)
                 frappe.db.commit()
                 
+                set_cursor(recipient, message_level=message_level, next_level=next_level)
+                
                 # Store message name in hook arg for later reference
                 if not hasattr(arg, 'message_doc_name'):
                     arg.message_doc_name = message_doc.name
                 
-                app_logger.info(f"✅ Saved outgoing message for template '{template_name}' to {recipient} (level: {message_level}, next: {next_level}, delay: {delay_time}s)")
+                app_logger.debug(
+                    "Saved outgoing message for template %s", template_name,
+                    recipient=recipient, level=message_level, next_level=next_level, delay=delay_time
+                )
                 
             except Exception as save_error:
-                app_logger.error(f"❌ Failed to save outgoing message: {save_error}")
+                app_logger.error("Failed to save outgoing message: %s", save_error)
     
     except Exception as e:
-        app_logger.error(f"❌ Failed to save message in hook: {e}")
+        app_logger.error("Failed to save message in hook: %s", e)
     
     # APPLY MESSAGE CONTROLS HERE (before message is sent)
     try:
@@ -119,57 +125,38 @@ def on_hook_listener(arg: HookArg) -> None:
             settings = storage_manager.get_template_settings(template_name)
             
             if settings:
-                app_logger.info("=" * 80)
-                app_logger.info(f"📋 APPLYING MESSAGE CONTROLS FOR: {template_name}")
-                app_logger.info("=" * 80)
+                app_logger.debug("Applying message controls for %s", template_name)
                 
                 # Apply typing indicator
                 if settings.get('typing', False) and wa_client:
                     try:
-                        app_logger.info("⌨️ Sending typing indicator...")
                         wa_client.mark_typing(recipient)
-                        app_logger.info("✅ Typing indicator sent")
                     except Exception as e:
-                        app_logger.error(f"❌ Failed to send typing indicator: {e}")
+                        app_logger.error("Failed to send typing indicator: %s", e)
                 
-                # Apply delay
+                # Apply delay, the send is scheduled instead of holding the worker
                 delay_time = settings.get('delay_time', 0)
-                app_logger.info(f"============================Delaying message by {delay_time} seconds...")
                 if delay_time > 0:
-                    app_logger.info(f"⏳ Delaying message by {delay_time} seconds...")
-                    time.sleep(delay_time)
-                    app_logger.info(f"✅ Delay complete ({delay_time}s)")
+                    app_logger.debug("Delaying message by %ss", delay_time)
+                    defer_next_send(recipient, delay_time)
                 
                 # Apply read receipt (before sending - marks conversation as read)
                 if settings.get('ack', False) and wa_client:
                     try:
-                        app_logger.info("✓✓ Marking as read...")
                         wa_client.mark_read(recipient)
-                        app_logger.info("✅ Read receipt sent")
                     except Exception as e:
-                        app_logger.error(f"❌ Failed to send read receipt: {e}")
-                
-                app_logger.info("=" * 80)
-            else:
-                app_logger.info(f"No specific message controls for template: {template_name}")
+                        app_logger.error("Failed to send read receipt: %s", e)
     except Exception as e:
-        app_logger.error(f"❌ Failed to apply message controls: {e}")
+        app_logger.error("Failed to apply message controls: %s", e)
     
     frappe.local.hook_arg = arg
-    app_logger.info('✅ Updated hook arg in frappe.local')
-    app_logger.info("=" * 80)
 
 def on_client_send_listener() -> None:
     """Reset hook_arg to None - CALLED AFTER MESSAGE IS SENT"""
-    app_logger.info("=" * 80)
-    app_logger.info("📤 CLIENT SEND LISTENER TRIGGERED")
-    app_logger.info("=" * 80)
-    app_logger.info("✉️ MESSAGE HAS BEEN SENT TO WHATSAPP!")
-    
     # Log what was sent if available
     hook_arg = getattr(frappe.local, "hook_arg", None)
     if hook_arg:
-        app_logger.info(f"Sent Hook Arg: {hook_arg}")
+        app_logger.debug("Message sent, hook arg: %s", hook_arg)
         
         # Update message status and ID if we saved a message
         if hasattr(hook_arg, 'message_doc_name') and hook_arg.message_doc_name:
@@ -189,28 +176,21 @@ def on_client_send_listener() -> None:
                     }
                 )
                 frappe.db.commit()
-                app_logger.info(f"✅ Updated message {hook_arg.message_doc_name} with status 'sent'")
+                app_logger.debug("Updated message %s with status 'sent'", hook_arg.message_doc_name)
                 
             except Exception as update_error:
-                app_logger.error(f"❌ Failed to update message status: {update_error}")
+                app_logger.error("Failed to update message status: %s", update_error)
     else:
         app_logger.warning("No hook_arg found in frappe.local")
     
     frappe.local.hook_arg = None
-    app_logger.info("🧹 Cleared hook_arg from frappe.local")
-    app_logger.info("=" * 80)
 
 def get_wa_config(settings) -> client.WhatsApp:
     """Configure WhatsApp client"""
-    app_logger.info("🔧 Configuring WhatsApp Client")
-    app_logger.info(f"  - Phone ID: {settings.phone_id}")
-    app_logger.info(f"  - Environment: {settings.env}")
-    app_logger.info(f"  - Use Emulator: {settings.env == 'local'}")
+    app_logger.info("Configuring WhatsApp client", phone_id=settings.phone_id, env=settings.env)
     
     if settings.env == "local":
-        app_logger.warning(f"⚠️ EMULATOR MODE - Messages will be sent to: {LOCAL_EMULATOR_URL}")
-    else:
-        app_logger.info("📡 PRODUCTION MODE - Messages will be sent to WhatsApp API")
+        app_logger.warning("Emulator mode, messages will be sent to %s", LOCAL_EMULATOR_URL)
     
     _wa_config = client.WhatsAppConfig(
         token=settings.access_token,
@@ -221,13 +201,12 @@ def get_wa_config(settings) -> client.WhatsApp:
         emulator_url=LOCAL_EMULATOR_URL
     )
 
-    wa_client = client.WhatsApp(_wa_config, on_send_listener=on_client_send_listener)
-    app_logger.info("✅ WhatsApp client configured successfully")
+    wa_client = DeferringWhatsApp(_wa_config, on_send_listener=on_client_send_listener)
     
     return wa_client
 
 
-def get_engine_config() -> Engine:
+def _build_engine(settings) -> Engine:
     """
     Initialize and configure the PyWCE Engine.
     
@@ -238,35 +217,19 @@ def get_engine_config() -> Engine:
     4. Applies message controls (delay, typing, ack) in hook listener
     """
     try:
-        app_logger.info("=" * 80)
-        app_logger.info("🚀 INITIALIZING PYWCE ENGINE")
-        app_logger.info("=" * 80)
-        
-        # Load bot settings
-        app_logger.info("1️⃣ Loading bot settings...")
-        settings = bot_settings()
-        app_logger.info(f"   ✅ Bot settings loaded")
-        
         # Initialize storage manager (templates)
-        app_logger.info("2️⃣ Initializing Storage Manager...")
         storage_manager = FrappeStorageManager(settings.flow_json)
-        app_logger.info(f"   ✅ Storage Manager initialized")
-        app_logger.info(f"   - START_MENU: {storage_manager.START_MENU}")
-        app_logger.info(f"   - REPORT_MENU: {storage_manager.REPORT_MENU}")
-        app_logger.info(f"   - Total Templates: {len(storage_manager._TEMPLATES)}")
+
+        try:
+            compiled = template_renderer.warm(storage_manager._TEMPLATES.values())
+        except Exception:
+            compiled = 0
+            app_logger.warning("Template precompilation failed, templates compile on first use", exc_info=True)
         
         # Initialize WhatsApp client
-        app_logger.info("3️⃣ Initializing WhatsApp Client...")
         wa_client = get_wa_config(settings)
-        app_logger.info(f"   ✅ WhatsApp client ready")
-        
-        # Store in frappe.local for hook listener access
-        frappe.local.storage_manager = storage_manager
-        frappe.local.wa_client = wa_client
-        app_logger.info("   ✅ Stored storage_manager and wa_client in frappe.local")
         
         # Create engine config
-        app_logger.info("4️⃣ Creating Engine Configuration...")
         _eng_config = EngineConfig(
             whatsapp=wa_client,
             storage_manager=storage_manager,
@@ -276,22 +239,105 @@ def get_engine_config() -> Engine:
             external_renderer=frappe_recursive_renderer,
             on_hook_arg=on_hook_listener
         )
-        app_logger.info(f"   ✅ Engine config created")
         
         # Initialize engine
-        app_logger.info("5️⃣ Initializing Engine...")
         engine = Engine(config=_eng_config)
-        app_logger.info(f"   ✅ Engine initialized successfully")
         
-        app_logger.info("=" * 80)
-        app_logger.info("✅ PYWCE ENGINE READY WITH MESSAGE CONTROLS IN HOOK")
-        app_logger.info("=" * 80)
+        app_logger.info(
+            "PyWCE engine ready",
+            start_menu=storage_manager.START_MENU,
+            report_menu=storage_manager.REPORT_MENU,
+            templates=len(storage_manager._TEMPLATES),
+            precompiled=compiled
+        )
         
         return engine
 
     except Exception as e:
-        app_logger.error("=" * 80)
-        app_logger.error("❌ FAILED TO LOAD ENGINE CONFIG")
-        app_logger.error("=" * 80)
-        app_logger.error(f"Error: {str(e)}", exc_info=True)
-        frappe.throw("Failed to load engine config", exc=e)
\ No newline at end of file
+        app_logger.error("Failed to load engine config: %s", e, exc_info=True)
+        frappe.throw("Failed to load engine config", exc=e)
+
+
+def _engine_cache_key(settings) -> tuple:
+    """(site, modified, flow digest) identifying the compiled engine for the current config"""
+    site = frappe.local.site
+    modified = str(settings.modified)
+
+    digest = _FLOW_DIGESTS.get((site, modified))
+    if digest is None:
+        flow_json = settings.flow_json or ""
+        if not isinstance(flow_json, str):
+            flow_json = json.dumps(flow_json, sort_keys=True)
+
+        digest = hashlib.sha256(flow_json.encode("utf-8")).hexdigest()
+        _FLOW_DIGESTS[(site, modified)] = digest
+
+    return (site, modified, digest)
+
+
+def _on_engine_invalidated(site: str, data: dict) -> None:
+    with _ENGINE_CACHE_LOCK:
+        if _ENGINE_CACHE.pop(site, None) is not None:
+            _ENGINE_CACHE_STATS["invalidations"] += 1
+
+        for digest_key in [k for k in _FLOW_DIGESTS if k[0] == site]:
+            _FLOW_DIGESTS.pop(digest_key, None)
+
+
+def get_engine_config() -> Engine:
+    """
+    Get the compiled PyWCE Engine for the current site.
+
+    The engine is built once per worker process and reused until the flow or
+    the ChatBot Config changes. Saves of `ChatBot Config` / `Bot Flow` are
+    broadcast over Redis pub/sub, and the `modified` + flow digest key catches
+    any missed invalidation.
+    """
+    pubsub.subscribe(ENGINE_CACHE_TOPIC, _on_engine_invalidated)
+
+    settings = frappe.get_cached_doc("ChatBot Config")
+    key = _engine_cache_key(settings)
+
+    cached = _ENGINE_CACHE.get(key[0])
+
+    if cached is not None and cached[0] == key:
+        _ENGINE_CACHE_STATS["hits"] += 1
+        engine = cached[1]
+
+    else:
+        with _ENGINE_CACHE_LOCK:
+            cached = _ENGINE_CACHE.get(key[0])
+
+            if cached is not None and cached[0] == key:
+                _ENGINE_CACHE_STATS["hits"] += 1
+                engine = cached[1]
+
+            else:
+                engine = _build_engine(settings)
+                _ENGINE_CACHE[key[0]] = (key, engine)
+                _ENGINE_CACHE_STATS["rebuilds"] += 1
+
+                app_logger.info("Engine cache rebuilt for %s, stats: %s", key[0], _ENGINE_CACHE_STATS)
+
+    # Store in frappe.local for hook listener access
+    frappe.local.storage_manager = engine.config.storage_manager
+    frappe.local.wa_client = engine.config.whatsapp
+
+    return engine
+
+
+def invalidate_engine_cache(doc=None, method=None) -> None:
+    """Drop the compiled engine in every worker, hooked to ChatBot Config / Bot Flow changes"""
+    _on_engine_invalidated(frappe.local.site, {})
+    pubsub.publish(ENGINE_CACHE_TOPIC)
+
+
+@frappe.whitelist()
+def get_engine_cache_stats() -> dict:
+    """Engine cache hit / rebuild counters of the worker process serving this request"""
+    frappe.only_for("System Manager")
+
+    return {
+        **_ENGINE_CACHE_STATS,
+        "cached_sites": list(_ENGINE_CACHE.keys())
+    }
@@ -0,0 +1,93 @@
+"""
+Per wa_id conversation cursor
+
+Keeps the routing state of the last outgoing message (template_id,
+message_level, next_level) in Redis so the routing engine does not have to
+sort `WhatsApp Chat Message` on every inbound message.
+
+Every path that records an outgoing message updates the cursor. Reads fall
+back to SQL only on a cache miss and repopulate the cursor.
+"""
+
+from typing import Optional, Dict
+
+import frappe
+
+from frappe_pywce.util import create_cache_key
+from frappe_pywce.pywce_logger import app_logger as logger
+
+CURSOR_TTL_IN_SEC = 7 * 24 * 60 * 60
+
+CURSOR_FIELDS = ("template_id", "message_level", "next_level")
+
+
+def _normalize_phone(phone_number: str) -> str:
+    return ''.join(filter(str.isdigit, str(phone_number or '')))
+
+
+def _cursor_key(phone_number: str) -> str:
+    return create_cache_key(f"cursor:{_normalize_phone(phone_number)}")
+
+
+def set_cursor(phone_number: str, template_id: str = None, message_level: str = None, next_level: str = None) -> None:
+    """Record the routing state of the message just sent to phone_number"""
+    try:
+        frappe.cache.set_value(
+            _cursor_key(phone_number),
+            {
+                "template_id": template_id or None,
+                "message_level": message_level or None,
+                "next_level": next_level or None,
+                "updated_at": frappe.utils.now()
+            },
+            expires_in_sec=CURSOR_TTL_IN_SEC
+        )
+    except Exception:
+        logger.warning("Failed to update conversation cursor for %s", phone_number, exc_info=True)
+
+
+def clear_cursor(phone_number: str) -> None:
+    frappe.cache.delete_value(_cursor_key(phone_number))
+
+
+def _load_cursor_from_db(phone_number: str) -> Dict:
+    last_message = frappe.get_all(
+        "WhatsApp Chat Message",
+        filters={
+            "phone_number": _normalize_phone(phone_number),
+            "direction": "Outgoing"
+        },
+        fields=["template_id", "message_level", "next_level", "timestamp"],
+        order_by="timestamp desc",
+        limit=1
+    )
+
+    if not last_message:
+        # cached as well, a user we never replied to must not hit SQL on every message
+        return {}
+
+    row = last_message[0]
+
+    return {
+        "template_id": row.get("template_id"),
+        "message_level": row.get("message_level"),
+        "next_level": row.get("next_level"),
+        "updated_at": str(row.get("timestamp"))
+    }
+
+
+def get_cursor(phone_number: str) -> Optional[Dict]:
+    """
+    Get the routing state of the last outgoing message to phone_number.
+
+    Returns dict with: template_id, message_level, next_level, updated_at
+    or None if nothing was ever sent to this number.
+    """
+    key = _cursor_key(phone_number)
+    cursor = frappe.cache.get_value(key)
+
+    if cursor is None:
+        cursor = _load_cursor_from_db(phone_number)
+        frappe.cache.set_value(key, cursor, expires_in_sec=CURSOR_TTL_IN_SEC)
+
+    return cursor or None
@@ -0,0 +1,260 @@
+"""
+Conversation summaries for the chat console
+
+`WhatsApp Conversation` keeps one row per phone number with the last
+message, its time and direction, the latest contact name and the number of
+unread incoming messages. It is maintained incrementally:
+
+- `record_messages` upserts a batch of new chat messages with one
+  `INSERT ... ON DUPLICATE KEY UPDATE` (bulk inserts call it directly, single
+  document inserts through the `after_insert` doc event)
+- `mark_read` / `delete` follow the console's read and delete actions
+
+`backfill` rebuilds every summary from `WhatsApp Chat Message`, it is
+enqueued by the v1_0.backfill_conversations patch and safe to run again.
+"""
+
+from typing import Dict, Iterable, List, Optional
+
+import frappe
+import frappe.utils
+
+from frappe_pywce.pywce_logger import app_logger as logger
+
+CONVERSATION_DOCTYPE = "WhatsApp Conversation"
+CHAT_MESSAGE_DOCTYPE = "WhatsApp Chat Message"
+
+BACKFILL_CHUNK_SIZE = 500
+
+SUMMARY_FIELDS = ("phone_number", "contact_name", "last_message", "last_message_time", "last_direction", "unread_count")
+
+# assignments run left to right, last_message_time is compared before it is moved forward
+_INCREMENTAL_UPDATE = """
+    `contact_name` = IF(COALESCE(VALUES(`contact_name`), '') != '', VALUES(`contact_name`), `contact_name`),
+    `last_message` = IF(`last_message_time` IS NULL OR VALUES(`last_message_time`) >= `last_message_time`,
+        VALUES(`last_message`), `last_message`),
+    `last_direction` = IF(`last_message_time` IS NULL OR VALUES(`last_message_time`) >= `last_message_time`,
+        VALUES(`last_direction`), `last_direction`),
+    `last_message_time` = GREATEST(COALESCE(`last_message_time`, VALUES(`last_message_time`)), VALUES(`last_message_time`)),
+    `unread_count` = `unread_count` + VALUES(`unread_count`),
+    `modified` = VALUES(`modified`)
+"""
+
+_ABSOLUTE_UPDATE = ",\n".join(
+    f"`{field}` = VALUES(`{field}`)" for field in (*SUMMARY_FIELDS[1:], "modified")
+)
+
+
+def _is_unread(row: Dict) -> bool:
+    return row.get("direction") == "Incoming" and row.get("status") != "read"
+
+
+def summarize(rows: Iterable[Dict]) -> List[Dict]:
+    """Fold chat message rows into one summary per phone number, sorted by phone number"""
+    summaries: Dict[str, Dict] = {}
+
+    for row in rows:
+        phone_number = row.get("phone_number")
+        if not phone_number:
+            continue
+
+        timestamp = frappe.utils.get_datetime(row.get("timestamp")) or frappe.utils.now_datetime()
+        summary = summaries.get(phone_number)
+
+        if summary is None:
+            summary = summaries[phone_number] = {"phone_number": phone_number, "contact_name": "", "unread_count": 0}
+
+        if summary.get("last_message_time") is None or timestamp >= summary["last_message_time"]:
+            summary["last_message"] = row.get("message_text") or ""
+            summary["last_message_time"] = timestamp
+            summary["last_direction"] = row.get("direction")
+
+            if row.get("contact_name"):
+                summary["contact_name"] = row["contact_name"]
+
+        elif row.get("contact_name") and not summary["contact_name"]:
+            summary["contact_name"] = row["contact_name"]
+
+        if _is_unread(row):
+            summary["unread_count"] += 1
+
+    # a fixed row order keeps concurrent upserts from deadlocking on each other
+    return [summaries[phone_number] for phone_number in sorted(summaries)]
+
+
+def _upsert(summaries: List[Dict], update: str) -> None:
+    if not summaries:
+        return
+
+    now = frappe.utils.now()
+    user = frappe.session.user
+
+    columns = ("name", "creation", "modified", "owner", "modified_by", "docstatus", *SUMMARY_FIELDS)
+    row_placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+
+    values = []
+    for summary in summaries:
+        values.extend((summary["phone_number"], now, now, user, user, 0, *(summary.get(f) for f in SUMMARY_FIELDS)))
+
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tab{CONVERSATION_DOCTYPE}` ({", ".join(f"`{c}`" for c in columns)})
+        VALUES {", ".join([row_placeholder] * len(summaries))}
+        ON DUPLICATE KEY UPDATE {update}
+        """,
+        values
+    )
+
+
+def record_messages(rows: Iterable[Dict]) -> None:
+    """Fold new chat message rows into their conversation summaries, part of the caller's transaction"""
+    _upsert(summarize(rows), _INCREMENTAL_UPDATE)
+
+
+def on_chat_message_insert(doc, method=None) -> None:
+    """`after_insert` of WhatsApp Chat Message, bulk inserts call record_messages themselves"""
+    try:
+        record_messages([doc.as_dict()])
+    except Exception:
+        logger.warning("Failed to update conversation summary of %s", doc.phone_number, exc_info=True)
+
+
+def mark_read(phone_number: str) -> None:
+    frappe.db.sql(
+        f"UPDATE `tab{CONVERSATION_DOCTYPE}` SET `unread_count` = 0 WHERE `name` = %s AND `unread_count` != 0",
+        (phone_number,)
+    )
+
+
+def delete(phone_number: str) -> None:
+    frappe.db.delete(CONVERSATION_DOCTYPE, {"name": phone_number})
+
+
+def get_page(limit: int = 50, before_time=None, before_phone: Optional[str] = None) -> List[Dict]:
+    """
+    Conversations newest first, keyset paginated on (last_message_time, phone_number).
+
+    Pass the `last_message_time` and `phone_number` of the last row of a page
+    to get the next one.
+    """
+    conditions = ""
+    values = []
+
+    if before_time:
+        conditions = "WHERE `last_message_time` < %s OR (`last_message_time` = %s AND `name` < %s)"
+        values = [before_time, before_time, before_phone or ""]
+
+    return frappe.db.sql(
+        f"""
+        SELECT `phone_number`, `contact_name`, `last_message_time`, `last_message`, `last_direction`, `unread_count`
+        FROM `tab{CONVERSATION_DOCTYPE}`
+        {conditions}
+        ORDER BY `last_message_time` DESC, `name` DESC
+        LIMIT %s
+        """,
+        (*values, limit),
+        as_dict=True
+    )
+
+
+def _summaries_from_messages(phone_numbers: List[str]) -> List[Dict]:
+    """Absolute summaries of `phone_numbers`, a few grouped queries per chunk instead of per phone number"""
+    placeholders = ", ".join(["%s"] * len(phone_numbers))
+
+    last_messages = frappe.db.sql(
+        f"""
+        SELECT m.`phone_number`, m.`message_text`, m.`timestamp`, m.`direction`
+        FROM `tab{CHAT_MESSAGE_DOCTYPE}` m
+        JOIN (
+            SELECT `phone_number`, MAX(`timestamp`) AS `timestamp`
+            FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+            WHERE `phone_number` IN ({placeholders})
+            GROUP BY `phone_number`
+        ) latest ON latest.`phone_number` = m.`phone_number` AND latest.`timestamp` = m.`timestamp`
+        """,
+        phone_numbers,
+        as_dict=True
+    )
+
+    contact_names = frappe.db.sql(
+        f"""
+        SELECT m.`phone_number`, m.`contact_name`
+        FROM `tab{CHAT_MESSAGE_DOCTYPE}` m
+        JOIN (
+            SELECT `phone_number`, MAX(`timestamp`) AS `timestamp`
+            FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+            WHERE `phone_number` IN ({placeholders}) AND COALESCE(`contact_name`, '') != ''
+            GROUP BY `phone_number`
+        ) named ON named.`phone_number` = m.`phone_number` AND named.`timestamp` = m.`timestamp`
+        WHERE COALESCE(m.`contact_name`, '') != ''
+        """,
+        phone_numbers
+    )
+
+    unread_counts = frappe.db.sql(
+        f"""
+        SELECT `phone_number`, COUNT(*)
+        FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+        WHERE `phone_number` IN ({placeholders}) AND `direction` = 'Incoming' AND `status` != 'read'
+        GROUP BY `phone_number`
+        """,
+        phone_numbers
+    )
+
+    contact_names = dict(contact_names)
+    unread_counts = dict(unread_counts)
+    summaries = {}
+
+    for row in last_messages:
+        # messages sharing the last timestamp: any of them will do
+        summaries.setdefault(row.phone_number, {
+            "phone_number": row.phone_number,
+            "contact_name": contact_names.get(row.phone_number, ""),
+            "last_message": row.message_text or "",
+            "last_message_time": row.timestamp,
+            "last_direction": row.direction,
+            "unread_count": unread_counts.get(row.phone_number, 0)
+        })
+
+    return [summaries[phone_number] for phone_number in sorted(summaries)]
+
+
+def backfill(chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    """Rebuild every conversation summary from the chat messages, one commit per chunk of phone numbers"""
+    last_phone = ""
+    total = 0
+
+    while True:
+        phone_numbers = frappe.db.sql_list(
+            f"""
+            SELECT DISTINCT `phone_number`
+            FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+            WHERE `phone_number` > %s
+            ORDER BY `phone_number`
+            LIMIT %s
+            """,
+            (last_phone, chunk_size)
+        )
+
+        if not phone_numbers:
+            break
+
+        _upsert(_summaries_from_messages(phone_numbers), _ABSOLUTE_UPDATE)
+        frappe.db.commit()
+
+        total += len(phone_numbers)
+        last_phone = phone_numbers[-1]
+
+    logger.info("Backfilled %s conversation summaries", total)
+    return total
+
+
+def enqueue_backfill() -> None:
+    frappe.enqueue(
+        "frappe_pywce.conversation_summary.backfill",
+        queue="long",
+        timeout=3600,
+        deduplicate=True,
+        job_id=f"fpw:conversation_backfill:{frappe.local.site}",
+        enqueue_after_commit=True
+    )
@@ -0,0 +1,151 @@
+"""
+Deferred chatbot sends
+
+A template's `delay_time` used to be applied with time.sleep in the hook
+listener, holding the webhook job, its wa_id partition and an RQ worker for
+the whole delay. The hook now only records the delay, and the next send to
+that recipient is scheduled into the outbound dispatcher's delayed sorted
+set (scored by due time) instead of being posted. `bench pywce-outbound-worker`
+promotes due entries to the head of the interactive lane and sends them. On
+sites without a running worker each scheduled send starts the short-lived
+`dispatch_due` job instead (see frappe_pywce.outbound.ensure_dispatch).
+
+Per recipient order is kept: while a deferred send is pending, later sends to
+the same recipient are scheduled right behind it instead of overtaking it.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+import frappe
+from frappe.utils.background_jobs import get_redis_conn
+from pywce import client
+
+from frappe_pywce import tracing
+from frappe_pywce.outbound import LANE_INTERACTIVE, ensure_dispatch, get_dispatcher
+from frappe_pywce.util import CACHE_KEY_PREFIX
+from frappe_pywce.pywce_logger import app_logger as logger
+
+# keeps later sends queued behind a deferred one until it has been dispatched
+PENDING_TTL_MARGIN_IN_SEC = 60
+ORDER_GAP_IN_SEC = 0.001
+
+DEFERRED_MESSAGE_ID_PREFIX = "deferred."
+
+
+def _pending_key(recipient: str) -> str:
+    return f"{CACHE_KEY_PREFIX}out:{frappe.local.site}:pending:{recipient}"
+
+
+def defer_next_send(recipient: str, delay: float) -> None:
+    """Delay the next send to `recipient` in this job by `delay` seconds, called from the hook listener"""
+    delays = getattr(frappe.local, "pywce_send_delays", None)
+
+    if delays is None:
+        delays = frappe.local.pywce_send_delays = {}
+
+    delays[recipient] = delay
+
+
+def _pop_delay(recipient: str) -> float:
+    delays = getattr(frappe.local, "pywce_send_delays", None) or {}
+    return delays.pop(recipient, 0) or 0
+
+
+def schedule_send(phone_id: str, recipient: str, payload: dict, delay: float = 0, **extra) -> Optional[float]:
+    """
+    Schedule `payload` when it has a delay or an earlier deferred send to the
+    recipient is still pending.
+
+    Returns:
+        the due time (epoch seconds), None when the payload should be sent now
+    """
+    conn = get_redis_conn()
+    key = _pending_key(recipient)
+    now = time.time()
+
+    due = now + delay if delay > 0 else None
+    pending = conn.get(key)
+
+    if pending is not None:
+        due = max(due or now, float(pending) + ORDER_GAP_IN_SEC)
+
+    if due is None:
+        return None
+
+    dispatcher = get_dispatcher()
+    dispatcher.schedule(phone_id, payload, due, lane=LANE_INTERACTIVE, recipient=recipient, **extra)
+    conn.set(key, repr(due), ex=int(due - now) + PENDING_TTL_MARGIN_IN_SEC)
+
+    try:
+        ensure_dispatch(dispatcher)
+    except Exception:
+        # the entry is queued already, the flush_overdue scheduler job still sends it
+        logger.warning("Failed to start an outbound dispatch job", exc_info=True)
+
+    return due
+
+
+def on_deferred_sent(entry: Dict[str, Any], result: Dict[str, Any]) -> None:
+    """`on_sent` callback of deferred entries, run by the outbound dispatcher"""
+    conn = get_redis_conn()
+    key = _pending_key(entry["recipient"])
+
+    # the last deferred send of the recipient is out, later sends go out directly again
+    pending = conn.get(key)
+    if pending is not None and float(pending) == entry["due"]:
+        conn.delete(key)
+
+    if not entry.get("message_doc"):
+        return
+
+    try:
+        message_id = (result.get("messages") or [{}])[0].get("id")
+
+        frappe.db.set_value(
+            "WhatsApp Chat Message",
+            entry["message_doc"],
+            {"message_id": message_id, "status": "sent"}
+        )
+        frappe.db.commit()
+
+    except Exception as e:
+        logger.error("Failed to update deferred message %s: %s", entry["message_doc"], e)
+
+
+class DeferringWhatsApp(client.WhatsApp):
+    """pywce WhatsApp client that hands delayed sends to the outbound dispatcher instead of posting them"""
+
+    def _send_request(self, message_type: str, recipient_id: str, data: Dict[str, Any]):
+        hook_arg = getattr(frappe.local, "hook_arg", None)
+
+        try:
+            due = schedule_send(
+                self.config.phone_number_id,
+                recipient_id,
+                data,
+                delay=_pop_delay(recipient_id),
+                url=self.url if self.config.use_emulator else None,
+                message_doc=getattr(hook_arg, "message_doc_name", None),
+                on_sent="frappe_pywce.delayed_send.on_deferred_sent"
+            )
+
+        except Exception:
+            logger.warning("Failed to schedule %s to %s, sending now", message_type, recipient_id, exc_info=True)
+            due = None
+
+        if due is None:
+            with tracing.span("graph_http"):
+                return super()._send_request(message_type, recipient_id, data)
+
+        logger.debug("Deferred %s to %s", message_type, recipient_id, due=round(due, 3))
+
+        # the send listener would mark the message sent, on_deferred_sent does it once it is
+        frappe.local.hook_arg = None
+
+        # shaped like a Graph response, pywce reads no wamid (message id) from it
+        return {
+            "messaging_product": "whatsapp",
+            "contacts": [{"wa_id": recipient_id}],
+            "messages": [{"id": f"{DEFERRED_MESSAGE_ID_PREFIX}{due}"}]
+        }
@@ -0,0 +1,150 @@
+"""
+Compiled flow cache
+
+Loading a flow translates it with pywce's VisualTranslator, then fixes and
+pydantic-validates every template. Two Redis caches avoid repeating that work:
+
+- compiled templates, keyed by a hash of the translated template: after a
+  flow is saved only templates whose content changed are fixed and validated
+  again (and checked for broken routes). Only the templates of the current
+  flow are kept, each compile drops the entries it no longer uses
+- the compiled artifact of a whole flow (templates, triggers, start and report
+  menus), keyed by the flow digest, so a cold worker starts without
+  translating at all
+
+Values are pickled by frappe's cache. Keys include a cache version and the
+installed pywce version, an upgrade starts from scratch.
+"""
+
+import hashlib
+import json
+import pickle
+from typing import Any, Dict, Iterable, Optional
+
+import frappe
+import redis
+
+from frappe_pywce.pywce_logger import app_logger as logger
+
+FLOW_CACHE_VERSION = 1
+FLOW_CACHE_TTL_IN_SEC = 7 * 86400
+
+_pywce_version = None
+
+
+def _get_pywce_version() -> str:
+    global _pywce_version
+
+    if _pywce_version is None:
+        try:
+            from importlib.metadata import version
+            _pywce_version = version("pywce")
+        except Exception:
+            _pywce_version = "unknown"
+
+    return _pywce_version
+
+
+def _key(name: str) -> str:
+    return f"fpw:flow:v{FLOW_CACHE_VERSION}:{_get_pywce_version()}:{name}"
+
+
+def flow_digest(flow_json) -> str:
+    if not isinstance(flow_json, str):
+        flow_json = json.dumps(flow_json, sort_keys=True)
+
+    return hashlib.sha256(flow_json.encode("utf-8")).hexdigest()
+
+
+def template_digest(name: str, template_data: dict) -> str:
+    """Content hash of a translated template, computed before it is fixed up"""
+    raw = json.dumps([name, template_data], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def get_artifact(digest: str) -> Optional[Dict[str, Any]]:
+    try:
+        return frappe.cache.get_value(_key(f"artifact:{digest}"), expires=True)
+    except Exception:
+        logger.warning("Failed to read compiled flow artifact", exc_info=True)
+        return None
+
+
+def set_artifact(digest: str, artifact: Dict[str, Any]) -> None:
+    try:
+        frappe.cache.set_value(_key(f"artifact:{digest}"), artifact, expires_in_sec=FLOW_CACHE_TTL_IN_SEC)
+    except Exception:
+        logger.warning("Failed to store compiled flow artifact", exc_info=True)
+
+
+def _templates_key() -> str:
+    # the raw redis commands below skip frappe's key prefixing
+    return frappe.cache.make_key(_key("templates"))
+
+
+def get_compiled_templates(digests: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Cached entries of `digests`, one HMGET:
+    {template digest: {"template": fixed template, "error": None or validation error}}
+    """
+    digests = list(digests)
+
+    if not digests:
+        return {}
+
+    try:
+        # values are pickled, as frappe.cache.hset stores them
+        values = redis.Redis.hmget(frappe.cache, _templates_key(), digests)
+        return {digest: pickle.loads(value) for digest, value in zip(digests, values) if value is not None}
+    except Exception:
+        logger.warning("Failed to read compiled templates", exc_info=True)
+        return {}
+
+
+def set_compiled_templates(compiled: Dict[str, Dict[str, Any]], keep: Optional[Iterable[str]] = None) -> None:
+    """Store `compiled`, with `keep` (the digests of the current flow) every other entry is dropped"""
+    try:
+        name = _key("templates")
+
+        for digest, entry in compiled.items():
+            frappe.cache.hset(name, digest, entry)
+
+        if keep is not None:
+            keep = set(keep) | set(compiled)
+            stale = [
+                field for field in redis.Redis.hkeys(frappe.cache, _templates_key())
+                if (field.decode("utf-8") if isinstance(field, bytes) else field) not in keep
+            ]
+
+            if stale:
+                redis.Redis.hdel(frappe.cache, _templates_key(), *stale)
+
+        if compiled:
+            frappe.cache.expire(_templates_key(), FLOW_CACHE_TTL_IN_SEC)
+
+    except Exception:
+        logger.warning("Failed to store compiled templates", exc_info=True)
+
+
+def clear() -> None:
+    frappe.cache.delete_keys(_key(""))
+
+
+def precompile_flow() -> None:
+    """Compile the configured flow ahead of the first webhook, enqueued on ChatBot Config save"""
+    from frappe_pywce.managers import FrappeStorageManager
+
+    settings = frappe.get_cached_doc("ChatBot Config")
+
+    if settings.flow_json:
+        FrappeStorageManager(settings.flow_json)
+
+
+def enqueue_precompile(doc=None, method=None) -> None:
+    frappe.enqueue(
+        "frappe_pywce.flow_cache.precompile_flow",
+        queue="short",
+        deduplicate=True,
+        job_id=f"fpw:precompile_flow:{frappe.local.site}",
+        enqueue_after_commit=True
+    )
@@ -6,6 +6,16 @@ import json
 from frappe import _
 from datetime import datetime
 
+from frappe_pywce import chat_history, media_upload
+from frappe_pywce.graph_client import get_graph_client
+from frappe_pywce.outbound import throttle
+
+
+def _send(config, payload):
+    """Send a message payload through the shared Graph client, fails fast when it exceeds Meta's rate limits"""
+    throttle(config.phone_id, payload.get("to", ""))
+    return get_graph_client().send_message(config.phone_id, config.access_token, payload)
+
 @frappe.whitelist()
 def get_contacts():
     """Get all WhatsApp contacts"""
@@ -18,16 +28,21 @@ def get_contacts():
     return contacts
 
 @frappe.whitelist()
-def get_messages(contact):
-    """Get all messages for a specific contact"""
-    messages = frappe.get_all(
+def get_messages(contact, limit=100, before=None, after=None):
+    """
+    Messages of a contact, oldest first: the newest `limit` ones, or the page
+    older / newer than a `before` / `after` cursor (see frappe_pywce.chat_history)
+    """
+    page = chat_history.fetch_page(
         "WhatsApp Message",
-        filters={"contact": contact},
-        fields=["name", "message_id", "direction", "message_type", "message_text", 
-                "media_url", "media_caption", "status", "timestamp", "is_read"],
-        order_by="timestamp asc"
+        {"contact": contact},
+        ["message_id", "direction", "message_type", "message_text",
+         "media_url", "media_caption", "status", "is_read"],
+        limit=chat_history.page_size(limit),
+        before=before,
+        after=after
     )
-    return messages
+    return page["messages"]
 
 @frappe.whitelist()
 def send_message(phone_number, message_text, message_type="text", media_url=None):
@@ -56,13 +71,6 @@ def send_message(phone_number, message_text, message_type="text", media_url=None
         # Ensure contact exists
         contact = get_or_create_contact(clean_phone)
         
-        # Prepare API request
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-        
         # Build message payload
         payload = {
             "messaging_product": "whatsapp",
@@ -82,10 +90,7 @@ def send_message(phone_number, message_text, message_type="text", media_url=None
                 payload[message_type]["caption"] = message_text
         
         # Send request to WhatsApp API
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
         
         # Save message to database
@@ -172,31 +177,45 @@ def update_contact_last_message(contact, message, timestamp):
     contact_doc.save(ignore_permissions=True)
 
 @frappe.whitelist()
-def upload_media(file_data):
-    """Upload media to WhatsApp and return media ID"""
+def upload_media(file_data=None, file_url=None, file_name=None, mime_type=None):
+    """
+    Upload media to WhatsApp and return its media ID
+
+    Pass the `file_url` of a Frappe File to stream it from disk, `file_data`
+    uploads content sent with the request. Media IDs are cached by content,
+    the same file is only uploaded once (see frappe_pywce.media_upload).
+    """
     try:
-        config = frappe.get_single("ChatBot Config")
-        
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/media"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}"
-        }
-        
-        files = {
-            "file": file_data,
-            "messaging_product": "whatsapp"
-        }
-        
-        response = requests.post(url, headers=headers, files=files)
-        response.raise_for_status()
-        
-        result = response.json()
-        return {"success": True, "media_id": result.get("id")}
+        if file_url:
+            file_doc = media_upload.get_file(file_url)
+            media_id = media_upload.upload_file(
+                file_doc.get_full_path(), file_name or file_doc.file_name, mime_type
+            )
+        elif file_data:
+            content = file_data.encode() if isinstance(file_data, str) else file_data
+            media_id = media_upload.upload_bytes(content, file_name or "file", mime_type)
+        else:
+            frappe.throw(_("Either file_url or file_data is required"))
+
+        return {"success": True, "media_id": media_id}
         
     except Exception as e:
         frappe.log_error(f"Media upload error: {str(e)}", "WhatsApp Media Upload")
         frappe.throw(_("Failed to upload media: {0}").format(str(e)))
 
+@frappe.whitelist()
+def upload_media_handle(file_url, mime_type=None):
+    """Upload a Frappe File through a resumable upload session and return its file handle (template header examples)"""
+    try:
+        file_doc = media_upload.get_file(file_url)
+        handle = media_upload.upload_handle(file_doc.get_full_path(), file_doc.file_name, mime_type)
+
+        return {"success": True, "handle": handle}
+
+    except Exception as e:
+        frappe.log_error(f"Media upload error: {str(e)}", "WhatsApp Media Upload")
+        frappe.throw(_("Failed to upload media: {0}").format(str(e)))
+
 @frappe.whitelist()
 def search_contacts(query):
     """Search contacts by name or phone number"""
@@ -268,12 +287,6 @@ def send_button_message(phone_number, message_text, buttons, header_text=None, f
             # Assume South African number if 10 digits
             clean_phone = f"27{clean_phone}"
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         # Format buttons for WhatsApp API
         button_rows = []
         for i, button in enumerate(buttons[:3]):  # WhatsApp allows max 3 buttons
@@ -317,10 +330,7 @@ def send_button_message(phone_number, message_text, buttons, header_text=None, f
         # Debug logging
         frappe.logger().info(f"Button message payload: {payload}")
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -346,12 +356,6 @@ def send_list_message(phone_number, message_text, list_title, sections, header_t
         if not config.access_token or not config.phone_id:
             frappe.throw(_("ChatBot Config not properly configured"))
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         # Format sections for WhatsApp API
         formatted_sections = []
         for section in sections[:10]:  # WhatsApp allows max 10 sections
@@ -395,10 +399,7 @@ def send_list_message(phone_number, message_text, list_title, sections, header_t
             "interactive": interactive
         }
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -421,12 +422,6 @@ def send_flow_message(phone_number, flow_token, flow_data=None):
         if not config.access_token or not config.phone_id:
             frappe.throw(_("ChatBot Config not properly configured"))
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
@@ -442,10 +437,7 @@ def send_flow_message(phone_number, flow_token, flow_data=None):
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -482,12 +474,6 @@ def send_location_message(phone_number, latitude, longitude, name=None, address=
         if not config.access_token or not config.phone_id:
             frappe.throw(_("ChatBot Config not properly configured"))
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
@@ -504,10 +490,7 @@ def send_location_message(phone_number, latitude, longitude, name=None, address=
         if address:
             payload["location"]["address"] = address
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -529,12 +512,6 @@ def send_contact_message(phone_number, contact_data):
         if not config.access_token or not config.phone_id:
             frappe.throw(_("ChatBot Config not properly configured"))
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         # Format contact data for WhatsApp API
         contact_payload = {
             "name": {
@@ -567,10 +544,7 @@ def send_contact_message(phone_number, contact_data):
             "contacts": [contact_payload]
         }
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -592,12 +566,6 @@ def request_location_message(phone_number, message_text):
         if not config.access_token or not config.phone_id:
             frappe.throw(_("ChatBot Config not properly configured"))
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
@@ -610,10 +578,7 @@ def request_location_message(phone_number, message_text):
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -646,12 +611,6 @@ def send_cta_url_message(phone_number, body_text, button_text, url, header_text=
         if len(clean_phone) == 10:
             clean_phone = f"27{clean_phone}"
 
-        url_endpoint = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         # Build interactive message with CTA URL button
         interactive = {
             "type": "cta_url",
@@ -681,10 +640,7 @@ def send_cta_url_message(phone_number, body_text, button_text, url, header_text=
             "interactive": interactive
         }
 
-        response = requests.post(url_endpoint, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -709,12 +665,6 @@ def send_template_message(phone_number, template_name, language_code="en", compo
         if not config.access_token or not config.phone_id:
             frappe.throw(_("ChatBot Config not properly configured"))
 
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.access_token}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
@@ -729,10 +679,7 @@ def send_template_message(phone_number, template_name, language_code="en", compo
         if components:
             payload["template"]["components"] = components
 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        result = response.json()
+        result = _send(config, payload)
         message_id = result.get("messages", [{}])[0].get("id")
 
         return {"success": True, "message_id": message_id}
@@ -1,5 +1,27 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_pywce.message_search import add_fulltext_index
+
+# index name -> columns, serving the inbox / routing access patterns:
+# a conversation's messages by direction in time order, its whole history
+# in time order, and unread incoming counts
+CHAT_MESSAGE_INDEXES = {
+    "phone_direction_timestamp_index": ["phone_number", "direction", "timestamp"],
+    "phone_timestamp_index": ["phone_number", "timestamp"],
+    "status_direction_index": ["status", "direction"],
+}
+
+
 class WhatsAppChatMessage(Document):
-    pass
\ No newline at end of file
+    pass
+
+
+def add_indexes():
+    for index_name, fields in CHAT_MESSAGE_INDEXES.items():
+        frappe.db.add_index("WhatsApp Chat Message", fields, index_name=index_name)
+
+
+def on_doctype_update():
+    add_indexes()
+    add_fulltext_index()
@@ -0,0 +1,14 @@
+# Copyright (c) 2026, donnc and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class WhatsAppConversation(Document):
+	pass
+
+
+def on_doctype_update():
+	# keyset pagination of the chat console, newest conversation first
+	frappe.db.add_index("WhatsApp Conversation", ["last_message_time", "name"], index_name="last_message_time_name_index")
@@ -13,7 +13,15 @@ class WhatsAppChat {
         this.page = page;
         this.current_phone = null;
         this.conversations = [];
+        this.conversations_page_size = 50;
+        this.has_more_conversations = false;
+        this.loading_more_conversations = false;
         this.messages = [];
+        this.messages_page_size = 50;
+        this.history_before = null;
+        this.history_has_more = false;
+        this.loading_older_messages = false;
+        this.mark_read_timeout = null;
         this.refresh_interval = null;
         this.last_message_count = 0;
         this.is_user_scrolled_up = false;
@@ -171,6 +179,20 @@ class WhatsAppChat {
             $('#scroll-to-bottom-btn').fadeOut(200);
         });
         
+        // Load older messages near the top of the conversation
+        $('#chat-messages').on('scroll', function() {
+            if (this.scrollTop < 100) {
+                self.load_older_messages();
+            }
+        });
+        
+        // Load the next page of conversations near the end of the list
+        $('#conversations-list').on('scroll', function() {
+            if (this.scrollHeight - this.scrollTop - this.clientHeight < 100) {
+                self.load_more_conversations();
+            }
+        });
+        
         // Monitor scroll position
         $(document).on('scroll', '#chat-messages', function() {
             const container = this;
@@ -192,13 +214,17 @@ class WhatsAppChat {
 
     async load_conversations(silent = false) {
         try {
+            // refreshes reload every page already shown, newest first
+            const limit = Math.max(this.conversations.length, this.conversations_page_size);
             const response = await frappe.call({
                 method: 'frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.get_conversations',
+                args: { limit },
                 freeze: !silent,
                 freeze_message: silent ? '' : 'Loading conversations...'
             });
             
             this.conversations = response.message || [];
+            this.has_more_conversations = this.conversations.length >= limit;
             this.render_conversations();
         } catch (error) {
             if (!silent) {
@@ -211,6 +237,33 @@ class WhatsAppChat {
         }
     }
 
+    async load_more_conversations() {
+        if (!this.has_more_conversations || this.loading_more_conversations || !this.conversations.length) {
+            return;
+        }
+        
+        this.loading_more_conversations = true;
+        
+        try {
+            const last = this.conversations[this.conversations.length - 1];
+            const response = await frappe.call({
+                method: 'frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.get_conversations',
+                args: {
+                    limit: this.conversations_page_size,
+                    before_time: last.last_message_time,
+                    before_phone: last.phone_number
+                }
+            });
+            
+            const page = response.message || [];
+            this.conversations = this.conversations.concat(page);
+            this.has_more_conversations = page.length >= this.conversations_page_size;
+            this.render_conversations();
+        } finally {
+            this.loading_more_conversations = false;
+        }
+    }
+
     render_conversations() {
         const container = $('#conversations-list');
         container.empty();
@@ -271,19 +324,40 @@ class WhatsAppChat {
         await this.load_messages(phone_number);
     }
 
+    history_args(phone_number, extra = {}) {
+        return {
+            method: 'frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.get_history',
+            args: { phone_number, limit: this.messages_page_size, ...extra }
+        };
+    }
+
     async load_messages(phone_number, silent = false) {
         try {
+            // the newest page, older pages are loaded on scroll
             const response = await frappe.call({
-                method: 'frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.get_messages',
-                args: { phone_number },
+                ...this.history_args(phone_number),
                 freeze: !silent
             });
             
+            if (phone_number !== this.current_phone) return;
+            
+            const page = response.message || {};
+            const latest = page.messages || [];
             const old_count = this.messages.length;
-            this.messages = response.message || [];
+            const overlap = latest.length ? this.messages.findIndex(m => m.name === latest[0].name) : -1;
+            
+            if (silent && overlap >= 0) {
+                // keep the older pages already loaded, refresh the newest one
+                this.messages = this.messages.slice(0, overlap).concat(latest);
+            } else {
+                this.messages = latest;
+                this.history_before = page.before;
+                this.history_has_more = page.has_more;
+            }
             const new_count = this.messages.length;
             
             this.render_messages();
+            this.schedule_mark_as_read(phone_number);
             
             // Decide whether to scroll based on context
             if (!silent) {
@@ -307,6 +381,54 @@ class WhatsAppChat {
         }
     }
 
+    async load_older_messages() {
+        if (!this.current_phone || !this.history_has_more || this.loading_older_messages) {
+            return;
+        }
+        
+        const phone_number = this.current_phone;
+        this.loading_older_messages = true;
+        
+        try {
+            const response = await frappe.call(this.history_args(phone_number, { before: this.history_before }));
+            if (phone_number !== this.current_phone) return;
+            
+            const page = response.message || {};
+            const container = document.getElementById('chat-messages');
+            const height_before = container.scrollHeight;
+            
+            this.messages = (page.messages || []).concat(this.messages);
+            this.history_before = page.before;
+            this.history_has_more = page.has_more;
+            this.render_messages();
+            
+            // keep the message the user was reading in place
+            container.scrollTop += container.scrollHeight - height_before;
+        } finally {
+            this.loading_older_messages = false;
+        }
+    }
+
+    schedule_mark_as_read(phone_number) {
+        // debounced: bursts of new messages and refreshes send a single call
+        clearTimeout(this.mark_read_timeout);
+        
+        this.mark_read_timeout = setTimeout(() => {
+            if (phone_number !== this.current_phone) return;
+            
+            frappe.call({
+                method: 'frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.mark_as_read',
+                args: { phone_number }
+            });
+            
+            const conv = this.conversations.find(c => c.phone_number === phone_number);
+            if (conv && conv.unread_count) {
+                conv.unread_count = 0;
+                this.render_conversations();
+            }
+        }, 1500);
+    }
+
     render_messages() {
         const container = $('#chat-messages');
         container.empty();
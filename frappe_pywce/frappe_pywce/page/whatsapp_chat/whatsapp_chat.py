@@ -3,6 +3,20 @@ import requests
 from datetime import datetime
 import json
 
+from frappe_pywce import chat_history, conversation_summary, media_cache, message_search
+from frappe_pywce.conversation_cursor import clear_cursor, set_cursor
+from frappe_pywce.graph_client import get_graph_client
+from frappe_pywce.outbound import LANE_INTERACTIVE, SendThrottledError, enqueue_send, throttle
+
+MAX_CONVERSATIONS_PAGE = 500
+
+HISTORY_FIELDS = (
+    "phone_number", "message_id", "direction", "message_type", "message_text",
+    "media_url", "media_type", "status", "contact_name"
+)
+# message types the console renders from their metadata
+METADATA_MESSAGE_TYPES = ("location", "contacts")
+
 
 def normalize_phone_number(phone_number):
     """Normalize phone number to consistent format (digits only)"""
@@ -12,73 +26,86 @@ def normalize_phone_number(phone_number):
 
 
 @frappe.whitelist()
-def get_conversations():
-    """Get all unique phone numbers with their last message"""
-    conversations = frappe.db.sql("""
-        SELECT 
-            phone_number,
-            (SELECT contact_name 
-             FROM `tabWhatsApp Chat Message` wcm2 
-             WHERE wcm2.phone_number = wcm.phone_number 
-             AND contact_name IS NOT NULL 
-             AND contact_name != ''
-             ORDER BY timestamp DESC 
-             LIMIT 1) as contact_name,
-            MAX(timestamp) as last_message_time,
-            (SELECT message_text 
-             FROM `tabWhatsApp Chat Message` wcm2 
-             WHERE wcm2.phone_number = wcm.phone_number 
-             ORDER BY timestamp DESC 
-             LIMIT 1) as last_message,
-            (SELECT COUNT(*) 
-             FROM `tabWhatsApp Chat Message` wcm3 
-             WHERE wcm3.phone_number = wcm.phone_number 
-             AND wcm3.status != 'read' 
-             AND wcm3.direction = 'Incoming') as unread_count
-        FROM `tabWhatsApp Chat Message` wcm
-        GROUP BY phone_number
-        ORDER BY last_message_time DESC
-    """, as_dict=True)
-    
-    return conversations
+def get_conversations(limit=50, before_time=None, before_phone=None):
+    """
+    Conversations with their last message, newest first, read from the
+    WhatsApp Conversation summaries.
 
+    Keyset paginated: pass `last_message_time` / `phone_number` of the last
+    row as before_time / before_phone for the next page.
+    """
+    limit = min(max(frappe.utils.cint(limit) or 50, 1), MAX_CONVERSATIONS_PAGE)
 
-@frappe.whitelist()
-def get_messages(phone_number, limit=100):
-    """Get messages for a specific phone number"""
-    # Normalize the phone number for querying
-    normalized_phone = normalize_phone_number(phone_number)
-    
-    messages = frappe.get_all(
-        "WhatsApp Chat Message",
-        filters={"phone_number": normalized_phone},
-        fields=[
-            "name", "phone_number", "message_id", "timestamp", 
-            "direction", "message_type", "message_text", 
-            "media_url", "media_type", "status", "contact_name", "metadata"
-        ],
-        order_by="timestamp asc",
-        limit=limit
-    )
-    
-    # Process metadata for each message
+    return conversation_summary.get_page(limit=limit, before_time=before_time, before_phone=before_phone)
+
+
+def _parse_metadata(messages):
     for msg in messages:
-        if msg.metadata:
+        if msg.get("metadata"):
             try:
                 msg.metadata = json.loads(msg.metadata) if isinstance(msg.metadata, str) else msg.metadata
             except:
                 msg.metadata = {}
-    
-    # Mark incoming messages as read
-    frappe.db.sql("""
-        UPDATE `tabWhatsApp Chat Message`
-        SET status = 'read'
-        WHERE phone_number = %s 
-        AND direction = 'Incoming'
-        AND status != 'read'
-    """, (normalized_phone,))
-    frappe.db.commit()
-    
+
+
+@frappe.whitelist()
+def get_history(phone_number, limit=chat_history.DEFAULT_PAGE_SIZE, before=None, after=None):
+    """
+    A page of a conversation, oldest first.
+
+    Without a cursor the newest `limit` messages are returned, `before` /
+    `after` take the cursor of a previous page to load older / newer ones.
+    `metadata` is only loaded for the message types that render it, see
+    get_message_metadata for the others. Reading does not mark the
+    conversation read, the console calls mark_as_read for that.
+    """
+    normalized_phone = normalize_phone_number(phone_number)
+
+    page = chat_history.fetch_page(
+        "WhatsApp Chat Message",
+        {"phone_number": normalized_phone},
+        HISTORY_FIELDS,
+        limit=chat_history.page_size(limit),
+        before=before,
+        after=after
+    )
+
+    with_metadata = [m.name for m in page["messages"] if m.message_type in METADATA_MESSAGE_TYPES]
+
+    if with_metadata:
+        metadata = dict(frappe.get_all(
+            "WhatsApp Chat Message",
+            filters={"name": ["in", with_metadata]},
+            fields=["name", "metadata"],
+            as_list=True
+        ))
+
+        for msg in page["messages"]:
+            if msg.name in metadata:
+                msg.metadata = metadata[msg.name]
+
+        _parse_metadata(page["messages"])
+
+    return page
+
+
+@frappe.whitelist()
+def get_message_metadata(name):
+    """The raw webhook metadata of one message, loaded on demand"""
+    metadata = frappe.db.get_value("WhatsApp Chat Message", name, "metadata")
+
+    try:
+        return json.loads(metadata) if isinstance(metadata, str) else (metadata or {})
+    except ValueError:
+        return {}
+
+
+@frappe.whitelist()
+def get_messages(phone_number, limit=100):
+    """The newest `limit` messages of a conversation, oldest first. Kept for older clients, use get_history"""
+    messages = get_history(phone_number, limit=limit)["messages"]
+    mark_as_read(phone_number)
+
     return messages
 
 
@@ -112,6 +139,9 @@ def send_message(phone_number, message_text, message_type="text"):
         message_doc.insert(ignore_permissions=True)
         frappe.db.commit()
         
+        # Agent replies carry no routing state, the bot resumes from triggers
+        set_cursor(clean_phone)
+        
         # Return immediately to UI
         frappe.enqueue(
             _send_message_async,
@@ -146,13 +176,6 @@ def _send_message_async(message_name, phone_number, message_text, message_type):
         # Get ChatBot Config
         config = frappe.get_single("ChatBot Config")
         
-        # Prepare API request
-        url = f"https://graph.facebook.com/v18.0/{config.phone_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {config.get_password('access_token')}",
-            "Content-Type": "application/json"
-        }
-        
         payload = {
             "messaging_product": "whatsapp",
             "to": phone_number,
@@ -162,101 +185,109 @@ def _send_message_async(message_name, phone_number, message_text, message_type):
             }
         }
         
-        # Send message to WhatsApp API
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        response.raise_for_status()
-        result = response.json()
-        
-        # Get message ID from response
-        message_id = None
-        if result.get("messages") and len(result["messages"]) > 0:
-            message_id = result["messages"][0].get("id")
-        
-        # Update message with ID and status
-        frappe.db.set_value(
-            "WhatsApp Chat Message",
-            message_name,
-            {
-                "message_id": message_id,
-                "status": "sent"
-            }
-        )
-        frappe.db.commit()
+        try:
+            throttle(config.phone_id, phone_number)
+        except SendThrottledError:
+            # the outbound worker parks pair limited sends instead of holding this job
+            enqueue_send(
+                payload,
+                lane=LANE_INTERACTIVE,
+                on_sent="frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.on_queued_message_sent",
+                on_failed="frappe_pywce.frappe_pywce.page.whatsapp_chat.whatsapp_chat.on_queued_message_failed",
+                message_name=message_name
+            )
+            return
         
-        # Publish realtime event
-        frappe.publish_realtime(
-            event='whatsapp_message_status_updated',
-            message={
-                'phone_number': phone_number,
-                'message_id': message_id,
-                'message_name': message_name,
-                'status': 'sent'
-            }
-        )
+        # Send message to WhatsApp API
+        result = get_graph_client().send_message(config.phone_id, config.get_password('access_token'), payload)
+        _mark_sent(message_name, phone_number, result)
         
     except requests.exceptions.RequestException as e:
-        error_msg = str(e)
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_detail = e.response.json()
-                error_msg = json.dumps(error_detail, indent=2)
-            except:
-                error_msg = e.response.text
-        
-        # Update message status to failed
-        frappe.db.set_value(
-            "WhatsApp Chat Message",
-            message_name,
-            {
-                "status": "failed",
-                "error_message": error_msg
-            }
-        )
-        frappe.db.commit()
-        
-        frappe.log_error(
-            title="WhatsApp Send Message Error",
-            message=f"Phone: {phone_number}\nError: {error_msg}"
-        )
-        
-        # Publish failure event
-        frappe.publish_realtime(
-            event='whatsapp_message_status_updated',
-            message={
-                'phone_number': phone_number,
-                'message_name': message_name,
-                'status': 'failed',
-                'error': error_msg
-            }
-        )
+        _mark_failed(message_name, phone_number, _request_error(e))
     
     except Exception as e:
-        # Update message status to failed
-        frappe.db.set_value(
-            "WhatsApp Chat Message",
-            message_name,
-            {
-                "status": "failed",
-                "error_message": str(e)
-            }
-        )
-        frappe.db.commit()
-        
-        frappe.log_error(
-            title="WhatsApp Send Message Error",
-            message=f"Phone: {phone_number}\nError: {str(e)}"
-        )
-        
-        # Publish failure event
-        frappe.publish_realtime(
-            event='whatsapp_message_status_updated',
-            message={
-                'phone_number': phone_number,
-                'message_name': message_name,
-                'status': 'failed',
-                'error': str(e)
-            }
-        )
+        _mark_failed(message_name, phone_number, str(e))
+
+
+def on_queued_message_sent(entry, result):
+    """`on_sent` callback of console messages the outbound worker sent"""
+    _mark_sent(entry["message_name"], entry["payload"]["to"], result)
+
+
+def on_queued_message_failed(entry, error):
+    """`on_failed` callback of console messages the outbound worker failed to send"""
+    error_msg = _request_error(error) if isinstance(error, requests.exceptions.RequestException) else str(error)
+    _mark_failed(entry["message_name"], entry["payload"]["to"], error_msg)
+
+
+def _request_error(e):
+    error_msg = str(e)
+    if hasattr(e, 'response') and e.response is not None:
+        try:
+            error_detail = e.response.json()
+            error_msg = json.dumps(error_detail, indent=2)
+        except:
+            error_msg = e.response.text
+    
+    return error_msg
+
+
+def _mark_sent(message_name, phone_number, result):
+    # Get message ID from response
+    message_id = None
+    if result.get("messages") and len(result["messages"]) > 0:
+        message_id = result["messages"][0].get("id")
+    
+    # Update message with ID and status
+    frappe.db.set_value(
+        "WhatsApp Chat Message",
+        message_name,
+        {
+            "message_id": message_id,
+            "status": "sent"
+        }
+    )
+    frappe.db.commit()
+    
+    # Publish realtime event
+    frappe.publish_realtime(
+        event='whatsapp_message_status_updated',
+        message={
+            'phone_number': phone_number,
+            'message_id': message_id,
+            'message_name': message_name,
+            'status': 'sent'
+        }
+    )
+
+
+def _mark_failed(message_name, phone_number, error_msg):
+    # Update message status to failed
+    frappe.db.set_value(
+        "WhatsApp Chat Message",
+        message_name,
+        {
+            "status": "failed",
+            "error_message": error_msg
+        }
+    )
+    frappe.db.commit()
+    
+    frappe.log_error(
+        title="WhatsApp Send Message Error",
+        message=f"Phone: {phone_number}\nError: {error_msg}"
+    )
+    
+    # Publish failure event
+    frappe.publish_realtime(
+        event='whatsapp_message_status_updated',
+        message={
+            'phone_number': phone_number,
+            'message_name': message_name,
+            'status': 'failed',
+            'error': error_msg
+        }
+    )
 
 
 @frappe.whitelist()
@@ -264,12 +295,18 @@ def mark_as_read(phone_number):
     """Mark all messages from a phone number as read"""
     normalized_phone = normalize_phone_number(phone_number)
     
+    # repeated calls for a read conversation stop at the summary row
+    if frappe.db.get_value("WhatsApp Conversation", normalized_phone, "unread_count") == 0:
+        return {"success": True}
+    
     frappe.db.sql("""
         UPDATE `tabWhatsApp Chat Message`
         SET status = 'read'
         WHERE phone_number = %s 
         AND direction = 'Incoming'
+        AND status != 'read'
     """, (normalized_phone,))
+    conversation_summary.mark_read(normalized_phone)
     frappe.db.commit()
     
     return {"success": True}
@@ -289,27 +326,14 @@ def get_unread_count():
 
 
 @frappe.whitelist()
-def search_messages(query, phone_number=None):
-    """Search messages by text content"""
-    filters = {
-        "message_text": ["like", f"%{query}%"]
-    }
-    
-    if phone_number:
-        filters["phone_number"] = normalize_phone_number(phone_number)
-    
-    messages = frappe.get_all(
-        "WhatsApp Chat Message",
-        filters=filters,
-        fields=[
-            "name", "phone_number", "message_text", 
-            "timestamp", "contact_name", "direction"
-        ],
-        order_by="timestamp desc",
-        limit=50
+def search_messages(query, phone_number=None, start=0, page_length=message_search.DEFAULT_PAGE_LENGTH):
+    """Search messages by text content, ranked by relevance with highlighted snippets, see frappe_pywce.message_search"""
+    return message_search.search(
+        query,
+        phone_number=normalize_phone_number(phone_number) if phone_number else None,
+        start=start,
+        page_length=page_length
     )
-    
-    return messages
 
 
 @frappe.whitelist()
@@ -321,7 +345,9 @@ def delete_conversation(phone_number):
         frappe.db.delete("WhatsApp Chat Message", {
             "phone_number": normalized_phone
         })
+        conversation_summary.delete(normalized_phone)
         frappe.db.commit()
+        clear_cursor(normalized_phone)
         
         return {"success": True}
     except Exception as e:
@@ -367,46 +393,17 @@ def get_or_create_folder(path, is_private=False):
 
 @frappe.whitelist()
 def get_media_url(media_id):
-    """Get media URL from WhatsApp API and download it"""
-    try:
-        config = frappe.get_single("ChatBot Config")
+    """Cached media URL of a media id, the media is downloaded on first use"""
+    frappe.has_permission("WhatsApp Chat Message", "read", throw=True)
+    media_id = media_cache.check_media_id(media_id)
 
-        # Get media URL details
-        url = f"https://graph.facebook.com/v18.0/{media_id}"
-        headers = {
-            "Authorization": f"Bearer {config.get_password('access_token')}"
-        }
-
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        result = response.json()
-
-        media_url = result.get("url")
-        mime_type = result.get("mime_type")
-
-        # Download media file
-        media_response = requests.get(media_url, headers=headers, timeout=30)
-        media_response.raise_for_status()
-
-        # Ensure the folder exists
-        folder_path = "Home/erpext"     # your custom folder
-        folder_name = get_or_create_folder(folder_path, is_private=False)
-
-        # Save file in Frappe
-        file_name = f"whatsapp_media_{media_id}"
-        file_doc = frappe.get_doc({
-            "doctype": "File",
-            "file_name": file_name,
-            "content": media_response.content,
-            "is_private": 0,
-            "folder": folder_name
-        })
-        file_doc.save(ignore_permissions=True)
+    try:
+        media = media_cache.resolve(media_id)
 
         return {
             "success": True,
-            "url": file_doc.file_url,
-            "mime_type": mime_type
+            "url": media_cache.media_url(media_id),
+            "mime_type": media.mime_type
         }
 
     except Exception as e:
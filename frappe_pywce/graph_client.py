@@ -0,0 +1,157 @@
+"""
+Shared HTTP client for the WhatsApp Cloud (Graph) API
+
+One keep-alive connection pool per worker process instead of a new TCP + TLS
+handshake per outbound message. Requests get a default timeout and are
+retried with jittered exponential backoff on 429 / 5xx, honouring
+Retry-After.
+
+The base URL defaults to the Graph API and can be pointed at the local
+emulator bridge (or a mock server in tests) with the `whatsapp_graph_base_url`
+site config key. The access token is only sent to the base URL host and to
+Meta's media CDN (media download URLs), never to any other absolute URL.
+"""
+
+import random
+import threading
+from typing import Optional
+from urllib.parse import urlparse
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from frappe_pywce import tracing
+
+DEFAULT_GRAPH_BASE_URL = "https://graph.facebook.com/v18.0"
+GRAPH_BASE_URL_CONF_KEY = "whatsapp_graph_base_url"
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# retried on 429 and connect errors only, see JitteredRetry
+NON_IDEMPOTENT_METHODS = frozenset({"POST"})
+
+# media download URLs returned by Graph, e.g. lookaside.fbsbx.com
+MEDIA_HOST_SUFFIXES = (".fbsbx.com",)
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 32
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class JitteredRetry(Retry):
+    """
+    Retry with full jitter: a random backoff between 0 and the exponential value.
+
+    POSTs (message sends, uploads) are not idempotent: a 5xx or a read
+    timeout may come after Graph accepted the message, repeating it would
+    deliver it twice. They are only retried on 429 and on connect errors,
+    where nothing was sent.
+    """
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method and method.upper() in NON_IDEMPOTENT_METHODS:
+            return bool(self.total) and status_code == 429
+
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class GraphClient:
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        timeout=DEFAULT_TIMEOUT,
+        retries: int = RETRY_TOTAL,
+        pool_maxsize: int = POOL_MAXSIZE
+    ):
+        self._base_url = base_url
+        self.timeout = timeout
+
+        retry = JitteredRetry(
+            total=retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            # read errors are only retried for these, POSTs are left out (JitteredRetry.is_retry
+            # still lets a 429 through)
+            allowed_methods=frozenset({"GET", "DELETE"}),
+            # errors other than connect / read ones may also come after the request was sent
+            other=0,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @property
+    def base_url(self) -> str:
+        if self._base_url:
+            return self._base_url.rstrip("/")
+
+        conf = getattr(frappe.local, "conf", None) or {}
+        return (conf.get(GRAPH_BASE_URL_CONF_KEY) or DEFAULT_GRAPH_BASE_URL).rstrip("/")
+
+    def url(self, path: str) -> str:
+        if path.startswith(("http://", "https://")):
+            return path
+
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def is_trusted(self, url: str) -> bool:
+        """True when the access token may be sent to `url`"""
+        host = urlparse(url).hostname or ""
+        return host == urlparse(self.base_url).hostname or host.endswith(MEDIA_HOST_SUFFIXES)
+
+    def request(self, method: str, path: str, access_token: Optional[str] = None, **kwargs) -> requests.Response:
+        """Send a request, `path` is relative to the base URL or an absolute URL (e.g. media downloads)"""
+        headers = kwargs.pop("headers", None) or {}
+        url = self.url(path)
+
+        if access_token:
+            if not self.is_trusted(url):
+                raise ValueError(f"Refusing to send the access token to {urlparse(url).hostname}")
+
+            headers.setdefault("Authorization", f"Bearer {access_token}")
+
+        kwargs.setdefault("timeout", self.timeout)
+
+        with tracing.span("graph_http"):
+            return self.session.request(method, url, headers=headers, **kwargs)
+
+    def get(self, path: str, access_token: Optional[str] = None, **kwargs) -> requests.Response:
+        return self.request("GET", path, access_token, **kwargs)
+
+    def post(self, path: str, access_token: Optional[str] = None, **kwargs) -> requests.Response:
+        return self.request("POST", path, access_token, **kwargs)
+
+    def send_message(self, phone_id: str, access_token: str, payload: dict) -> dict:
+        """POST a message payload to /<phone_id>/messages, raises requests.HTTPError on failure"""
+        response = self.post(f"{phone_id}/messages", access_token, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+
+def get_graph_client() -> GraphClient:
+    """Process wide client, its connection pool is shared by every sender"""
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GraphClient()
+
+    return _client
@@ -147,9 +147,38 @@ app_license = "MIT"
 # 	}
 # }
 
+doc_events = {
+	"ChatBot Config": {
+		"on_update": [
+			"frappe_pywce.config.invalidate_engine_cache",
+			"frappe_pywce.flow_cache.enqueue_precompile"
+		]
+	},
+	"Bot Flow": {
+		"on_update": "frappe_pywce.config.invalidate_engine_cache",
+		"on_trash": "frappe_pywce.config.invalidate_engine_cache"
+	},
+	"WhatsApp Chat Message": {
+		"after_insert": "frappe_pywce.conversation_summary.on_chat_message_insert"
+	}
+}
+
+# Campaign Components
+# -------------------
+# methods send_template_campaign may call with each recipient row for its template components
+
+# pywce_campaign_components = ["my_app.campaigns.get_components"]
+
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"all": [
+		"frappe_pywce.sequencer.kick_stalled_partitions",
+		"frappe_pywce.outbound.flush_overdue"
+	],
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"frappe_pywce.tasks.all"
@@ -204,7 +233,7 @@ app_license = "MIT"
 # Job Events
 # ----------
 # before_job = ["frappe_pywce.utils.before_job"]
-# after_job = ["frappe_pywce.utils.after_job"]
+after_job = ["frappe_pywce.pywce_logger.flush"]
 
 # User Data Protection
 # --------------------
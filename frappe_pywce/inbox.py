@@ -0,0 +1,369 @@
+"""
+Durable webhook inbox on Redis Streams
+
+In the `Redis Stream` ingress mode the webhook endpoint only verifies the
+signature and XADDs the raw request body to a stream, one stream per
+partition of wa_id, then returns 200.
+
+Streams live on the queue Redis (the one RQ uses) so the inbox survives a
+cache flush. A consumer group worker (`bench pywce-inbox-worker`) drains the
+partitions:
+
+1. each partition is owned by exactly one consumer at a time, through a
+   lease key holding the consumer name. A worker only reads the partitions
+   it holds, so one wa_id is never processed by two workers at once
+2. new entries are read with XREADGROUP and acked + deleted once processed
+3. a failed entry blocks its partition: it is retried before anything after
+   it is handled or read, so one user's messages stay in order
+4. entries that failed `max_deliveries` times move to a dead-letter stream
+   for inspection and unblock the partition
+5. entries left pending by a consumer that died are reclaimed with
+   XAUTOCLAIM after `claim_idle_ms` by the partition's next owner
+
+Delivery is at-least-once, the persistence layer already deduplicates on
+message_id.
+"""
+
+import json
+import os
+import socket
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+import frappe
+import redis.exceptions
+from frappe.utils.background_jobs import get_redis_conn
+
+from frappe_pywce.sequencer import HashRing
+from frappe_pywce.util import CACHE_KEY_PREFIX
+from frappe_pywce.pywce_logger import app_logger as logger
+
+INGRESS_MODE_JOB_QUEUE = "Job Queue"
+INGRESS_MODE_STREAM = "Redis Stream"
+
+INBOX_GROUP = "fpw-inbox"
+INBOX_PARTITIONS = 16
+DEAD_LETTER_MAXLEN = 10_000
+
+CLAIM_IDLE_MS = 60_000
+MAX_DELIVERIES = 5
+READ_COUNT = 32
+BLOCK_MS = 5_000
+
+# refreshed before every entry, a consumer that stops refreshing hands its partitions over
+OWNER_LEASE_MS = 30_000
+
+# KEYS: lease. ARGV: consumer, lease ms. 1 when the consumer holds the lease
+_OWN_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', tonumber(ARGV[2]))
+    return 1
+end
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[2]))
+    return 1
+end
+return 0
+"""
+
+_DISOWN_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_inbox_conn():
+    return get_redis_conn()
+
+
+def stream_key(partition: int, site: str = None) -> str:
+    return f"{CACHE_KEY_PREFIX}inbox:{site or frappe.local.site}:{partition}"
+
+
+def owner_key(key: str) -> str:
+    return f"{_decode(key)}:owner"
+
+
+def dead_letter_key(site: str = None) -> str:
+    return f"{CACHE_KEY_PREFIX}inbox:{site or frappe.local.site}:dead"
+
+
+_RING = HashRing(INBOX_PARTITIONS)
+
+
+def partition_for(wa_id: str) -> int:
+    return _RING.get(wa_id)
+
+
+def extract_wa_id(payload: dict) -> Optional[str]:
+    """Cheap wa_id lookup used for partitioning, no engine involved"""
+    for entry in payload.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+
+            for message in value.get("messages") or []:
+                if message.get("from"):
+                    return message["from"]
+
+            for status in value.get("statuses") or []:
+                if status.get("recipient_id"):
+                    return status["recipient_id"]
+
+            for contact in value.get("contacts") or []:
+                if contact.get("wa_id"):
+                    return contact["wa_id"]
+
+    return None
+
+
+def push(wa_id: str, body: bytes, conn=None) -> str:
+    """Append a raw webhook body to the partition of wa_id, returns the stream entry id"""
+    conn = conn or get_inbox_conn()
+    return conn.xadd(stream_key(partition_for(wa_id)), {"wa_id": wa_id, "body": body})
+
+
+def ensure_group(conn, key: str) -> None:
+    try:
+        conn.xgroup_create(key, INBOX_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _field(fields: Dict, name: str, raw: bool = False):
+    value = fields.get(name.encode(), fields.get(name))
+    return value if raw else _decode(value)
+
+
+class InboxConsumer:
+    """
+    Consumer group worker over a set of inbox partitions.
+
+    `handler(wa_id, payload)` must raise on failure so the entry is retried.
+    Of `partitions` (default all) the consumer drains those whose lease it
+    holds, the others are left to the consumers holding them.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, dict], None],
+        partitions: Optional[Iterable[int]] = None,
+        consumer: str = None,
+        conn=None,
+        claim_idle_ms: int = CLAIM_IDLE_MS,
+        max_deliveries: int = MAX_DELIVERIES
+    ):
+        self.handler = handler
+        self.conn = conn or get_inbox_conn()
+        self.partitions = list(partitions) if partitions is not None else list(range(INBOX_PARTITIONS))
+        self.keys = [stream_key(p) for p in self.partitions]
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}"
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self._errors: Dict[str, str] = {}
+        self._failures: Dict[str, int] = {}
+
+        # entries read but not handled yet, per stream, behind a failed head
+        self._backlog: Dict[str, Deque[Tuple]] = {}
+
+        self._own = self.conn.register_script(_OWN_SCRIPT)
+        self._disown = self.conn.register_script(_DISOWN_SCRIPT)
+
+        for key in self.keys:
+            ensure_group(self.conn, key)
+
+    def _owns(self, key) -> bool:
+        if self._own(keys=[owner_key(key)], args=[self.consumer, OWNER_LEASE_MS]):
+            return True
+
+        # another consumer took over, what we read is pending in our name and it reclaims it
+        self._backlog.pop(key, None)
+        return False
+
+    def release(self) -> None:
+        """Hand the partitions over to other consumers right away"""
+        for key in self.keys:
+            self._disown(keys=[owner_key(key)], args=[self.consumer])
+
+    def run(self, burst: bool = False) -> None:
+        """Drain forever, or until the partitions are empty when burst is set"""
+        logger.info("Inbox consumer %s started on partitions %s", self.consumer, self.partitions)
+
+        try:
+            while True:
+                processed = self.drain_once(block_ms=None if burst else BLOCK_MS)
+
+                if burst and not processed and not self._backlog:
+                    return
+
+        finally:
+            self.release()
+
+    def drain_once(self, block_ms: Optional[int] = None) -> int:
+        """
+        Retry blocked and stale pending entries, then read new ones from
+        unblocked partitions. Returns the number of entries handled
+        """
+        processed = 0
+        owned = [key for key in self.keys if self._owns(key)]
+
+        for key in owned:
+            if key in self._backlog:
+                processed += self._drain_backlog(key)
+            else:
+                processed += self._retry_stale(key)
+
+        readable = [key for key in owned if key not in self._backlog]
+
+        if not readable:
+            # every partition is blocked or held elsewhere, wait before retrying
+            if block_ms:
+                time.sleep(block_ms / 1000)
+
+            return processed
+
+        response = self.conn.xreadgroup(
+            INBOX_GROUP,
+            self.consumer,
+            {key: ">" for key in readable},
+            count=READ_COUNT,
+            block=block_ms
+        )
+
+        for key, entries in response or []:
+            self._backlog[_decode(key)] = deque(entries)
+            processed += self._drain_backlog(_decode(key))
+
+        return processed
+
+    def _drain_backlog(self, key) -> int:
+        """Handle the read entries of key in order, stops at the first failure, which stays the head"""
+        backlog = self._backlog[key]
+        processed = 0
+
+        while backlog:
+            if not self._owns(key):
+                break
+
+            message_id, fields = backlog[0]
+
+            if not self._handle(key, message_id, fields):
+                break
+
+            backlog.popleft()
+            processed += 1
+
+        if not backlog:
+            self._backlog.pop(key, None)
+
+        return processed
+
+    def _retry_stale(self, key) -> int:
+        claimed = self.conn.xautoclaim(
+            key,
+            INBOX_GROUP,
+            self.consumer,
+            min_idle_time=self.claim_idle_ms,
+            start_id="0-0",
+            count=READ_COUNT
+        )
+
+        processed = 0
+
+        for message_id, fields in claimed[1]:
+            if not fields:
+                # trimmed or deleted while pending
+                self.conn.xack(key, INBOX_GROUP, message_id)
+                continue
+
+            pending = self.conn.xpending_range(key, INBOX_GROUP, min=message_id, max=message_id, count=1)
+            deliveries = pending[0]["times_delivered"] if pending else 1
+
+            if deliveries > self.max_deliveries:
+                self._dead_letter(key, message_id, fields, deliveries)
+                processed += 1
+                continue
+
+            # reclaimed entries go first and block the partition like fresh ones
+            self._backlog.setdefault(_decode(key), deque()).append((message_id, fields))
+
+        if _decode(key) in self._backlog:
+            processed += self._drain_backlog(_decode(key))
+
+        return processed
+
+    def _handle(self, key, message_id, fields) -> bool:
+        """True once the entry is done with: handled and acked, or dead-lettered"""
+        entry_id = _decode(message_id)
+
+        try:
+            payload = json.loads(_field(fields, "body", raw=True))
+            self.handler(_field(fields, "wa_id"), payload)
+
+        except Exception as e:
+            self._errors[entry_id] = str(e)
+            self._failures[entry_id] = failures = self._failures.get(entry_id, 0) + 1
+
+            if failures >= self.max_deliveries:
+                self._dead_letter(key, message_id, fields, failures)
+                return True
+
+            logger.warning("Inbox entry %s failed, retrying before later entries: %s", message_id, e)
+            return False
+
+        self._ack(key, message_id)
+        return True
+
+    def _ack(self, key, message_id) -> None:
+        self._errors.pop(_decode(message_id), None)
+        self._failures.pop(_decode(message_id), None)
+
+        pipe = self.conn.pipeline()
+        pipe.xack(key, INBOX_GROUP, message_id)
+        pipe.xdel(key, message_id)
+        pipe.execute()
+
+    def _dead_letter(self, key, message_id, fields, deliveries: int) -> None:
+        entry_id = _decode(message_id)
+
+        self.conn.xadd(
+            dead_letter_key(),
+            {
+                "stream": key,
+                "id": entry_id,
+                "wa_id": _field(fields, "wa_id") or "",
+                "body": _field(fields, "body", raw=True) or b"",
+                "deliveries": deliveries,
+                "error": self._errors.pop(entry_id, "")
+            },
+            maxlen=DEAD_LETTER_MAXLEN,
+            approximate=True
+        )
+        self._ack(key, message_id)
+
+        logger.error("Inbox entry %s moved to dead letter after %s deliveries", entry_id, deliveries)
+
+
+def process_inbox_entry(wa_id: str, payload: dict) -> None:
+    """Default handler, runs the webhook pipeline and rolls back on failure"""
+    from frappe_pywce.webhook import process_webhook_payload
+
+    try:
+        process_webhook_payload(wa_id, payload)
+        frappe.db.commit()
+
+    except Exception:
+        frappe.db.rollback()
+        raise
+
+
+def run_worker(partitions: Optional[List[int]] = None, consumer: str = None, burst: bool = False) -> None:
+    InboxConsumer(process_inbox_entry, partitions=partitions, consumer=consumer).run(burst=burst)
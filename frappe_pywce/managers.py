@@ -6,7 +6,9 @@ import frappe
 
 from pywce import ISessionManager, VisualTranslator, storage, template
 
+from frappe_pywce import flow_cache
 from frappe_pywce.pywce_logger import app_logger as logger
+from frappe_pywce.session_store import GlobalStore, SessionStore, current_unit_of_work, session_scope
 
 T = TypeVar("T")
 
@@ -28,6 +30,8 @@ class FrappeStorageManager(storage.IStorageManager):
     """
     _TEMPLATES: Dict = {}
     _TRIGGERS: List[template.EngineRoute] = {}
+    # template name -> validated EngineTemplate, filled on first get
+    _MODELS: Dict = {}
 
     START_MENU: Optional[str] = None
     REPORT_MENU: Optional[str] = None
@@ -49,7 +53,7 @@ class FrappeStorageManager(storage.IStorageManager):
                 logger.error("No chatbots found in flow_json")
                 raise Exception("No chatbots found in flow_json")
             
-            logger.info(f"Found {len(chatbots)} chatbot(s) in flow_json")
+            logger.info("Found %s chatbot(s) in flow_json", len(chatbots))
             
             # Merge templates from ALL chatbots
             for bot in chatbots:
@@ -57,14 +61,14 @@ class FrappeStorageManager(storage.IStorageManager):
                 templates = bot.get('templates', [])
                 
                 if not templates:
-                    logger.warning(f"Chatbot '{bot_name}' has no templates, skipping")
+                    logger.warning("Chatbot '%s' has no templates, skipping", bot_name)
                     continue
                 
-                logger.info(f"Extracting {len(templates)} templates from chatbot '{bot_name}'")
+                logger.info("Extracting %s templates from chatbot '%s'", len(templates), bot_name)
                 
                 # Log template IDs for debugging
                 template_ids = [t.get('id', 'NO_ID') for t in templates]
-                logger.debug(f"Template IDs from '{bot_name}': {template_ids}")
+                logger.debug("Template IDs from '%s': %s", bot_name, template_ids)
                 
                 all_templates.extend(templates)
             
@@ -75,13 +79,13 @@ class FrappeStorageManager(storage.IStorageManager):
                     'version': flow_data.get('version', '1.0')
                 }
             
-            logger.info(f"Total templates extracted from all chatbots: {len(all_templates)}")
+            logger.info("Total templates extracted from all chatbots: %s", len(all_templates))
             
             # Check for duplicate template IDs
             template_ids = [t.get('id') for t in all_templates]
             duplicates = [tid for tid in template_ids if template_ids.count(tid) > 1]
             if duplicates:
-                logger.warning(f"Duplicate template IDs found: {set(duplicates)}")
+                logger.warning("Duplicate template IDs found: %s", set(duplicates))
             
             # Return the flow in the old format that VisualTranslator expects
             return {
@@ -91,11 +95,11 @@ class FrappeStorageManager(storage.IStorageManager):
         
         # Old format (already has 'templates' at root level)
         elif isinstance(flow_data, dict) and 'templates' in flow_data:
-            logger.info(f"Using old format, found {len(flow_data.get('templates', []))} templates")
+            logger.info("Using old format, found %s templates", len(flow_data.get('templates', [])))
             return flow_data
         
         else:
-            logger.error(f"Invalid flow_json format. Keys found: {flow_data.keys() if isinstance(flow_data, dict) else 'not a dict'}")
+            logger.error("Invalid flow_json format. Keys found: %s", flow_data.keys() if isinstance(flow_data, dict) else 'not a dict')
             raise Exception("Invalid flow_json format: missing 'chatbots' or 'templates' key")
     
     def _normalize_message_field(self, message):
@@ -112,7 +116,7 @@ class FrappeStorageManager(storage.IStorageManager):
             # If it's a dict, keep it as-is for now (pydantic will handle it)
             return message
         else:
-            logger.warning(f"Invalid message type: {type(message)}, converting to empty string")
+            logger.warning("Invalid message type: %s, converting to empty string", type(message))
             return ""
     
     def _validate_and_fix_template(self, template_name: str, template_data: dict) -> dict:
@@ -122,7 +126,7 @@ class FrappeStorageManager(storage.IStorageManager):
         
         # Ensure we have a message field
         if 'message' not in template_data:
-            logger.warning(f"Template '{template_name}' missing message field, creating empty string")
+            logger.warning("Template '%s' missing message field, creating empty string", template_name)
             template_data['message'] = ""
         
         # Normalize message field
@@ -133,10 +137,10 @@ class FrappeStorageManager(storage.IStorageManager):
             if isinstance(message, dict):
                 # Extract meaningful text from dict
                 text = message.get('body') or message.get('title') or "Please share your location"
-                logger.warning(f"Template '{template_name}' (request-location) has dict message, converting to string: {text}")
+                logger.warning("Template '%s' (request-location) has dict message, converting to string: %s", template_name, text)
                 template_data['message'] = text
             elif not message:
-                logger.warning(f"Template '{template_name}' (request-location) has empty message, setting default")
+                logger.warning("Template '%s' (request-location) has empty message, setting default", template_name)
                 template_data['message'] = "Please share your location"
         
         # For text templates, message should be a string
@@ -154,7 +158,7 @@ class FrappeStorageManager(storage.IStorageManager):
                     message = "Message content not available"
                 template_data['message'] = message
             else:
-                logger.warning(f"Template '{template_name}' (text) has invalid message type, setting default")
+                logger.warning("Template '%s' (text) has invalid message type, setting default", template_name)
                 template_data['message'] = "Message content not available"
         
         # For button templates
@@ -167,13 +171,13 @@ class FrappeStorageManager(storage.IStorageManager):
                     body = message.get('body', '')
                     
                     if not body and not title:
-                        logger.info(f"Template '{template_name}' appears to be empty placeholder, converting to text")
+                        logger.info("Template '%s' appears to be empty placeholder, converting to text", template_name)
                         template_data['kind'] = 'text'
                         if 'type' in template_data:
                             template_data['type'] = 'text'
                         template_data['message'] = "No content available"
                     else:
-                        logger.info(f"Converting '{template_name}' from 'button' to 'text' template (no buttons)")
+                        logger.info("Converting '%s' from 'button' to 'text' template (no buttons)", template_name)
                         template_data['kind'] = 'text'
                         if 'type' in template_data:
                             template_data['type'] = 'text'
@@ -194,7 +198,7 @@ class FrappeStorageManager(storage.IStorageManager):
             if isinstance(message, dict):
                 sections = message.get('sections', [])
                 if not isinstance(sections, list):
-                    logger.error(f"Template '{template_name}' has invalid sections (not a list)")
+                    logger.error("Template '%s' has invalid sections (not a list)", template_name)
                     message['sections'] = []
                     template_data['message'] = message
                 else:
@@ -205,7 +209,7 @@ class FrappeStorageManager(storage.IStorageManager):
                             # Ensure rows exist and is a list
                             rows = section.get('rows', [])
                             if not isinstance(rows, list):
-                                logger.warning(f"Template '{template_name}' section {i} has invalid rows (not a list)")
+                                logger.warning("Template '%s' section %s has invalid rows (not a list)", template_name, i)
                                 section['rows'] = []
                             else:
                                 # Normalize row structure (WhatsApp uses 'id', pywce might use 'identifier')
@@ -220,7 +224,7 @@ class FrappeStorageManager(storage.IStorageManager):
                                         }
                                         fixed_rows.append(fixed_row)
                                     else:
-                                        logger.warning(f"Template '{template_name}' section {i} row {j} is not a dict, skipping")
+                                        logger.warning("Template '%s' section %s row %s is not a dict, skipping", template_name, i, j)
                                 
                                 section['rows'] = fixed_rows
                             
@@ -230,12 +234,12 @@ class FrappeStorageManager(storage.IStorageManager):
                             
                             fixed_sections.append(section)
                         else:
-                            logger.warning(f"Template '{template_name}' section {i} is not a dict, skipping")
+                            logger.warning("Template '%s' section %s is not a dict, skipping", template_name, i)
                     
                     message['sections'] = fixed_sections
                     template_data['message'] = message
                     
-                    logger.info(f"Template '{template_name}' (list) fixed with {len(fixed_sections)} sections")
+                    logger.info("Template '%s' (list) fixed with %s sections", template_name, len(fixed_sections))
         
         # Normalize routes structure
         if 'routes' in template_data:
@@ -272,52 +276,66 @@ class FrappeStorageManager(storage.IStorageManager):
                 if isinstance(delay, str):
                     delay = int(delay)
                 settings['delay_time'] = max(0, int(delay))  # Ensure non-negative
-                logger.info(f"Template '{template_name}' has delay_time: {settings['delay_time']}s")
+                logger.debug("Template '%s' has delay_time: %ss", template_name, settings['delay_time'])
             except (ValueError, TypeError):
-                logger.warning(f"Template '{template_name}' has invalid delay_time, removing")
+                logger.warning("Template '%s' has invalid delay_time, removing", template_name)
                 settings.pop('delay_time', None)
         
         # Validate typing (should be boolean)
         if 'typing' in settings:
             settings['typing'] = bool(settings['typing'])
-            logger.info(f"Template '{template_name}' typing indicator: {settings['typing']}")
+            logger.debug("Template '%s' typing indicator: %s", template_name, settings['typing'])
         
         # Validate ack (should be boolean)
         if 'ack' in settings:
             settings['ack'] = bool(settings['ack'])
-            logger.info(f"Template '{template_name}' read receipt: {settings['ack']}")
+            logger.debug("Template '%s' read receipt: %s", template_name, settings['ack'])
         
         # Validate other settings without modification
         if 'message_level' in settings:
-            logger.info(f"Template '{template_name}' message_level: {settings['message_level']}")
+            logger.debug("Template '%s' message_level: %s", template_name, settings['message_level'])
         
         if 'next_level' in settings:
-            logger.info(f"Template '{template_name}' next_level: {settings['next_level']}")
+            logger.debug("Template '%s' next_level: %s", template_name, settings['next_level'])
         
         if 'isStart' in settings:
-            logger.info(f"Template '{template_name}' isStart: {settings['isStart']}")
+            logger.debug("Template '%s' isStart: %s", template_name, settings['isStart'])
         
         if 'isReport' in settings:
-            logger.info(f"Template '{template_name}' isReport: {settings['isReport']}")
+            logger.debug("Template '%s' isReport: %s", template_name, settings['isReport'])
         
         if 'trigger' in settings:
-            logger.info(f"Template '{template_name}' trigger: {settings['trigger']}")
+            logger.debug("Template '%s' trigger: %s", template_name, settings['trigger'])
         
         return template_data
     
-    def _check_for_broken_routes(self, validation_errors: List[dict]) -> None:
-        """Check if any valid templates have routes pointing to invalid templates."""
+    def _check_for_broken_routes(self, validation_errors: List[dict], changed: Optional[set] = None) -> None:
+        """Check if any valid templates have routes pointing to invalid templates.
+
+        With `changed`, only routes from or to those templates are reported,
+        the others were reported when they were compiled.
+        """
         invalid_template_names = {error['name'] for error in validation_errors}
+        # a route is newly broken when its source or its target changed
+        changed_invalid_names = invalid_template_names if changed is None else invalid_template_names & changed
         broken_routes = []
         
         for template_name, template_data in self._TEMPLATES.items():
+            if changed is None or template_name in changed:
+                targets = invalid_template_names
+            else:
+                targets = changed_invalid_names
+
+            if not targets:
+                continue
+
             routes = template_data.get('routes', [])
             
             # Handle different route formats
             if isinstance(routes, dict):
                 # Routes is a dict mapping patterns to template names
                 for pattern, next_template in routes.items():
-                    if isinstance(next_template, str) and next_template in invalid_template_names:
+                    if isinstance(next_template, str) and next_template in targets:
                         broken_routes.append({
                             'from_template': template_name,
                             'to_template': next_template,
@@ -329,7 +347,7 @@ class FrappeStorageManager(storage.IStorageManager):
                     if isinstance(route, dict):
                         # Try both possible keys for next template
                         next_template = route.get('next_stage') or route.get('connectedTo')
-                        if next_template and next_template in invalid_template_names:
+                        if next_template and next_template in targets:
                             broken_routes.append({
                                 'from_template': template_name,
                                 'to_template': next_template,
@@ -337,7 +355,7 @@ class FrappeStorageManager(storage.IStorageManager):
                             })
                     elif isinstance(route, str):
                         # Route is just a string (template name)
-                        if route in invalid_template_names:
+                        if route in targets:
                             broken_routes.append({
                                 'from_template': template_name,
                                 'to_template': route,
@@ -345,22 +363,103 @@ class FrappeStorageManager(storage.IStorageManager):
                             })
         
         if broken_routes:
-            logger.error(f"Found {len(broken_routes)} broken routes pointing to invalid templates:")
+            logger.error("Found %s broken routes pointing to invalid templates:", len(broken_routes))
             for broken in broken_routes:
-                logger.error(f"  - '{broken['from_template']}' -> '{broken['to_template']}' (route will fail at runtime)")
+                logger.error("  - '%s' -> '%s' (route will fail at runtime)", broken['from_template'], broken['to_template'])
             
             logger.error("Fix these by either:")
             logger.error("  1. Fixing the invalid templates in your flow builder")
             logger.error("  2. Updating routes to point to valid templates")
             logger.error("  3. Removing the broken routes")
     
+    def _compile_template(self, template_name: str, template_data: dict) -> dict:
+        """Fix and validate one translated template, returns {"template": ..., "error": None or message}"""
+        try:
+            # Validate and fix common issues
+            fixed_template = self._validate_and_fix_template(template_name, template_data)
+            
+            # Try to validate with pydantic
+            template.Template.as_model(fixed_template)
+            
+            return {"template": fixed_template, "error": None}
+            
+        except Exception as e:
+            error_msg = str(e)
+            logger.error("Validation failed for template '%s': %s", template_name, error_msg)
+            logger.debug("Template data: %s", template_data)
+            
+            # Try one more fix attempt for specific errors
+            retry = False
+            
+            # Handle "list object has no attribute 'items'" error for list templates
+            if "'list' object has no attribute 'items'" in error_msg:
+                template_type = template_data.get('kind') or template_data.get('type')
+                if template_type == 'list':
+                    logger.warning("Attempting to fix list template '%s' structure", template_name)
+                    # Try converting to a simpler structure or skip problematic fields
+                    message = template_data.get('message', {})
+                    if isinstance(message, dict) and 'sections' in message:
+                        # Simplify sections structure
+                        sections = message.get('sections', [])
+                        simplified_sections = []
+                        for section in sections:
+                            if isinstance(section, dict):
+                                simplified_section = {
+                                    'title': str(section.get('title', 'Section')),
+                                    'rows': []
+                                }
+                                rows = section.get('rows', [])
+                                for row in rows:
+                                    if isinstance(row, dict):
+                                        simplified_section['rows'].append({
+                                            'title': str(row.get('title', '')),
+                                            'identifier': str(row.get('identifier') or row.get('id', '')),
+                                            'description': str(row.get('description') or row.get('desc', ''))
+                                        })
+                                simplified_sections.append(simplified_section)
+                        
+                        message['sections'] = simplified_sections
+                        template_data['message'] = message
+                        retry = True
+            
+            if retry:
+                try:
+                    template.Template.as_model(template_data)
+                    logger.info("Successfully fixed template '%s' on retry", template_name)
+                    return {"template": template_data, "error": None}
+                except Exception as retry_error:
+                    logger.error("Retry failed for template '%s': %s", template_name, retry_error)
+            
+            # Don't store invalid templates
+            return {"template": template_data, "error": error_msg}
+
+    def _apply_artifact(self, artifact: dict) -> None:
+        self._MODELS = {}
+        self._TEMPLATES = artifact["templates"]
+        self._TRIGGERS = artifact["triggers"]
+        self.START_MENU = artifact["start_menu"]
+        self.REPORT_MENU = artifact["report_menu"]
+
     def _load_templates_from_db(self):
-        """Load templates from database and translate them."""
+        """Load templates from database and translate them.
+
+        The compiled flow is cached by digest and each compiled template by its
+        content hash, see frappe_pywce.flow_cache.
+        """
         try:
             if not self.flow_json:
                 raise Exception("No flow json found or is empty.")
+
+            digest = flow_cache.flow_digest(self.flow_json)
+            artifact = flow_cache.get_artifact(digest)
+
+            if artifact is not None:
+                self._apply_artifact(artifact)
+                logger.info("Loaded compiled flow %s: %s templates, START_MENU: %s, REPORT_MENU: %s",
+                            digest[:12], len(self._TEMPLATES), self.START_MENU, self.REPORT_MENU)
+                return
             
-            logger.info(f"Loading templates from flow_json (fetching all chatbots)")
+            logger.info("Loading templates from flow_json (fetching all chatbots)")
             
             # Parse the flow_json if it's a string
             if isinstance(self.flow_json, str):
@@ -371,9 +470,7 @@ class FrappeStorageManager(storage.IStorageManager):
             # Extract ALL templates from all chatbots
             extracted_flow = self._extract_all_templates_from_flow(flow_data)
             
-            logger.info(f"Extracted flow structure: templates={len(extracted_flow.get('templates', []))}, version={extracted_flow.get('version')}")
-            logger.info("Extracted flow JSON:\n%s",frappe.as_json(extracted_flow, indent=2)            
-        )
+            logger.info("Extracted flow structure: templates=%s, version=%s", len(extracted_flow.get('templates', [])), extracted_flow.get('version'))
             
             if not extracted_flow.get('templates'):
                 logger.warning("No templates to translate!")
@@ -391,20 +488,20 @@ class FrappeStorageManager(storage.IStorageManager):
             self.START_MENU = ui_translator.START_MENU
             self.REPORT_MENU = ui_translator.REPORT_MENU
             
-            logger.info(f"Translation complete: {len(raw_templates)} templates, {len(self._TRIGGERS)} triggers")
-            logger.info(f"Initial START_MENU from translator: {self.START_MENU}, REPORT_MENU: {self.REPORT_MENU}")
+            logger.info("Translation complete: %s templates, %s triggers", len(raw_templates), len(self._TRIGGERS))
+            logger.info("Initial START_MENU from translator: %s, REPORT_MENU: %s", self.START_MENU, self.REPORT_MENU)
             
             # WORKAROUND: If START_MENU is incorrectly set, find the template with isStart=true in settings
             if self.START_MENU:
                 start_template_data = raw_templates.get(self.START_MENU, {})
                 settings = start_template_data.get('settings', {})
                 if not settings.get('isStart', False):
-                    logger.warning(f"START_MENU '{self.START_MENU}' does not have isStart=true, searching for correct start template")
+                    logger.warning("START_MENU '%s' does not have isStart=true, searching for correct start template", self.START_MENU)
                     # Find the correct start template
                     for template_name, template_data in raw_templates.items():
                         tmpl_settings = template_data.get('settings', {})
                         if tmpl_settings.get('isStart', False):
-                            logger.info(f"Found correct START_MENU: '{template_name}' (was '{self.START_MENU}')")
+                            logger.info("Found correct START_MENU: '%s' (was '%s')", template_name, self.START_MENU)
                             self.START_MENU = template_name
                             break
             else:
@@ -413,7 +510,7 @@ class FrappeStorageManager(storage.IStorageManager):
                 for template_name, template_data in raw_templates.items():
                     settings = template_data.get('settings', {})
                     if settings.get('isStart', False):
-                        logger.info(f"Found START_MENU from settings: '{template_name}'")
+                        logger.info("Found START_MENU from settings: '%s'", template_name)
                         self.START_MENU = template_name
                         break
             
@@ -422,11 +519,11 @@ class FrappeStorageManager(storage.IStorageManager):
                 report_template_data = raw_templates.get(self.REPORT_MENU, {})
                 settings = report_template_data.get('settings', {})
                 if not settings.get('isReport', False):
-                    logger.warning(f"REPORT_MENU '{self.REPORT_MENU}' does not have isReport=true, searching for correct report template")
+                    logger.warning("REPORT_MENU '%s' does not have isReport=true, searching for correct report template", self.REPORT_MENU)
                     for template_name, template_data in raw_templates.items():
                         tmpl_settings = template_data.get('settings', {})
                         if tmpl_settings.get('isReport', False):
-                            logger.info(f"Found correct REPORT_MENU: '{template_name}' (was '{self.REPORT_MENU}')")
+                            logger.info("Found correct REPORT_MENU: '%s' (was '%s')", template_name, self.REPORT_MENU)
                             self.REPORT_MENU = template_name
                             break
             else:
@@ -434,105 +531,74 @@ class FrappeStorageManager(storage.IStorageManager):
                 for template_name, template_data in raw_templates.items():
                     settings = template_data.get('settings', {})
                     if settings.get('isReport', False):
-                        logger.info(f"Found REPORT_MENU from settings: '{template_name}'")
+                        logger.info("Found REPORT_MENU from settings: '%s'", template_name)
                         self.REPORT_MENU = template_name
                         break
             
-            logger.info(f"Final START_MENU: {self.START_MENU}, REPORT_MENU: {self.REPORT_MENU}")
+            logger.info("Final START_MENU: %s, REPORT_MENU: %s", self.START_MENU, self.REPORT_MENU)
             
-            # Validate and fix templates before storing
+            # Validate and fix only templates whose content changed since they were last compiled
             self._TEMPLATES = {}
+            self._MODELS = {}
             validation_errors = []
+            digests = {
+                template_name: flow_cache.template_digest(template_name, template_data)
+                for template_name, template_data in raw_templates.items()
+            }
+            compiled = flow_cache.get_compiled_templates(digests.values())
+            recompiled = {}
+            changed = set()
             
             for template_name, template_data in raw_templates.items():
-                try:
-                    # Validate and fix common issues
-                    fixed_template = self._validate_and_fix_template(template_name, template_data)
-                    
-                    # Try to validate with pydantic
-                    validated = template.Template.as_model(fixed_template)
-                    
-                    # Store validated template
-                    self._TEMPLATES[template_name] = fixed_template
-                    
-                except Exception as e:
-                    error_msg = str(e)
-                    logger.error(f"Validation failed for template '{template_name}': {error_msg}")
-                    logger.error(f"Template data: {json.dumps(template_data, indent=2)}")
-                    
-                    # Try one more fix attempt for specific errors
-                    retry = False
-                    
-                    # Handle "list object has no attribute 'items'" error for list templates
-                    if "'list' object has no attribute 'items'" in error_msg:
-                        template_type = template_data.get('kind') or template_data.get('type')
-                        if template_type == 'list':
-                            logger.warning(f"Attempting to fix list template '{template_name}' structure")
-                            # Try converting to a simpler structure or skip problematic fields
-                            message = template_data.get('message', {})
-                            if isinstance(message, dict) and 'sections' in message:
-                                # Simplify sections structure
-                                sections = message.get('sections', [])
-                                simplified_sections = []
-                                for section in sections:
-                                    if isinstance(section, dict):
-                                        simplified_section = {
-                                            'title': str(section.get('title', 'Section')),
-                                            'rows': []
-                                        }
-                                        rows = section.get('rows', [])
-                                        for row in rows:
-                                            if isinstance(row, dict):
-                                                simplified_section['rows'].append({
-                                                    'title': str(row.get('title', '')),
-                                                    'identifier': str(row.get('identifier') or row.get('id', '')),
-                                                    'description': str(row.get('description') or row.get('desc', ''))
-                                                })
-                                        simplified_sections.append(simplified_section)
-                                
-                                message['sections'] = simplified_sections
-                                template_data['message'] = message
-                                retry = True
-                    
-                    if retry:
-                        try:
-                            validated = template.Template.as_model(template_data)
-                            self._TEMPLATES[template_name] = template_data
-                            logger.info(f"Successfully fixed template '{template_name}' on retry")
-                            continue
-                        except Exception as retry_error:
-                            logger.error(f"Retry failed for template '{template_name}': {retry_error}")
-                    
+                template_digest = digests[template_name]
+                result = compiled.get(template_digest)
+
+                if result is None:
+                    result = self._compile_template(template_name, template_data)
+                    recompiled[template_digest] = result
+                    changed.add(template_name)
+
+                if result["error"] is None:
+                    self._TEMPLATES[template_name] = result["template"]
+                else:
                     validation_errors.append({
                         'name': template_name,
-                        'error': error_msg,
-                        'data': template_data
+                        'error': result["error"],
+                        'data': result["template"]
                     })
-                    
-                    # Don't store invalid templates
-                    continue
+
+            flow_cache.set_compiled_templates(recompiled, keep=digests.values())
             
-            logger.info(f"Validation complete: {len(self._TEMPLATES)} valid templates")
-            logger.info(f"Template IDs after validation: {list(self._TEMPLATES.keys())}")
-            logger.info(f"START_MENU: {self.START_MENU}, REPORT_MENU: {self.REPORT_MENU}")
+            logger.info("Validation complete: %s valid templates, %s recompiled", len(self._TEMPLATES), len(changed))
+            logger.debug("Template IDs after validation: %s", list(self._TEMPLATES.keys()))
+            logger.info("START_MENU: %s, REPORT_MENU: %s", self.START_MENU, self.REPORT_MENU)
             
             if validation_errors:
-                logger.warning(f"{len(validation_errors)} templates failed validation:")
+                logger.warning("%s templates failed validation:", len(validation_errors))
                 for error in validation_errors:
-                    logger.warning(f"  - {error['name']}: {error['error']}")
+                    logger.warning("  - %s: %s", error['name'], error['error'])
                 
                 # Check for broken routes (routes pointing to invalid templates)
-                self._check_for_broken_routes(validation_errors)
+                self._check_for_broken_routes(validation_errors, changed)
                 
-                # Log to Frappe error log for visibility
-                frappe.log_error(
-                    title="Template Validation Errors",
-                    message=json.dumps(validation_errors, indent=2)
-                )
+                # Log to Frappe error log for visibility, once per changed template
+                new_errors = [error for error in validation_errors if error['name'] in changed]
+                if new_errors:
+                    frappe.log_error(
+                        title="Template Validation Errors",
+                        message=json.dumps(new_errors, indent=2)
+                    )
+
+            flow_cache.set_artifact(digest, {
+                "templates": self._TEMPLATES,
+                "triggers": self._TRIGGERS,
+                "start_menu": self.START_MENU,
+                "report_menu": self.REPORT_MENU
+            })
 
         except Exception as e:
             frappe.log_error(title="FrappeStorageManager Load Error", message=str(e))
-            logger.error(f"Error loading templates: {str(e)}", exc_info=True)
+            logger.error("Error loading templates: %s", e, exc_info=True)
             self._TEMPLATES = {}
             self._TRIGGERS = []
 
@@ -552,7 +618,7 @@ class FrappeStorageManager(storage.IStorageManager):
         exists = name in self._TEMPLATES
         
         if not exists:
-            logger.warning(f"Template '{name}' does not exist. Available: {list(self._TEMPLATES.keys())}")
+            logger.warning("Template '%s' does not exist. Available: %s", name, list(self._TEMPLATES.keys()))
         
         return exists
 
@@ -561,7 +627,7 @@ class FrappeStorageManager(storage.IStorageManager):
         Create a fallback error template when the requested template fails.
         This prevents the entire flow from breaking due to one bad template.
         """
-        logger.warning(f"Creating error fallback template for '{template_name}'")
+        logger.warning("Creating error fallback template for '%s'", template_name)
         
         error_template_data = {
             'kind': 'text',
@@ -573,42 +639,48 @@ class FrappeStorageManager(storage.IStorageManager):
         try:
             return template.Template.as_model(error_template_data)
         except Exception as e:
-            logger.critical(f"Even error template failed to create: {e}")
+            logger.critical("Even error template failed to create: %s", e)
             return None
 
+    def _get_model(self, name: str, template_data: dict) -> template.EngineTemplate:
+        """Validated model of a loaded template, built once and handed out as a shallow copy"""
+        model = self._MODELS.get(name)
+
+        if model is None:
+            model = template.Template.as_model(template_data)
+            self._MODELS[name] = model
+
+        # attribute assignments by the engine stay on the copy
+        return model.model_copy()
+
     def get(self, name: str) -> template.EngineTemplate:    
         """Get a template by name with enhanced error handling and fallback."""
         try:
             self._ensure_templates_loaded()
             
-            logger.info(f"Attempting to fetch template: '{name}'")
+            logger.debug("Fetching template '%s'", name)
             
             if not self._TEMPLATES:
                 logger.error("No templates loaded! _TEMPLATES is empty")
                 return self._get_error_template(name, "No templates loaded")
             
             if name is None or name == "None":
-                logger.error(f"Template name is None or 'None' string - routing issue detected")
+                logger.error("Template name is None or 'None' string - routing issue detected")
                 return self._get_error_template(name, "Invalid template name: None")
             
             template_data = self._TEMPLATES.get(name)
             
             if template_data is None:
-                logger.error(f"Template '{name}' not found in _TEMPLATES")
-                logger.error(f"Available template IDs: {list(self._TEMPLATES.keys())}")
+                logger.error("Template '%s' not found in _TEMPLATES", name)
+                logger.error("Available template IDs: %s", list(self._TEMPLATES.keys()))
                 return self._get_error_template(name, f"Template not found: {name}")
             
-            # Log template data for debugging
-            logger.debug(f"Retrieved template '{name}': {json.dumps(template_data, indent=2)}")
-            
-            # Validate before returning
+            # Validated on load, the model is only built on the first fetch
             try:
-                validated_template = template.Template.as_model(template_data)
-                logger.info(f"Template '{name}' validated successfully (type: {template_data.get('kind')})")
-                return validated_template
+                return self._get_model(name, template_data)
             except Exception as validation_error:
-                logger.critical(f"Template '{name}' failed runtime validation: {validation_error}")
-                logger.critical(f"Template data: {json.dumps(template_data, indent=2)}")
+                logger.critical("Template '%s' failed runtime validation: %s", name, validation_error)
+                logger.debug("Template data: %s", template_data)
                 
                 # Try to fix and re-validate
                 fixed_template = self._validate_and_fix_template(name, template_data)
@@ -616,15 +688,16 @@ class FrappeStorageManager(storage.IStorageManager):
                     validated = template.Template.as_model(fixed_template)
                     # Update stored template with fixed version
                     self._TEMPLATES[name] = fixed_template
-                    logger.info(f"Template '{name}' fixed and validated on retry")
-                    return validated
+                    self._MODELS[name] = validated
+                    logger.info("Template '%s' fixed and validated on retry", name)
+                    return validated.model_copy()
                 except Exception as second_error:
-                    logger.critical(f"Template '{name}' still invalid after fix attempt: {second_error}")
+                    logger.critical("Template '%s' still invalid after fix attempt: %s", name, second_error)
                     return self._get_error_template(name, f"Validation failed: {second_error}")
                 
         except Exception as e:
             frappe.log_error(title="Get Template Error", message=f"Template: {name}, Error: {str(e)}")
-            logger.critical(f"Error fetching template '{name}': {str(e)}", exc_info=True)
+            logger.critical("Error fetching template '%s': %s", name, e, exc_info=True)
             return self._get_error_template(name, str(e))
 
     def get_template_settings(self, name: str) -> dict:
@@ -637,14 +710,14 @@ class FrappeStorageManager(storage.IStorageManager):
         
         template_data = self._TEMPLATES.get(name)
         if not template_data:
-            logger.warning(f"Cannot get settings for non-existent template '{name}'")
+            logger.warning("Cannot get settings for non-existent template '%s'", name)
             return {}
         
         settings = template_data.get('settings', {})
         
         # Return all settings (they should all be consolidated in the settings dict now)
         if settings:
-            logger.info(f"Template '{name}' settings: {settings}")
+            logger.debug("Template '%s' settings: %s", name, settings)
         
         return settings
 
@@ -662,10 +735,15 @@ class FrappeRedisSessionManager(ISessionManager):
     """
     Redis-based session manager for PyWCE in Frappe.
     
-    Uses Frappe's Redis cache to store user session data.
+    User sessions are Redis hashes with one field per key, see
+    `frappe_pywce.session_store`. User props are stored as their own
+    `fpw:props:<prop>` fields so a prop update is a single HSET.
+
+    Global data is one hash with a field per key, read through a short
+    lived in-process copy that is invalidated over pub/sub on every write.
 
-    user data has default expiry set to 10 mins
-    global data has default expiry set to 30 mins
+    user data has default expiry set to 30 mins, refreshed on every access
+    global data has default expiry set to 24 hours, refreshed on every write
     """
     _global_expiry = 86400
     _global_key_ = create_cache_key("global")
@@ -675,6 +753,11 @@ class FrappeRedisSessionManager(ISessionManager):
         TODO: take the configured ttl in app settings
         """
         self.ttl = ttl
+        self.store = SessionStore(ttl, legacy_transform=self._flatten_props)
+        self.global_store = GlobalStore(
+            ttl=self._global_expiry,
+            legacy_key=self._get_prefixed_key(self._global_key_)
+        )
 
     def _get_prefixed_key(self, session_id, key=None):
         """Helper to create prefixed cache keys."""
@@ -685,114 +768,151 @@ class FrappeRedisSessionManager(ISessionManager):
         
         return f"{k}:{key}"
     
-    def _set_data(self, session_id:str=None, session_data:dict=None, is_global=False):
-        """
-            set session data under 1 key for user
-        """
-        if session_data is None: return
-        
-        if is_global:
-            frappe.cache.set_value(
-                key=self._get_prefixed_key(self._global_key_), 
-                val=json.dumps(session_data), 
-                expires_in_sec=self._global_expiry
-            )
-            
-        else:
-            frappe.cache.set_value(
-                key=self._get_prefixed_key(session_id), 
-                val=json.dumps(session_data), 
-                expires_in_sec=self.ttl
-        )
+    def _session(self, session_id: str):
+        """The running unit of work when it is for session_id, else the Redis store"""
+        uow = current_unit_of_work()
 
-    def _get_data(self, session_id:str=None, is_global=False) -> dict:
-        raw = frappe.cache.get_value(
-            key=self._get_prefixed_key(self._global_expiry), 
-            expires=True
-        ) if is_global else frappe.cache.get_value(
-            key=self._get_prefixed_key(session_id), 
-            expires=True
-        )
+        if uow is not None and uow.session_id == session_id:
+            return uow
 
-        if raw is None:
-            return {}
-        
-        return json.loads(raw)
+        return self.store
+
+    def scope(self, session_id: str):
+        """Serve session_id (and global data) from memory for the duration of a webhook, see session_store"""
+        return session_scope(self.store, session_id, global_store=self.global_store)
 
     @property
     def prop_key(self) -> str:
         return create_cache_key("props")
 
+    def _prop_field(self, prop_key: str) -> str:
+        return f"{self.prop_key}:{prop_key}"
+
+    def _is_prop_field(self, field: str) -> bool:
+        return field.startswith(f"{self.prop_key}:")
+
+    def _flatten_props(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Blob layout -> hash layout, the props dict becomes one field per prop"""
+        fields = {k: v for k, v in data.items() if k != self.prop_key}
+
+        for prop_key, value in (data.get(self.prop_key) or {}).items():
+            fields[self._prop_field(prop_key)] = value
+
+        return fields
+
+    def _fold_props(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Hash layout -> the dict shape pywce expects, props under prop_key"""
+        data, props = {}, {}
+        offset = len(self.prop_key) + 1
+
+        for field, value in fields.items():
+            if self._is_prop_field(field):
+                props[field[offset:]] = value
+            else:
+                data[field] = value
+
+        if props:
+            data[self.prop_key] = props
+
+        return data
+
     def session(self, session_id: str) -> "FrappeRedisSessionManager":
         """Initialize session in Redis if it doesn't exist."""
         return self
 
     def save(self, session_id: str, key: str, data: Any) -> None:
         """Save a key-value pair into the session."""
-        d = self._get_data(session_id=session_id)
-        d[key] = data
-        self._set_data(session_id=session_id, session_data=d)
+        self.save_all(session_id, {key: data})
 
     def save_global(self, key: str, data: Any) -> None:
         """Save global key-value pair."""
-        g = self._get_data(is_global=True)
-        g[key] = data
-        self._set_data(session_data=g, is_global=True)
+        uow = current_unit_of_work()
+
+        if uow is not None:
+            uow.set_global(key, data)
+        else:
+            self.global_store.set(key, data)
 
     def get(self, session_id: str, key: str, t: Type[T] = None):
         """Retrieve a specific key from session."""
-        d = self._get_data(session_id=session_id)
-        return d.get(key)
+        if key == self.prop_key:
+            return self.get_user_props(session_id) or None
+
+        return self._session(session_id).get(session_id, key)
 
     def get_global(self, key: str, t: Type[T] = None):
         """Retrieve global data."""
-        g = self._get_data(is_global=True)
-        return g.get(key)
+        uow = current_unit_of_work()
+
+        if uow is not None:
+            return uow.get_global(self.global_store, key)
+
+        return self.global_store.get(key)
 
     def fetch_all(self, session_id: str, is_global: bool = False) -> Dict[str, Any]:
         """Retrieve all session data."""
-        return self._get_data(session_id=session_id, is_global=is_global)
+        if is_global:
+            uow = current_unit_of_work()
+            return uow.get_all_global(self.global_store) if uow is not None else self.global_store.get_all()
+
+        return self._fold_props(self._session(session_id).get_all(session_id))
 
     def evict(self, session_id: str, key: str) -> None:
         """Remove a key from session."""
-        d = self._get_data(session_id=session_id)
-        d.pop(key, -1)
-        self._set_data(session_id= session_id, session_data=d)
+        self.evict_all(session_id, [key])
 
     def save_all(self, session_id: str, data: Dict[str, Any]) -> None:
-        """Save multiple key-value pairs at once."""
-        for k, d in data.items():
-            self.save(session_id, k, d)
+        """Save multiple key-value pairs at once, a single pipelined write."""
+        fields = dict(data)
+        stale_props = []
+
+        if self.prop_key in fields:
+            # replacing the props dict replaces every prop field
+            props = fields.pop(self.prop_key) or {}
+            stale_props = [f for f in self._session(session_id).fields(session_id) if self._is_prop_field(f)]
+            fields.update({self._prop_field(k): v for k, v in props.items()})
+
+        self._session(session_id).set_many(session_id, fields, delete=stale_props)
 
     def evict_all(self, session_id: str, keys: List[str]) -> None:
         """Remove multiple keys from session."""
-        for key in keys:
-            self.evict(session_id, key)
+        fields = [k for k in keys if k != self.prop_key]
+
+        if self.prop_key in keys:
+            fields.extend(f for f in self._session(session_id).fields(session_id) if self._is_prop_field(f))
+
+        self._session(session_id).delete(session_id, fields)
 
     def evict_global(self, key: str) -> None:
         """Remove a key from global storage."""
-        g = self._get_data(is_global=True)
-        g.pop(key, -1)
-        self._set_data(session_data=g, is_global=True)
+        uow = current_unit_of_work()
+
+        if uow is not None:
+            uow.delete_global(key)
+        else:
+            self.global_store.delete(key)
 
     def clear(self, session_id: str, retain_keys: List[str] = None) -> None:
-        """Clear the entire session.
+        """Clear the entire session, keeping keys that contain any of retain_keys.
         """
         if retain_keys is None or retain_keys == []:
-            frappe.cache().delete_keys(self._get_prefixed_key(session_id))
+            self._session(session_id).drop(session_id)
             return
-        
-        for retain_key in retain_keys:
-            data = self.fetch_all(session_id)
-            for k, v in data.items():
-                if retain_key in k:
-                    continue
 
-                self.evict(session_id, k)
+        self._session(session_id).delete(session_id, [
+            field for field in self._session(session_id).fields(session_id)
+            if not any(retain_key in field for retain_key in retain_keys)
+        ])
 
     def clear_global(self) -> None:
         """Clear all global data."""
-        frappe.cache().delete_keys(self._get_prefixed_key(self._global_key_))
+        uow = current_unit_of_work()
+
+        if uow is not None:
+            uow.global_pending = {}
+            uow.global_deleted = set()
+
+        self.global_store.clear()
 
     def key_in_session(self, session_id: str, key: str, check_global: bool = True) -> bool:
         """Check if a key exists in session or global storage."""
@@ -803,25 +923,16 @@ class FrappeRedisSessionManager(ISessionManager):
 
     def get_user_props(self, session_id: str) -> Dict[str, Any]:
         """Retrieve user properties."""
-        return self.get(session_id, self.prop_key) or {}
+        return self._fold_props(self._session(session_id).get_all(session_id)).get(self.prop_key) or {}
 
     def evict_prop(self, session_id: str, prop_key: str) -> bool:
         """Remove a property from user props."""
-        current_props = self.get_user_props(session_id)
-        if prop_key not in current_props:
-            return False
-        
-        current_props.pop(prop_key, -1)
-        self.save(session_id, self.prop_key, current_props)
-        return True
+        return self._session(session_id).delete(session_id, [self._prop_field(prop_key)]) > 0
 
     def get_from_props(self, session_id: str, prop_key: str, t: Type[T] = None):
         """Retrieve a property from user props."""
-        props = self.get_user_props(session_id)
-        return props.get(prop_key)
+        return self._session(session_id).get(session_id, self._prop_field(prop_key))
 
     def save_prop(self, session_id: str, prop_key: str, data: Any) -> None:
         """Save a property in user props."""
-        current_props = self.get_user_props(session_id)
-        current_props[prop_key] = data
-        self.save(session_id, self.prop_key, current_props)
\ No newline at end of file
+        self._session(session_id).set(session_id, self._prop_field(prop_key), data)
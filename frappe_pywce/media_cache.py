@@ -0,0 +1,276 @@
+"""
+Content addressed cache of WhatsApp media
+
+Graph media ids resolve to short lived, token protected download URLs. Each
+media id is resolved and downloaded once:
+
+1. `WhatsApp Media` (the index) maps a media id to the SHA-256 of its content
+2. on a miss, the download is streamed to a temporary file in fixed size
+   chunks and hashed on the way, then moved to
+   `private/files/whatsapp_media/<sha[:2]>/<sha>`. Identical content sent
+   under several media ids is stored once
+3. `serve` answers from the cached file with ETag and Range support, nothing
+   is buffered in memory and Graph is not called again
+
+Concurrent misses of one media id are serialized by a lock, the second one
+finds the index row written by the first. `prefetch` downloads the media of
+new incoming messages in the background while their Graph URLs are still
+valid, it is enqueued by the webhook persistence and can be turned off with
+the `whatsapp_media_prefetch` site config key.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+from typing import Dict, Iterable, Optional
+
+import frappe
+import frappe.utils
+from werkzeug.utils import send_file
+
+from frappe_pywce.graph_client import get_graph_client
+from frappe_pywce.pywce_logger import app_logger as logger
+from frappe_pywce.util import LOCK_LEASE_TIME, LOCK_WAIT_TIME, create_cache_key
+
+MEDIA_DOCTYPE = "WhatsApp Media"
+PREFETCH_CONF_KEY = "whatsapp_media_prefetch"
+
+CACHE_FOLDER = "whatsapp_media"
+CHUNK_SIZE = 64 * 1024
+# Cloud API media is at most 100MB (documents)
+MAX_MEDIA_SIZE = 100 * 1024 * 1024
+# a media id always resolves to the same content
+MAX_AGE_IN_SEC = 7 * 24 * 60 * 60
+
+DEFAULT_MIME_TYPE = "application/octet-stream"
+
+# Graph media ids are numeric
+MEDIA_ID_PATTERN = re.compile(r"^\d+$")
+
+
+class MediaTooLargeError(Exception):
+    pass
+
+
+def cache_dir() -> str:
+    return frappe.get_site_path("private", "files", CACHE_FOLDER)
+
+
+def content_path(sha256: str) -> str:
+    """Relative to the site folder, the first two hex digits fan the files out over 256 folders"""
+    return os.path.join("private", "files", CACHE_FOLDER, sha256[:2], sha256)
+
+
+def _absolute(file_path: str) -> str:
+    return frappe.get_site_path(file_path)
+
+
+def _is_path_like(media_id: str) -> bool:
+    # anything else would make the Graph request go to another path or host
+    return not media_id or "/" in media_id or ":" in media_id or "?" in media_id
+
+
+def check_media_id(media_id: str) -> str:
+    """
+    `media_id` of a request: a numeric Graph media id, or the media of a chat
+    message the user can read. Raises frappe.PermissionError otherwise
+    """
+    media_id = str(media_id or "").strip()
+
+    if MEDIA_ID_PATTERN.match(media_id):
+        return media_id
+
+    if not _is_path_like(media_id):
+        message = frappe.db.get_value("WhatsApp Chat Message", {"media_url": media_id}, "name")
+
+        if message and frappe.has_permission("WhatsApp Chat Message", "read", doc=message):
+            return media_id
+
+    frappe.throw(f"Invalid media id {media_id}", exc=frappe.PermissionError)
+
+
+def get_cached(media_id: str) -> Optional[Dict]:
+    """Index row of `media_id` if its content is on disk"""
+    row = frappe.db.get_value(
+        MEDIA_DOCTYPE, media_id, ["media_id", "sha256", "mime_type", "size", "file_path"], as_dict=True
+    )
+
+    if row and row.file_path and os.path.exists(_absolute(row.file_path)):
+        return row
+
+    return None
+
+
+def _find_by_sha256(sha256: Optional[str]) -> Optional[Dict]:
+    if not sha256:
+        return None
+
+    row = frappe.db.get_value(MEDIA_DOCTYPE, {"sha256": sha256}, ["sha256", "size", "file_path"], as_dict=True)
+
+    if row and row.file_path and os.path.exists(_absolute(row.file_path)):
+        return row
+
+    return None
+
+
+def stream_to_cache(chunks: Iterable[bytes], max_size: int = MAX_MEDIA_SIZE) -> Dict:
+    """
+    Write `chunks` to the cache under the SHA-256 of their content.
+
+    Returns:
+        {"sha256": hex digest, "size": bytes, "file_path": relative to the site}
+    """
+    folder = cache_dir()
+    os.makedirs(folder, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+
+    # same file system as the destination, the final move is an atomic rename
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix=".download-")
+
+    try:
+        with os.fdopen(handle, "wb") as f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+
+                size += len(chunk)
+                if size > max_size:
+                    raise MediaTooLargeError(f"Media exceeds {max_size} bytes")
+
+                digest.update(chunk)
+                f.write(chunk)
+
+        sha256 = digest.hexdigest()
+        file_path = content_path(sha256)
+        destination = _absolute(file_path)
+
+        if os.path.exists(destination):
+            # same content already cached under another media id
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(temp_path, destination)
+
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return {"sha256": sha256, "size": size, "file_path": file_path}
+
+
+def _save_index(media_id: str, mime_type: str, content: Dict) -> None:
+    now = frappe.utils.now()
+    user = frappe.session.user
+
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tab{MEDIA_DOCTYPE}`
+            (`name`, `creation`, `modified`, `owner`, `modified_by`, `docstatus`,
+             `media_id`, `sha256`, `mime_type`, `size`, `file_path`)
+        VALUES (%s, %s, %s, %s, %s, 0, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            `sha256` = VALUES(`sha256`), `mime_type` = VALUES(`mime_type`), `size` = VALUES(`size`),
+            `file_path` = VALUES(`file_path`), `modified` = VALUES(`modified`)
+        """,
+        (media_id, now, now, user, user, media_id, content["sha256"], mime_type, content["size"], content["file_path"])
+    )
+
+
+def _download(media_id: str) -> Dict:
+    if _is_path_like(media_id):
+        raise ValueError(f"Not a media id: {media_id}")
+
+    access_token = frappe.get_cached_doc("ChatBot Config").get_password("access_token")
+    client = get_graph_client()
+
+    response = client.get(media_id, access_token)
+    response.raise_for_status()
+    info = response.json()
+
+    mime_type = info.get("mime_type") or DEFAULT_MIME_TYPE
+
+    if frappe.utils.cint(info.get("file_size")) > MAX_MEDIA_SIZE:
+        raise MediaTooLargeError(f"Media {media_id} is {info.get('file_size')} bytes")
+
+    # Graph reports the content hash, known content is not downloaded again
+    content = _find_by_sha256(info.get("sha256"))
+
+    if content is None:
+        with client.get(info["url"], access_token, stream=True) as download:
+            download.raise_for_status()
+            content = stream_to_cache(download.iter_content(chunk_size=CHUNK_SIZE))
+
+    _save_index(media_id, mime_type, content)
+    frappe.db.commit()
+
+    logger.debug("Cached media %s", media_id, sha256=content["sha256"], size=content["size"])
+
+    return {"media_id": media_id, "mime_type": mime_type, **content}
+
+
+def resolve(media_id: str) -> Dict:
+    """Index row of `media_id`, downloading it on a miss"""
+    cached = get_cached(media_id)
+    if cached:
+        return cached
+
+    lock_key = create_cache_key(f"lock:media:{media_id}")
+
+    with frappe.cache().lock(lock_key, timeout=LOCK_LEASE_TIME, blocking_timeout=LOCK_WAIT_TIME):
+        # downloaded by whoever held the lock before us
+        return get_cached(media_id) or frappe._dict(_download(media_id))
+
+
+def media_url(media_id: str) -> str:
+    return f"/api/method/frappe_pywce.media_cache.serve?media_id={media_id}"
+
+
+@frappe.whitelist()
+def serve(media_id: str):
+    """Cached media content, supports conditional and Range requests"""
+    frappe.has_permission("WhatsApp Chat Message", "read", throw=True)
+
+    media_id = check_media_id(media_id)
+    media = resolve(media_id)
+
+    response = send_file(
+        _absolute(media.file_path),
+        environ=frappe.request.environ,
+        mimetype=media.mime_type or DEFAULT_MIME_TYPE,
+        conditional=True,
+        etag=media.sha256,
+        max_age=MAX_AGE_IN_SEC
+    )
+
+    # customer media, never stored by shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+
+    return response
+
+
+def prefetch(media_ids: Iterable[str]) -> None:
+    """Background job, downloads media while their Graph URLs are valid"""
+    for media_id in media_ids:
+        try:
+            resolve(media_id)
+        except Exception:
+            logger.warning("Failed to prefetch media %s", media_id, exc_info=True)
+
+
+def enqueue_prefetch(media_ids: Iterable[str]) -> None:
+    media_ids = [media_id for media_id in dict.fromkeys(media_ids) if media_id]
+
+    if not media_ids or not frappe.utils.cint(frappe.conf.get(PREFETCH_CONF_KEY, 1)):
+        return
+
+    frappe.enqueue(
+        "frappe_pywce.media_cache.prefetch",
+        queue="default",
+        media_ids=media_ids,
+        enqueue_after_commit=True
+    )
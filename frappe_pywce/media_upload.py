@@ -0,0 +1,318 @@
+"""
+Streaming media uploads to the WhatsApp Cloud (Graph) API
+
+Files are sent straight from disk: `StreamBody` is a sized, seekable
+file-like object over the multipart envelope and the file on disk. requests
+sends it with a Content-Length in small blocks, urllib3 rewinds it when a
+429 / 5xx is retried, and the file is never held in memory.
+
+Uploads are cached by the SHA-256 of their content:
+
+- `upload_file` posts to /<phone_id>/media and caches the returned media id
+  for the phone number. Sending the same brochure to thousands of users
+  uploads it once
+- `upload_handle` uses the resumable upload session API
+  (/<app_id>/uploads) and caches the returned file handle, used for
+  message template header examples. The session id is kept as well: an
+  interrupted upload resumes from the offset Graph reports instead of
+  starting over, in this call or a later one
+
+Concurrent uploads of the same content are serialized by a lock, the second
+one finds the id cached by the first.
+"""
+
+import hashlib
+import mimetypes
+import os
+import uuid
+from typing import List, Optional, Tuple, Union
+
+import frappe
+import frappe.utils
+import requests
+from frappe.utils.background_jobs import get_redis_conn
+
+from frappe_pywce.graph_client import get_graph_client
+from frappe_pywce.pywce_logger import app_logger as logger
+from frappe_pywce.util import CACHE_KEY_PREFIX, LOCK_LEASE_TIME, LOCK_WAIT_TIME, create_cache_key
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MIME_TYPE = "application/octet-stream"
+
+# uploaded media is kept by Meta for 30 days
+MEDIA_ID_TTL_IN_SEC = 29 * 24 * 60 * 60
+UPLOAD_SESSION_TTL_IN_SEC = 24 * 60 * 60
+MAX_RESUME_ATTEMPTS = 3
+
+# (path, offset, length) of a file range
+FileRange = Tuple[str, int, int]
+Part = Union[bytes, FileRange]
+
+
+class StreamBody:
+    """
+    Read only, seekable concatenation of byte strings and file ranges.
+
+    `__len__` makes requests send a Content-Length instead of a chunked body,
+    `tell` / `seek` let urllib3 rewind it for a retry.
+    """
+
+    def __init__(self, parts: List[Part]):
+        self._parts = []
+        self._length = 0
+
+        for part in parts:
+            size = len(part) if isinstance(part, bytes) else part[2]
+            self._parts.append((self._length, size, part))
+            self._length += size
+
+        self._position = 0
+        self._files = {}
+
+    def __len__(self) -> int:
+        return self._length
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._length
+
+        self._position = min(max(offset, 0), self._length)
+        return self._position
+
+    def _read_part(self, part: Part, start: int, size: int) -> bytes:
+        if isinstance(part, bytes):
+            return part[start:start + size]
+
+        path, offset, _ = part
+        f = self._files.get(path)
+
+        if f is None:
+            f = self._files[path] = open(path, "rb")
+
+        f.seek(offset + start)
+        return f.read(size)
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self._length - self._position if size is None or size < 0 else size
+        chunks = []
+
+        for start, length, part in self._parts:
+            if remaining <= 0:
+                break
+
+            if self._position >= start + length:
+                continue
+
+            local = self._position - start
+            chunk = self._read_part(part, local, min(remaining, length - local))
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            self._position += len(chunk)
+            remaining -= len(chunk)
+
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def guess_mime_type(file_name: str) -> str:
+    return mimetypes.guess_type(file_name or "")[0] or DEFAULT_MIME_TYPE
+
+
+def multipart_body(fields: dict, file_name: str, mime_type: str, content: Part) -> Tuple[StreamBody, str]:
+    """multipart/form-data body with `content` as its `file` field, returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    file_name = (file_name or "file").replace('"', "").replace("\r", "").replace("\n", "")
+
+    head = "".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        f"Content-Type: {mime_type}\r\n\r\n"
+    )
+    tail = f"\r\n--{boundary}--\r\n"
+
+    body = StreamBody([head.encode(), content, tail.encode()])
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def _cache_key(kind: str, owner: str, sha256: str) -> str:
+    return f"{CACHE_KEY_PREFIX}media:{frappe.local.site}:{kind}:{owner}:{sha256}"
+
+
+def _cached(kind: str, owner: str, sha256: str, create) -> str:
+    """Value cached for (kind, owner, content), `create()` under a lock on a miss"""
+    conn = get_redis_conn()
+    key = _cache_key(kind, owner, sha256)
+
+    value = conn.get(key)
+    if value is not None:
+        return value.decode()
+
+    with frappe.cache().lock(create_cache_key(f"lock:{kind}:{sha256}"), timeout=LOCK_LEASE_TIME, blocking_timeout=LOCK_WAIT_TIME):
+        value = conn.get(key)
+        if value is not None:
+            return value.decode()
+
+        value = create()
+        conn.set(key, value, ex=MEDIA_ID_TTL_IN_SEC)
+
+        return value
+
+
+def _config():
+    config = frappe.get_cached_doc("ChatBot Config")
+
+    if not config.access_token or not config.phone_id:
+        frappe.throw("ChatBot Config not properly configured. Please set Access Token and Phone ID")
+
+    return config
+
+
+def _post_media(config, content: Part, file_name: str, mime_type: str) -> str:
+    fields = {"messaging_product": "whatsapp", "type": mime_type}
+    body, content_type = multipart_body(fields, file_name, mime_type, content)
+
+    with body:
+        response = get_graph_client().post(
+            f"{config.phone_id}/media", config.access_token, data=body, headers={"Content-Type": content_type}
+        )
+
+    response.raise_for_status()
+    media_id = response.json()["id"]
+
+    logger.debug("Uploaded media %s", file_name, media_id=media_id, size=len(body))
+    return media_id
+
+
+def upload_file(path: str, file_name: Optional[str] = None, mime_type: Optional[str] = None) -> str:
+    """Media id of the file at `path`, uploaded once per content and phone number"""
+    config = _config()
+    file_name = file_name or os.path.basename(path)
+    mime_type = mime_type or guess_mime_type(file_name)
+
+    return _cached(
+        "upload", config.phone_id, file_sha256(path),
+        lambda: _post_media(config, (path, 0, os.path.getsize(path)), file_name, mime_type)
+    )
+
+
+def upload_bytes(content: bytes, file_name: str, mime_type: Optional[str] = None) -> str:
+    """`upload_file` for content already in memory"""
+    config = _config()
+    mime_type = mime_type or guess_mime_type(file_name)
+
+    return _cached(
+        "upload", config.phone_id, hashlib.sha256(content).hexdigest(),
+        lambda: _post_media(config, content, file_name, mime_type)
+    )
+
+
+def _oauth(config) -> dict:
+    # the upload session API takes OAuth, not Bearer, authorization
+    return {"Authorization": f"OAuth {config.access_token}"}
+
+
+def _upload_offset(config, session_id: str) -> int:
+    response = get_graph_client().get(session_id, headers=_oauth(config))
+    response.raise_for_status()
+    return frappe.utils.cint(response.json().get("file_offset"))
+
+
+def _resumable_upload(config, path: str, sha256: str, file_name: str, mime_type: str) -> str:
+    conn = get_redis_conn()
+    session_key = _cache_key("upload_session", config.app_id, sha256)
+    size = os.path.getsize(path)
+
+    session_id = conn.get(session_key)
+    session_id = session_id.decode() if session_id is not None else None
+
+    if session_id is None:
+        response = get_graph_client().post(
+            f"{config.app_id}/uploads",
+            config.access_token,
+            params={"file_name": file_name, "file_length": size, "file_type": mime_type}
+        )
+        response.raise_for_status()
+
+        session_id = response.json()["id"]
+        conn.set(session_key, session_id, ex=UPLOAD_SESSION_TTL_IN_SEC)
+
+    for attempt in range(1, MAX_RESUME_ATTEMPTS + 1):
+        try:
+            # a fresh session is at 0, an earlier interrupted one wherever Graph got to
+            offset = _upload_offset(config, session_id)
+
+            with StreamBody([(path, offset, size - offset)]) as body:
+                response = get_graph_client().post(
+                    session_id, data=body, headers={**_oauth(config), "file_offset": str(offset)}
+                )
+
+            response.raise_for_status()
+            break
+
+        except requests.RequestException:
+            if attempt == MAX_RESUME_ATTEMPTS:
+                # the session may be gone, the next call starts a new one
+                conn.delete(session_key)
+                raise
+
+            logger.warning("Upload of %s interrupted, resuming", file_name, exc_info=True, attempt=attempt)
+
+    conn.delete(session_key)
+    return response.json()["h"]
+
+
+def upload_handle(path: str, file_name: Optional[str] = None, mime_type: Optional[str] = None) -> str:
+    """Resumable upload file handle of the file at `path`, uploaded once per content and app"""
+    config = _config()
+
+    if not config.app_id:
+        frappe.throw("Set the App ID in ChatBot Config to use resumable uploads")
+
+    file_name = file_name or os.path.basename(path)
+    mime_type = mime_type or guess_mime_type(file_name)
+    sha256 = file_sha256(path)
+
+    return _cached(
+        "handle", config.app_id, sha256,
+        lambda: _resumable_upload(config, path, sha256, file_name, mime_type)
+    )
+
+
+def get_file(file_url: str):
+    """`File` doc of `file_url`, checked for read permission"""
+    file_doc = frappe.get_doc("File", {"file_url": file_url})
+    file_doc.check_permission("read")
+
+    return file_doc
@@ -0,0 +1,162 @@
+"""
+Full-text search over chat messages
+
+`message_text` carries a MariaDB FULLTEXT index. InnoDB keeps it current on
+every insert and update, so the webhook, campaign and console write paths
+feed it without extra work. Queries run in boolean mode:
+
+- every word of the query is required and prefix matched (`+word*`)
+- hits are ranked by relevance, then newest first
+- an optional phone number narrows the search to one conversation
+- each hit carries an HTML snippet around its first match, matched words
+  wrapped in <mark>
+
+Words shorter than innodb_ft_min_token_size (3 by default) and stopwords are
+not indexed. A query made only of such words falls back to a LIKE scan, bounded by the
+page size and newest first.
+"""
+
+import html
+import re
+from typing import Dict, List, Optional
+
+import frappe
+import frappe.utils
+
+CHAT_MESSAGE_DOCTYPE = "WhatsApp Chat Message"
+FULLTEXT_INDEX_NAME = "message_text_fulltext_index"
+
+MIN_TOKEN_SIZE = 3
+# InnoDB's default FULLTEXT stopwords, never indexed so they cannot be required
+STOPWORDS = frozenset((
+    "a about an are as at be by com de en for from how i in is it la of on or that the this to was what "
+    "when where who will with und www"
+).split())
+SNIPPET_RADIUS = 60
+
+DEFAULT_PAGE_LENGTH = 20
+MAX_PAGE_LENGTH = 100
+# relevance ranked results have no stable keyset, deep offsets are cut off instead
+MAX_START = 1000
+
+RESULT_FIELDS = ("name", "phone_number", "message_text", "timestamp", "contact_name", "direction")
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def add_fulltext_index() -> None:
+    if frappe.db.db_type != "mariadb":
+        return
+
+    if frappe.db.sql(
+        f"SHOW INDEX FROM `tab{CHAT_MESSAGE_DOCTYPE}` WHERE Key_name = %s", (FULLTEXT_INDEX_NAME,)
+    ):
+        return
+
+    frappe.db.sql_ddl(
+        f"ALTER TABLE `tab{CHAT_MESSAGE_DOCTYPE}` ADD FULLTEXT INDEX `{FULLTEXT_INDEX_NAME}` (`message_text`)"
+    )
+
+
+def query_terms(query: str) -> List[str]:
+    """Distinct lower case words of a search query, in order"""
+    return list(dict.fromkeys(_WORD.findall((query or "").lower())))
+
+
+def boolean_query(terms: List[str]) -> str:
+    """MATCH ... AGAINST boolean mode query requiring every indexable term as a prefix"""
+    return " ".join(f"+{term}*" for term in terms if len(term) >= MIN_TOKEN_SIZE and term not in STOPWORDS)
+
+
+def snippet(text: str, terms: List[str], radius: int = SNIPPET_RADIUS) -> str:
+    """HTML escaped excerpt of `text` around the first matched term, matches wrapped in <mark>"""
+    text = text or ""
+
+    if not terms:
+        return html.escape(text[:radius * 2])
+
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(text)
+
+    start = max(first.start() - radius, 0) if first else 0
+    end = min((first.end() if first else 0) + radius, len(text))
+    excerpt = text[start:end]
+
+    parts = []
+    position = 0
+
+    for match in pattern.finditer(excerpt):
+        parts.append(html.escape(excerpt[position:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(0))}</mark>")
+        position = match.end()
+
+    parts.append(html.escape(excerpt[position:]))
+
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+
+def search(query: str, phone_number: Optional[str] = None, start: int = 0,
+           page_length: int = DEFAULT_PAGE_LENGTH) -> Dict:
+    """
+    One page of messages matching `query`.
+
+    Returns:
+        {"results": rows with `score` and `snippet`, "start": start,
+         "has_more": a next page exists}
+    """
+    terms = query_terms(query)
+    start = min(max(frappe.utils.cint(start), 0), MAX_START)
+    page_length = min(max(frappe.utils.cint(page_length) or DEFAULT_PAGE_LENGTH, 1), MAX_PAGE_LENGTH)
+
+    if not terms:
+        return {"results": [], "start": start, "has_more": False}
+
+    columns = ", ".join(f"`{field}`" for field in RESULT_FIELDS)
+    conditions = []
+    values = []
+
+    if phone_number:
+        conditions.append("`phone_number` = %s")
+        values.append(phone_number)
+
+    against = boolean_query(terms)
+
+    if against:
+        rows = frappe.db.sql(
+            f"""
+            SELECT {columns}, MATCH(`message_text`) AGAINST (%s IN BOOLEAN MODE) AS `score`
+            FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+            WHERE MATCH(`message_text`) AGAINST (%s IN BOOLEAN MODE)
+            {"".join(f" AND {c}" for c in conditions)}
+            ORDER BY `score` DESC, `timestamp` DESC, `name` DESC
+            LIMIT %s OFFSET %s
+            """,
+            (against, against, *values, page_length + 1, start),
+            as_dict=True
+        )
+
+    else:
+        # only words below the index's minimum token size, terms are \w+ so `_` is the only wildcard
+        for term in terms:
+            conditions.append("`message_text` LIKE %s")
+            values.append("%" + term.replace("_", "\\_") + "%")
+
+        rows = frappe.db.sql(
+            f"""
+            SELECT {columns}, 0 AS `score`
+            FROM `tab{CHAT_MESSAGE_DOCTYPE}`
+            WHERE {" AND ".join(conditions)}
+            ORDER BY `timestamp` DESC, `name` DESC
+            LIMIT %s OFFSET %s
+            """,
+            (*values, page_length + 1, start),
+            as_dict=True
+        )
+
+    has_more = len(rows) > page_length
+    rows = rows[:page_length]
+
+    for row in rows:
+        row.snippet = snippet(row.message_text, terms)
+
+    return {"results": rows, "start": start, "has_more": has_more}
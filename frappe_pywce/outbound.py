@@ -0,0 +1,426 @@
+"""
+Rate limit aware outbound dispatch
+
+Meta throttles sends per business phone number (throughput) and per
+recipient (pair rate, roughly one message every 6 seconds with short
+bursts). Both limits are kept as token buckets in Redis so every web and
+background worker shares them:
+
+- phone bucket `fpw:tb:<phone_id>`: `rate` tokens / second up to `burst`
+- pair bucket `fpw:tb:<phone_id>:<recipient>`: `pair_rate` / second up to `pair_burst`
+
+A single Lua script refills and takes from both buckets atomically.
+
+Two priority lanes share the phone bucket. Interactive replies may use the
+whole bucket, bulk sends only when more than `bulk_reserve` of the burst is
+left, so replies to users always have headroom.
+
+Synchronous senders (chatbot replies) call `throttle` before each send.
+Bulk / broadcast style sends go through `enqueue_send` and are drained by
+`bench pywce-outbound-worker`, which dispatches interactive entries first
+and parks pair-limited entries in a delay set instead of blocking the lane.
+
+The delay set is a sorted set scored by due time, `schedule` adds entries
+to it directly for sends that must wait (see frappe_pywce.delayed_send).
+
+A running worker keeps a heartbeat key alive. Without one, `ensure_dispatch`
+enqueues a short-lived `dispatch_due` RQ job that drains the queue and the
+delay set, and the `flush_overdue` scheduler job picks up anything left.
+"""
+
+import json
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import frappe
+from frappe.utils.background_jobs import get_redis_conn
+
+from frappe_pywce.util import CACHE_KEY_PREFIX
+from frappe_pywce.pywce_logger import app_logger as logger
+
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+LANES = (LANE_INTERACTIVE, LANE_BULK)
+
+# Meta defaults: 80 messages / second per phone number, 1 message / 6 s per recipient
+DEFAULT_RATE = 80
+DEFAULT_BURST = 80
+DEFAULT_PAIR_RATE = 1 / 6
+DEFAULT_PAIR_BURST = 10
+DEFAULT_BULK_RESERVE = 0.2
+
+BUCKET_TTL_IN_SEC = 3600
+MAX_THROTTLE_WAIT_IN_SEC = 10
+# request path sends (web requests, short queue jobs) may only wait this long
+REQUEST_THROTTLE_WAIT_IN_SEC = 1
+PROMOTE_BATCH = 100
+
+OVERDUE_GRACE_IN_SEC = 30
+OVERDUE_FLUSH_LIMIT = 500
+
+HEARTBEAT_INTERVAL_IN_SEC = 5
+HEARTBEAT_TTL_IN_SEC = 15
+
+# the fallback job leaves well within the short queue timeout
+FALLBACK_RUN_LIMIT_IN_SEC = 240
+
+WAIT_NONE = 0
+WAIT_PHONE = 1
+WAIT_PAIR = 2
+
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local rate, burst, reserve = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local pair_rate, pair_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local ttl = tonumber(ARGV[6])
+
+local function refill(key, r, b)
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens, ts = tonumber(data[1]), tonumber(data[2])
+    if tokens == nil then
+        return b
+    end
+    return math.min(b, tokens + math.max(0, now - ts) * r)
+end
+
+local tokens = refill(KEYS[1], rate, burst)
+local pair_tokens = refill(KEYS[2], pair_rate, pair_burst)
+
+local wait, reason = 0, 0
+local need = 1 + reserve
+
+if pair_tokens < 1 then
+    wait, reason = (1 - pair_tokens) / pair_rate, 2
+end
+
+if tokens < need and (need - tokens) / rate > wait then
+    wait, reason = (need - tokens) / rate, 1
+end
+
+if reason == 0 then
+    tokens = tokens - 1
+    pair_tokens = pair_tokens - 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('HSET', KEYS[2], 'tokens', pair_tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[2], ttl)
+
+return {tostring(wait), reason}
+"""
+
+
+def _conf(key: str, default):
+    conf = getattr(frappe.local, "conf", None) or {}
+    return float(conf.get(key) or default)
+
+
+class RateLimiter:
+    """Shared phone + pair token buckets, see module docstring"""
+
+    def __init__(
+        self,
+        conn=None,
+        rate: float = None,
+        burst: float = None,
+        pair_rate: float = None,
+        pair_burst: float = None,
+        bulk_reserve: float = None
+    ):
+        self.conn = conn or get_redis_conn()
+        self.rate = rate or _conf("whatsapp_send_rate", DEFAULT_RATE)
+        self.burst = burst or _conf("whatsapp_send_burst", DEFAULT_BURST)
+        self.pair_rate = pair_rate or _conf("whatsapp_pair_rate", DEFAULT_PAIR_RATE)
+        self.pair_burst = pair_burst or _conf("whatsapp_pair_burst", DEFAULT_PAIR_BURST)
+        self.bulk_reserve = DEFAULT_BULK_RESERVE if bulk_reserve is None else bulk_reserve
+        self._script = self.conn.register_script(_ACQUIRE_SCRIPT)
+
+    def try_acquire(self, phone_id: str, recipient: str, lane: str = LANE_INTERACTIVE) -> Tuple[float, int]:
+        """
+        Take one token from both buckets if available.
+
+        Returns:
+            (0, WAIT_NONE) when granted, else (seconds to wait, WAIT_PHONE | WAIT_PAIR)
+        """
+        reserve = self.bulk_reserve * self.burst if lane == LANE_BULK else 0
+        key = f"{CACHE_KEY_PREFIX}tb:{phone_id}"
+
+        wait, reason = self._script(
+            keys=[key, f"{key}:{recipient}"],
+            args=[self.rate, self.burst, reserve, self.pair_rate, self.pair_burst, BUCKET_TTL_IN_SEC]
+        )
+
+        return float(wait), int(reason)
+
+    def acquire(self, phone_id: str, recipient: str, lane: str = LANE_INTERACTIVE,
+                max_wait: float = MAX_THROTTLE_WAIT_IN_SEC) -> bool:
+        """Block until a token is granted, False when it would take longer than max_wait"""
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            wait, _ = self.try_acquire(phone_id, recipient, lane)
+
+            if wait <= 0:
+                return True
+
+            if time.monotonic() + wait > deadline:
+                return False
+
+            time.sleep(wait)
+
+
+class SendThrottledError(Exception):
+    """A synchronous send would have to wait longer than REQUEST_THROTTLE_WAIT_IN_SEC for capacity"""
+
+
+def throttle(phone_id: str, recipient: str, lane: str = LANE_INTERACTIVE,
+             max_wait: float = REQUEST_THROTTLE_WAIT_IN_SEC) -> None:
+    """
+    Wait briefly for send capacity before a synchronous send.
+
+    Raises SendThrottledError instead of blocking the request or job, callers
+    queue the send with `enqueue_send` or report the error.
+    """
+    try:
+        granted = RateLimiter().acquire(phone_id, recipient, lane, max_wait=max_wait)
+
+    except Exception:
+        logger.warning("Rate limiter unavailable, sending unthrottled", exc_info=True)
+        return
+
+    if not granted:
+        raise SendThrottledError(f"Send to {recipient} exceeds WhatsApp rate limits, try again shortly")
+
+
+class OutboundDispatcher:
+    """
+    Redis backed outbound queue with priority lanes.
+
+    `sender(entry)` performs the actual send, entry is the dict given to
+    `enqueue` plus `phone_id`, `lane` and `enqueued_at`.
+    """
+
+    def __init__(self, sender: Callable[[Dict], None], conn=None, limiter: RateLimiter = None, site: str = None):
+        self.sender = sender
+        self.conn = conn or get_redis_conn()
+        self.limiter = limiter or RateLimiter(conn=self.conn)
+        self.site = site or frappe.local.site
+        self.stats = {"sent": 0, "failed": 0, "deferred": 0, "throttled": 0}
+
+    def _lane_key(self, lane: str) -> str:
+        return f"{CACHE_KEY_PREFIX}out:{self.site}:{lane}"
+
+    def _delayed_key(self) -> str:
+        return f"{CACHE_KEY_PREFIX}out:{self.site}:delayed"
+
+    def _heartbeat_key(self) -> str:
+        return f"{CACHE_KEY_PREFIX}out:{self.site}:worker"
+
+    def worker_alive(self) -> bool:
+        """True while a `bench pywce-outbound-worker` of the site is running"""
+        return bool(self.conn.exists(self._heartbeat_key()))
+
+    def _entry(self, phone_id: str, payload: dict, lane: str, **extra) -> str:
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane {lane}")
+
+        entry = {**extra, "phone_id": phone_id, "payload": payload, "lane": lane, "enqueued_at": time.time()}
+        return json.dumps(entry)
+
+    def enqueue(self, phone_id: str, payload: dict, lane: str = LANE_BULK, **extra) -> None:
+        self.conn.rpush(self._lane_key(lane), self._entry(phone_id, payload, lane, **extra))
+
+    def schedule(self, phone_id: str, payload: dict, due: float, lane: str = LANE_INTERACTIVE, **extra) -> None:
+        """Queue an entry that is dispatched once `due` (epoch seconds) has passed"""
+        self.conn.zadd(self._delayed_key(), {self._entry(phone_id, payload, lane, due=due, **extra): due})
+
+    def depth(self) -> Dict[str, int]:
+        depth = {lane: self.conn.llen(self._lane_key(lane)) for lane in LANES}
+        depth["delayed"] = self.conn.zcard(self._delayed_key())
+        return depth
+
+    def _promote_due(self) -> None:
+        """Move pair-limited entries whose wait is over back to the head of their lane"""
+        due = self.conn.zrangebyscore(self._delayed_key(), "-inf", time.time(), start=0, num=PROMOTE_BATCH)
+
+        # pushed to the head in reverse so the earliest due entry is dispatched first
+        for raw in reversed(due):
+            if self.conn.zrem(self._delayed_key(), raw):
+                self.conn.lpush(self._lane_key(json.loads(raw)["lane"]), raw)
+
+    def _pop(self, block_s: Optional[int]) -> Optional[bytes]:
+        keys = [self._lane_key(lane) for lane in LANES]
+
+        if block_s:
+            # BLPOP checks keys in order, interactive always wins
+            popped = self.conn.blpop(keys, timeout=block_s)
+            return popped[1] if popped else None
+
+        for key in keys:
+            raw = self.conn.lpop(key)
+            if raw is not None:
+                return raw
+
+        return None
+
+    def dispatch_once(self, block_s: Optional[int] = None) -> bool:
+        """Dispatch at most one entry, returns False when there was nothing to do"""
+        self._promote_due()
+
+        raw = self._pop(block_s)
+        if raw is None:
+            return False
+
+        entry = json.loads(raw)
+        recipient = entry["payload"].get("to", "")
+
+        wait, reason = self.limiter.try_acquire(entry["phone_id"], recipient, entry["lane"])
+
+        if reason == WAIT_PAIR:
+            # only this recipient is limited, keep the lane moving
+            self.conn.zadd(self._delayed_key(), {raw: time.time() + wait})
+            self.stats["deferred"] += 1
+            return True
+
+        if reason == WAIT_PHONE:
+            self.conn.lpush(self._lane_key(entry["lane"]), raw)
+            self.stats["throttled"] += 1
+            time.sleep(wait)
+            return True
+
+        try:
+            self.sender(entry)
+            self.stats["sent"] += 1
+
+        except Exception:
+            self.stats["failed"] += 1
+            logger.error("Outbound send to %s failed", recipient, exc_info=True)
+
+        return True
+
+    def run(self, burst: bool = False, block_s: int = 1, max_s: Optional[float] = None) -> None:
+        """
+        Dispatch until stopped, `burst` returns once the lanes and the delay
+        set are empty, `max_s` after that many seconds at the latest.
+
+        Only a long running worker keeps the heartbeat alive.
+        """
+        deadline = time.monotonic() + max_s if max_s else None
+        last_beat = None
+
+        try:
+            while True:
+                if not burst and (last_beat is None or time.monotonic() - last_beat >= HEARTBEAT_INTERVAL_IN_SEC):
+                    self.conn.set(self._heartbeat_key(), 1, ex=HEARTBEAT_TTL_IN_SEC)
+                    last_beat = time.monotonic()
+
+                worked = self.dispatch_once(block_s=None if burst else block_s)
+
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+
+                if burst and not worked:
+                    if not self.conn.zcard(self._delayed_key()):
+                        return
+
+                    time.sleep(0.1)
+
+        finally:
+            if last_beat is not None:
+                # hand over to the fallback job right away instead of after the TTL
+                self.conn.delete(self._heartbeat_key())
+
+    def flush_overdue(self, grace_s: float = OVERDUE_GRACE_IN_SEC, limit: int = OVERDUE_FLUSH_LIMIT) -> int:
+        """Dispatch queued entries when the oldest delayed one is overdue by more than grace_s, i.e. no worker runs"""
+        oldest = self.conn.zrange(self._delayed_key(), 0, 0, withscores=True)
+
+        if not oldest or oldest[0][1] > time.time() - grace_s:
+            return 0
+
+        dispatched = 0
+        while dispatched < limit and self.dispatch_once():
+            dispatched += 1
+
+        logger.warning("Outbound worker is not running, dispatched %s overdue entries", dispatched)
+
+        return dispatched
+
+
+def _send_entry(entry: Dict) -> None:
+    from frappe_pywce.graph_client import get_graph_client
+
+    config = frappe.get_cached_doc("ChatBot Config")
+
+    try:
+        if entry.get("url"):
+            # sends captured from a client pointed at the emulator, it needs no token
+            response = get_graph_client().post(entry["url"], json=entry["payload"])
+            response.raise_for_status()
+            result = response.json()
+        else:
+            result = get_graph_client().send_message(entry["phone_id"], config.access_token, entry["payload"])
+
+    except Exception as e:
+        if entry.get("on_failed"):
+            frappe.get_attr(entry["on_failed"])(entry, e)
+        raise
+
+    if entry.get("on_sent"):
+        frappe.get_attr(entry["on_sent"])(entry, result)
+
+
+def get_dispatcher() -> OutboundDispatcher:
+    return OutboundDispatcher(_send_entry)
+
+
+def ensure_dispatch(dispatcher: OutboundDispatcher = None) -> None:
+    """Enqueue the short-lived `dispatch_due` job when no outbound worker is running"""
+    dispatcher = dispatcher or get_dispatcher()
+
+    if dispatcher.worker_alive():
+        return
+
+    frappe.enqueue(
+        "frappe_pywce.outbound.dispatch_due",
+        queue="short",
+        deduplicate=True,
+        job_id=f"{CACHE_KEY_PREFIX}outbound_dispatch:{dispatcher.site}",
+        enqueue_after_commit=True
+    )
+
+
+def enqueue_send(payload: dict, lane: str = LANE_BULK, on_sent: str = None, on_failed: str = None, **extra) -> None:
+    """
+    Queue a Graph message payload for the outbound worker.
+
+    Args:
+        payload: Graph API message payload, `to` is the recipient
+        lane: LANE_BULK or LANE_INTERACTIVE
+        on_sent: optional dotted path called as `on_sent(entry, graph_response)`
+        on_failed: optional dotted path called as `on_failed(entry, exception)`
+    """
+    config = frappe.get_cached_doc("ChatBot Config")
+    dispatcher = get_dispatcher()
+
+    dispatcher.enqueue(config.phone_id, payload, lane=lane, on_sent=on_sent, on_failed=on_failed, **extra)
+    ensure_dispatch(dispatcher)
+
+
+def run_worker(burst: bool = False) -> None:
+    get_dispatcher().run(burst=burst)
+
+
+def dispatch_due() -> None:
+    """Stand-in for `bench pywce-outbound-worker`, enqueued by `ensure_dispatch`"""
+    get_dispatcher().run(burst=True, max_s=FALLBACK_RUN_LIMIT_IN_SEC)
+
+
+def flush_overdue() -> None:
+    """Scheduler fallback for entries the worker or the `dispatch_due` job left behind"""
+    dispatcher = get_dispatcher()
+
+    # without a worker nothing else dispatches them, no reason to wait out the grace period
+    dispatcher.flush_overdue(grace_s=OVERDUE_GRACE_IN_SEC if dispatcher.worker_alive() else 0)
@@ -0,0 +1,6 @@
+from frappe_pywce.frappe_pywce.doctype.whatsapp_chat_message.whatsapp_chat_message import add_indexes
+
+
+def execute():
+    """Composite indexes for the phone_number / direction / timestamp and unread queries"""
+    add_indexes()
@@ -0,0 +1,6 @@
+from frappe_pywce.message_search import add_fulltext_index
+
+
+def execute():
+    """FULLTEXT index on WhatsApp Chat Message.message_text for the chat console search"""
+    add_fulltext_index()
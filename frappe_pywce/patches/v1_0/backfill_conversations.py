@@ -0,0 +1,6 @@
+from frappe_pywce.conversation_summary import enqueue_backfill
+
+
+def execute():
+    """Build the WhatsApp Conversation summaries of existing chat messages in a background job"""
+    enqueue_backfill()
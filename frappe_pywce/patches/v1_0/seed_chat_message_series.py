@@ -0,0 +1,22 @@
+import frappe
+
+from frappe_pywce.persistence import CHAT_MESSAGE_SERIES
+
+
+def execute():
+    """WhatsApp Chat Message now names from the `WCHAT-` series, continue after the highest existing name"""
+    last = frappe.db.sql(
+        """
+        SELECT MAX(CAST(SUBSTRING(`name`, %s) AS UNSIGNED))
+        FROM `tabWhatsApp Chat Message`
+        WHERE `name` LIKE %s
+        """,
+        (len(CHAT_MESSAGE_SERIES) + 1, f"{CHAT_MESSAGE_SERIES}%"),
+    )[0][0] or 0
+
+    current = frappe.db.get_value("Series", CHAT_MESSAGE_SERIES, "current", order_by="name")
+
+    if current is None:
+        frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (CHAT_MESSAGE_SERIES, last))
+    elif int(current) < last:
+        frappe.db.sql("UPDATE `tabSeries` SET `current` = %s WHERE `name` = %s", (last, CHAT_MESSAGE_SERIES))
@@ -0,0 +1,324 @@
+"""
+Batched persistence of webhook payloads
+
+Meta batches many messages and statuses into one webhook payload under load.
+Everything in a payload is written in a single transaction:
+
+1. one `IN (...)` query to drop message ids we already stored
+2. one multi-row INSERT for the new incoming messages
+3. one upsert of the affected `WhatsApp Conversation` summaries
+4. one `CASE` based UPDATE for all status changes
+5. a single commit
+
+The media of the new messages is prefetched into the media cache after the
+commit.
+"""
+
+from datetime import datetime
+import json
+from typing import Dict, List, Sequence, Tuple
+
+import frappe
+import frappe.utils
+
+from frappe_pywce import tracing
+from frappe_pywce.conversation_summary import record_messages
+from frappe_pywce.media_cache import enqueue_prefetch
+from frappe_pywce.pywce_logger import app_logger as logger
+
+CHAT_MESSAGE_DOCTYPE = "WhatsApp Chat Message"
+CHAT_MESSAGE_SERIES = "WCHAT-"
+CHAT_MESSAGE_SERIES_DIGITS = 5
+
+STATUS_MAP = {
+    'sent': 'sent',
+    'delivered': 'delivered',
+    'read': 'read',
+    'failed': 'failed'
+}
+
+INCOMING_FIELDS = (
+    "phone_number", "message_id", "timestamp", "direction", "message_type",
+    "message_text", "media_url", "media_type", "contact_name", "status", "metadata"
+)
+
+
+def normalize_phone(phone: str) -> str:
+    return ''.join(filter(str.isdigit, str(phone or '')))
+
+
+def get_message_content(message: dict) -> Tuple[str, str, str]:
+    """Get (message_text, media_url, media_type) from a webhook message based on its type"""
+    message_type = message.get('type', 'text')
+
+    message_text = ''
+    media_url = None
+    media_type = None
+
+    if message_type == 'text':
+        message_text = message.get('text', {}).get('body', '')
+
+    elif message_type in ('image', 'video'):
+        media_data = message.get(message_type, {})
+        message_text = media_data.get('caption', '')
+        media_url = media_data.get('id', '')
+        media_type = message_type
+
+    elif message_type == 'audio':
+        audio_data = message.get('audio', {})
+        media_url = audio_data.get('id', '')
+        media_type = 'audio'
+        message_text = f"Audio message ({audio_data.get('mime_type', 'audio')})"
+
+    elif message_type == 'voice':
+        voice_data = message.get('voice', {})
+        media_url = voice_data.get('id', '')
+        media_type = 'voice'
+        message_text = "Voice message"
+
+    elif message_type == 'document':
+        doc_data = message.get('document', {})
+        message_text = doc_data.get('filename', 'Document')
+        media_url = doc_data.get('id', '')
+        media_type = 'document'
+
+    elif message_type == 'sticker':
+        sticker_data = message.get('sticker', {})
+        media_url = sticker_data.get('id', '')
+        media_type = 'sticker'
+        message_text = "Sticker"
+
+    elif message_type == 'location':
+        location_data = message.get('location', {})
+        message_text = f"Location: {location_data.get('name', 'Shared location')}"
+
+    elif message_type == 'contacts':
+        contacts_data = message.get('contacts', [])
+        if contacts_data:
+            contact = contacts_data[0]
+            name = contact.get('name', {}).get('formatted_name', 'Contact')
+            message_text = f"Contact: {name}"
+
+    elif message_type == 'button':
+        button_data = message.get('button', {})
+        message_text = f"Button: {button_data.get('text', 'Button clicked')}"
+
+    elif message_type == 'interactive':
+        interactive_data = message.get('interactive', {})
+        interactive_type = interactive_data.get('type', '')
+
+        if interactive_type == 'button_reply':
+            button_reply = interactive_data.get('button_reply', {})
+            message_text = f"Button: {button_reply.get('title', 'Button clicked')}"
+        elif interactive_type == 'list_reply':
+            list_reply = interactive_data.get('list_reply', {})
+            message_text = f"Selected: {list_reply.get('title', 'List item')}"
+        else:
+            message_text = "Interactive message"
+
+    else:
+        message_text = f"Unsupported message type: {message_type}"
+
+    return message_text, media_url, media_type
+
+
+def collect_payload(payload: dict) -> Tuple[List[Dict], Dict[str, str]]:
+    """
+    Collect every incoming message and status update of a webhook payload.
+
+    Returns:
+        (incoming message rows, {message_id: mapped status}) where a later
+        status for the same message id wins, like applying them in order.
+    """
+    messages: List[Dict] = []
+    statuses: Dict[str, str] = {}
+
+    for entry in payload.get('entry', []) or []:
+        for change in entry.get('changes', []):
+            value = change.get('value', {})
+
+            contact_names = {
+                normalize_phone(contact.get('wa_id', '')): contact.get('profile', {}).get('name', '')
+                for contact in value.get('contacts', [])
+            }
+
+            for message in value.get('messages', []):
+                phone_number = normalize_phone(message.get('from', ''))
+                timestamp = message.get('timestamp')
+                message_text, media_url, media_type = get_message_content(message)
+
+                messages.append({
+                    "phone_number": phone_number,
+                    "message_id": message.get('id', ''),
+                    "timestamp": datetime.fromtimestamp(int(timestamp)) if timestamp else datetime.now(),
+                    "direction": "Incoming",
+                    "message_type": message.get('type', 'text'),
+                    "message_text": message_text,
+                    "media_url": media_url,
+                    "media_type": media_type,
+                    "contact_name": contact_names.get(phone_number, ''),
+                    "status": "delivered",
+                    "metadata": json.dumps(message)
+                })
+
+            for status in value.get('statuses', []):
+                statuses[status.get('id', '')] = STATUS_MAP.get(status.get('status', ''), 'sent')
+
+    return messages, statuses
+
+
+def reserve_names(count: int) -> List[str]:
+    """Reserve `count` consecutive WhatsApp Chat Message names from the naming series in one upsert"""
+    if count <= 0:
+        return []
+
+    # one statement creates the series row or bumps it under its row lock, concurrent
+    # webhook workers (the very first ones included) never reserve the same block
+    frappe.db.sql(
+        """
+        INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE `current` = `current` + %s
+        """,
+        (CHAT_MESSAGE_SERIES, count, count)
+    )
+
+    # the row stays locked by this transaction, the read sees our own increment
+    last = frappe.utils.cint(
+        frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name` = %s", (CHAT_MESSAGE_SERIES,))[0][0]
+    )
+
+    first = last - count + 1
+    return [f"{CHAT_MESSAGE_SERIES}{n:0{CHAT_MESSAGE_SERIES_DIGITS}d}" for n in range(first, last + 1)]
+
+
+def bulk_insert_messages(rows: List[Dict], fields: Sequence[str]) -> List[Dict]:
+    """
+    Multi-row insert of WhatsApp Chat Message rows, `fields` are the row keys to write.
+
+    Rows whose message_id is already stored (e.g. a concurrent redelivery) are skipped,
+    returns the rows actually inserted.
+    """
+    if not rows:
+        return []
+
+    now = frappe.utils.now()
+    user = frappe.session.user
+    names = reserve_names(len(rows))
+
+    values = [
+        (name, now, now, user, user, 0, *(row.get(f) for f in fields))
+        for name, row in zip(names, rows)
+    ]
+
+    frappe.db.bulk_insert(
+        CHAT_MESSAGE_DOCTYPE,
+        fields=["name", "creation", "modified", "owner", "modified_by", "docstatus", *fields],
+        values=values,
+        ignore_duplicates=True
+    )
+
+    # reserved names are unique, a missing one is a row dropped on the message_id index
+    stored = set(frappe.get_all(CHAT_MESSAGE_DOCTYPE, filters={"name": ["in", names]}, pluck="name"))
+    inserted = [row for name, row in zip(names, rows) if name in stored]
+
+    # bulk inserts skip doc events, the conversation summaries are updated here
+    record_messages(inserted)
+    return inserted
+
+
+def _insert_messages(messages: List[Dict]) -> List[Dict]:
+    """Multi-row insert of the messages not stored yet, returns the inserted rows"""
+    message_ids = {m["message_id"] for m in messages if m["message_id"]}
+
+    existing = set(frappe.get_all(
+        CHAT_MESSAGE_DOCTYPE,
+        filters={"message_id": ["in", list(message_ids)]},
+        pluck="message_id"
+    )) if message_ids else set()
+
+    new_messages = []
+    seen = set()
+
+    for message in messages:
+        message_id = message["message_id"]
+        if message_id in existing or message_id in seen:
+            continue
+
+        seen.add(message_id)
+        new_messages.append(message)
+
+    if not new_messages:
+        return []
+
+    return bulk_insert_messages(new_messages, INCOMING_FIELDS)
+
+
+def _update_statuses(statuses: Dict[str, str]) -> None:
+    """Apply all status changes in a single CASE based UPDATE"""
+    statuses = {message_id: status for message_id, status in statuses.items() if message_id}
+
+    if not statuses:
+        return
+
+    cases = " ".join(["WHEN %s THEN %s"] * len(statuses))
+    placeholders = ", ".join(["%s"] * len(statuses))
+
+    params = []
+    for message_id, status in statuses.items():
+        params.extend((message_id, status))
+
+    frappe.db.sql(
+        f"""
+        UPDATE `tabWhatsApp Chat Message`
+        SET `status` = CASE `message_id` {cases} ELSE `status` END,
+            `modified` = %s
+        WHERE `message_id` IN ({placeholders})
+        """,
+        (*params, frappe.utils.now(), *statuses.keys())
+    )
+
+
+def save_webhook_payload(payload: dict) -> Tuple[int, int]:
+    """
+    Persist all incoming messages and status updates of a webhook payload
+    in one transaction.
+
+    Returns:
+        (number of inserted messages, number of status updates)
+    """
+    try:
+        if not payload.get('entry'):
+            return 0, 0
+
+        messages, statuses = collect_payload(payload)
+
+        with tracing.span("insert_messages"):
+            inserted = _insert_messages(messages) if messages else []
+
+        with tracing.span("update_statuses"):
+            _update_statuses(statuses)
+
+        for message in inserted:
+            # Publish realtime event for chat interface
+            frappe.publish_realtime(
+                event='whatsapp_message_received',
+                message={
+                    'phone_number': message["phone_number"],
+                    'message_id': message["message_id"],
+                    'message_text': message["message_text"]
+                },
+                after_commit=True
+            )
+
+        enqueue_prefetch(message["media_url"] for message in inserted)
+
+        frappe.db.commit()
+
+        logger.info("Saved %s incoming messages and %s status updates", len(inserted), len(statuses))
+        return len(inserted), len(statuses)
+
+    except Exception as e:
+        frappe.db.rollback()
+        logger.error("Error saving webhook payload: %s", e)
+        frappe.log_error(title="WhatsApp Chat Message Save Error", message=str(e))
+        return 0, 0
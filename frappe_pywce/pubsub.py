@@ -0,0 +1,76 @@
+"""
+Process-local Redis pub/sub fan-out.
+
+Each worker process lazily starts one daemon thread subscribed to a single
+channel. Messages carry the originating site and a topic, and are dispatched
+to the handlers registered for that topic in this process.
+
+Used to drop in-process caches (compiled engine, global session data) across
+all web and background workers when the underlying documents change.
+"""
+
+import json
+import threading
+from typing import Callable, Dict, List, Optional
+
+import frappe
+
+from frappe_pywce.pywce_logger import app_logger as logger
+
+PUBSUB_CHANNEL = "fpw:pubsub"
+
+_handlers: Dict[str, List[Callable[[str, dict], None]]] = {}
+_listener = None
+_lock = threading.Lock()
+
+
+def _dispatch(message: dict) -> None:
+    try:
+        event = json.loads(message.get("data"))
+    except (TypeError, ValueError):
+        return
+
+    for handler in list(_handlers.get(event.get("topic"), [])):
+        try:
+            handler(event.get("site"), event.get("data") or {})
+        except Exception:
+            logger.error("PubSub handler failed for topic %s", event.get("topic"), exc_info=True)
+
+
+def _ensure_listener() -> None:
+    global _listener
+
+    if _listener is not None and _listener.is_alive():
+        return
+
+    pubsub = frappe.cache.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{PUBSUB_CHANNEL: _dispatch})
+    _listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def subscribe(topic: str, handler: Callable[[str, dict], None]) -> None:
+    """Register `handler(site, data)` for `topic` and make sure the listener is running.
+
+    Failing to reach Redis is not fatal, callers are expected to have a
+    staleness check of their own.
+    """
+    with _lock:
+        topic_handlers = _handlers.setdefault(topic, [])
+        if handler not in topic_handlers:
+            topic_handlers.append(handler)
+
+        try:
+            _ensure_listener()
+        except Exception:
+            logger.warning("Could not start pubsub listener", exc_info=True)
+
+
+def publish(topic: str, data: Optional[dict] = None) -> None:
+    """Broadcast `topic` for the current site to every subscribed worker process."""
+    try:
+        frappe.cache.publish(
+            PUBSUB_CHANNEL,
+            json.dumps({"site": frappe.local.site, "topic": topic, "data": data or {}})
+        )
+    except Exception:
+        logger.warning("Could not publish %s invalidation", topic, exc_info=True)
@@ -1,33 +1,242 @@
-import frappe
-import frappe.utils.logger
+"""
+Logging for frappe_pywce and the pywce library
+
+- records are handed to a QueueHandler and written by a QueueListener thread,
+  so file I/O never runs on the webhook path
+- the level is per site: `pywce_log_level` in site config (default INFO).
+  `app_logger` checks it before a message is formatted, the queue handler
+  applies it to pywce's own records too
+- call sites pass `%` args, never pre-formatted strings, and may add
+  structured fields as keyword arguments, written as ` key=value`:
+
+      app_logger.info("Sent %s", template_name, wa_id=wa_id)
+
+- high volume events can be sampled, `pywce_log_sampling` maps an event
+  name to the fraction of records kept:
+
+      app_logger.sample("webhook.queued").debug("Queued webhook %s", wa_id)
+
+- a forked RQ work horse leaves with os._exit, atexit never runs there.
+  `flush` runs as an `after_job` hook and writes out what the job queued
+"""
+
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+import frappe
+
+LOG_LEVEL_CONF_KEY = "pywce_log_level"
+LOG_SAMPLING_CONF_KEY = "pywce_log_sampling"
+DEFAULT_LOG_LEVEL = logging.INFO
+
+LOG_QUEUE_SIZE = 10000
+
+_RESERVED_KWARGS = {"exc_info", "stack_info", "stacklevel", "extra"}
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+_queue = queue.Queue(LOG_QUEUE_SIZE)
+
+
+def _conf() -> dict:
+    return getattr(frappe.local, "conf", None) or {}
+
+
+def get_site_level() -> int:
+    """Level configured for the current site, DEFAULT_LOG_LEVEL outside a site"""
+    level = _conf().get(LOG_LEVEL_CONF_KEY)
+
+    if level is None:
+        return DEFAULT_LOG_LEVEL
+
+    if isinstance(level, int):
+        return level
+
+    # getLevelName maps a known name to its number
+    level = logging.getLevelName(str(level).upper())
+    return level if isinstance(level, int) else DEFAULT_LOG_LEVEL
+
+
+class SiteLevelFilter(logging.Filter):
+    """Drops records below the site level and tags the rest with the site"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < get_site_level():
+            return False
+
+        if not hasattr(record, "site"):
+            record.site = getattr(frappe.local, "site", None) or "-"
+
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """`<time> <level> <logger> [<site>] <message> key=value ...`"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(site)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "site"):
+            record.site = "-"
+
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+
+        return line
+
+
+class _ForkSafeQueueHandler(logging.handlers.QueueHandler):
+    """Restarts the listener in forked workers, threads do not survive a fork"""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if _listener_pid != os.getpid():
+            _start_listener()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # never block the request on logging
+            pass
+
+
+class PywceLogger(logging.LoggerAdapter):
+    """Site level aware adapter, extra keyword arguments become structured fields"""
+
+    def isEnabledFor(self, level: int) -> bool:
+        return level >= get_site_level()
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _RESERVED_KWARGS}
+
+        if fields:
+            extra = dict(kwargs.get("extra") or {})
+            extra["fields"] = fields
+            kwargs["extra"] = extra
+
+        return msg, kwargs
+
+    def sample(self, event: str, rate: float = None) -> logging.LoggerAdapter:
+        """This logger for a `rate` fraction of calls (site `pywce_log_sampling[event]`), else a no-op logger"""
+        if rate is None:
+            rate = (_conf().get(LOG_SAMPLING_CONF_KEY) or {}).get(event, 1)
+
+        if rate >= 1 or random.random() < rate:
+            return self
+
+        return _DROPPED
+
+
+class _DroppedLogger(PywceLogger):
+    def isEnabledFor(self, level: int) -> bool:
+        return False
+
+
+_handlers = []
+
+
+def _start_listener() -> None:
+    global _listener, _listener_pid
+
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+
+        _listener = logging.handlers.QueueListener(_queue, *_handlers, respect_handler_level=True)
+        _listener.start()
+        _listener_pid = os.getpid()
+
+
+def _stop_listener() -> None:
+    global _listener, _listener_pid
+
+    with _listener_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            # stop() drains the queue before the thread exits
+            _listener.stop()
+
+        _listener = None
+        _listener_pid = None
+
+
+def flush(**kwargs) -> None:
+    """Writes out queued records, the next record starts a new listener. Runs after every job"""
+    _stop_listener()
+
+
+def _reset_after_fork() -> None:
+    global _listener, _listener_pid, _listener_lock
+
+    # the parent's thread and its lock state did not come along, nor should its queued records
+    _listener = None
+    _listener_pid = None
+    _listener_lock = threading.Lock()
+    _queue.__init__(LOG_QUEUE_SIZE)
+
+
+atexit.register(_stop_listener)
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _queue_handler() -> logging.Handler:
+    handler = _ForkSafeQueueHandler(_queue)
+    handler.addFilter(SiteLevelFilter())
+    return handler
+
 
 def setup_pywce_logging_for_frappe():
     """
     Integrates pywce's logging into Frappe's logging system.
     This function should be called once when your Frappe app starts up.
+
+    pywce records go through the same queue, level filter and files as ours.
     """
     pywce_root_logger = logging.getLogger('pywce')
-    frappe_logger = frappe.logger()
-    pywce_root_logger.setLevel(logging.DEBUG)
 
-    has_console_handler = any(isinstance(h, logging.StreamHandler) and h.stream.name == '<stderr>' for h in pywce_root_logger.handlers)
-    if not has_console_handler:
-        frappe_console_handler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
-        frappe_console_handler.setFormatter(formatter)
-        pywce_root_logger.addHandler(frappe_console_handler)
+    if any(isinstance(h, _ForkSafeQueueHandler) for h in pywce_root_logger.handlers):
+        return
 
-        for handler in frappe_logger.handlers:
-            pywce_root_logger.addHandler(handler)
-
-    frappe_logger.addHandler(pywce_root_logger.handlers[0])
+    pywce_root_logger.setLevel(logging.DEBUG)
+    pywce_root_logger.propagate = False
+    pywce_root_logger.addHandler(_queue_handler())
 
 
 def _get_logger():
-    frappe.utils.logger.set_log_level("DEBUG")
+    # frappe.logger adds the app and site file handlers, they move behind the queue
     logger = frappe.logger("frappe_pywce", allow_site=True)
 
-    return logger
+    for handler in list(logger.handlers):
+        if isinstance(handler, _ForkSafeQueueHandler):
+            continue
+
+        handler.setFormatter(StructuredFormatter())
+        _handlers.append(handler)
+        logger.removeHandler(handler)
+
+    if not _handlers:
+        stream = logging.StreamHandler()
+        stream.setFormatter(StructuredFormatter())
+        _handlers.append(stream)
+
+    if not any(isinstance(h, _ForkSafeQueueHandler) for h in logger.handlers):
+        logger.addHandler(_queue_handler())
+
+    # gating happens per site in PywceLogger / SiteLevelFilter
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    return PywceLogger(logger, {})
+
+
+_DROPPED = _DroppedLogger(logging.getLogger("frappe_pywce.dropped"), {})
 
-app_logger = _get_logger()
\ No newline at end of file
+app_logger = _get_logger()
@@ -7,12 +7,13 @@ This engine determines the appropriate response template based on:
 3. Trigger pattern matching for entry points
 """
 
-import re
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any
 
 import frappe
 
+from frappe_pywce.conversation_cursor import get_cursor, set_cursor
 from frappe_pywce.pywce_logger import app_logger as logger
+from frappe_pywce.routing_index import CompiledRoutingIndex
 
 
 class RoutingEngine:
@@ -29,16 +30,12 @@ class RoutingEngine:
             chatbot: The chatbot dict containing 'templates' list
         """
         self.chatbot = chatbot
-        self.templates = chatbot.get('templates', []) if chatbot else []
-        self._template_map = self._build_template_map()
-    
-    def _build_template_map(self) -> Dict[str, Dict]:
-        """Build a map of template_id -> template for quick lookup"""
-        return {t.get('id'): t for t in self.templates if t.get('id')}
+        self.index = CompiledRoutingIndex.for_chatbot(chatbot)
+        self.templates = self.index.templates
     
     def get_template_by_id(self, template_id: str) -> Optional[Dict]:
         """Get a template by its ID"""
-        return self._template_map.get(template_id)
+        return self.index.template_map.get(template_id)
     
     def find_response_template(self, phone_number: str, incoming_message: str) -> Optional[Dict]:
         """
@@ -77,8 +74,8 @@ class RoutingEngine:
                     connected_template_id = route_match.get('connectedTo')
                     connected_template = self.get_template_by_id(connected_template_id)
                     if connected_template:
-                        logger.info(
-                            f"Route match: '{incoming_text}' -> template '{connected_template.get('name', connected_template_id)}'"
+                        logger.debug(
+                            "Route match: '%s' -> template '%s'", incoming_text, connected_template.get('name', connected_template_id)
                         )
                         return connected_template
             
@@ -87,51 +84,41 @@ class RoutingEngine:
             if next_level:
                 level_template = self._find_template_by_message_level(next_level)
                 if level_template:
-                    logger.info(
-                        f"Level match: next_level '{next_level}' -> template '{level_template.get('name', level_template.get('id'))}'"
+                    logger.debug(
+                        "Level match: next_level '%s' -> template '%s'", next_level, level_template.get('name', level_template.get('id'))
                     )
                     return level_template
         
         # Step 4: Check trigger patterns for entry points (e.g., "hi", "start")
         trigger_template = self._find_template_by_trigger(incoming_text, incoming_message)
         if trigger_template:
-            logger.info(
-                f"Trigger match: '{incoming_text}' -> template '{trigger_template.get('name', trigger_template.get('id'))}'"
+            logger.debug(
+                "Trigger match: '%s' -> template '%s'", incoming_text, trigger_template.get('name', trigger_template.get('id'))
             )
             return trigger_template
         
         # Step 5: Find start template as last resort
         start_template = self._find_start_template()
         if start_template:
-            logger.info(f"No match found, using start template: '{start_template.get('name', start_template.get('id'))}'")
+            logger.debug("No match found, using start template: '%s'", start_template.get('name', start_template.get('id')))
             return start_template
         
-        logger.warning(f"No matching template found for message: '{incoming_text}' from {phone_number}")
+        logger.warning("No matching template found for message: '%s' from %s", incoming_text, phone_number)
         return None
     
     def _get_last_outgoing_message(self, phone_number: str) -> Optional[Dict]:
         """
-        Get the last outgoing message sent to this phone number.
+        Get the routing state of the last outgoing message sent to this phone number.
+        
+        Served from the Redis conversation cursor, SQL is only hit on a cache miss.
         
         Returns dict with: template_id, message_level, next_level
         """
         try:
-            last_message = frappe.get_all(
-                "WhatsApp Chat Message",
-                filters={
-                    "phone_number": phone_number,
-                    "direction": "Outgoing"
-                },
-                fields=["template_id", "message_level", "next_level"],
-                order_by="timestamp desc",
-                limit=1
-            )
-            
-            if last_message:
-                return last_message[0]
+            return get_cursor(phone_number)
                 
         except Exception as e:
-            logger.error(f"Error fetching last outgoing message: {str(e)}")
+            logger.error("Error fetching last outgoing message: %s", e)
         
         return None
     
@@ -139,7 +126,7 @@ class RoutingEngine:
         """
         Find a matching route in the template's routes.
         
-        First checks for exact match, then regex patterns.
+        First checks for exact / contained (non-regex) matches, then regex patterns.
         
         Args:
             template: The current template dict
@@ -148,71 +135,19 @@ class RoutingEngine:
         Returns:
             The matching route dict, or None
         """
-        routes = template.get('routes', [])
-        
-        # First pass: exact matches (non-regex)
-        for route in routes:
-            pattern = (route.get('pattern') or "").strip().lower()
-            is_regex = route.get('isRegex', False)
-            
-            if not is_regex:
-                # Exact match (case-insensitive)
-                if pattern == incoming_text:
-                    return route
-                # Partial match - pattern contained in input
-                if pattern and pattern in incoming_text:
-                    return route
-        
-        # Second pass: regex patterns
-        for route in routes:
-            pattern = route.get('pattern', '')
-            is_regex = route.get('isRegex', False)
-            
-            if is_regex and pattern:
-                try:
-                    if re.match(pattern, incoming_text, re.IGNORECASE):
-                        return route
-                except re.error as e:
-                    logger.warning(f"Invalid regex pattern '{pattern}': {e}")
-                    continue
-        
-        return None
+        return self.index.find_route(template, incoming_text)
     
     def _find_template_by_message_level(self, level: str) -> Optional[Dict]:
         """Find template where settings.message_level matches the given level"""
-        for template in self.templates:
-            settings = template.get('settings', {})
-            if settings.get('message_level') == level:
-                return template
-        return None
+        return self.index.find_by_level(level)
     
     def _find_template_by_trigger(self, incoming_text: str, original_message: str) -> Optional[Dict]:
         """Find template by trigger pattern in settings"""
-        for template in self.templates:
-            settings = template.get('settings', {})
-            trigger = settings.get('trigger', '')
-            
-            if not trigger:
-                continue
-            
-            try:
-                # Try regex match first
-                if re.match(trigger, original_message, re.IGNORECASE):
-                    return template
-            except re.error:
-                # Fallback to simple contains check
-                if trigger.lower() in incoming_text:
-                    return template
-        
-        return None
+        return self.index.find_by_trigger(incoming_text, original_message)
     
     def _find_start_template(self) -> Optional[Dict]:
         """Find the template marked as start (isStart: true)"""
-        for template in self.templates:
-            settings = template.get('settings', {})
-            if settings.get('isStart'):
-                return template
-        return None
+        return self.index.start_template
 
 
 def get_response_template(chatbot: Dict, phone_number: str, incoming_message: str) -> Optional[Dict]:
@@ -276,7 +211,7 @@ class TemplateSender:
         message_data = template.get('message', {})
         settings = template.get('settings', {})
         
-        logger.info(f"Sending template '{template_name}' (type: {template_type}) to {self.phone_number}")
+        logger.debug("Sending template '%s' (type: %s) to %s", template_name, template_type, self.phone_number)
         
         try:
             # Get the appropriate send function and call it
@@ -289,12 +224,12 @@ class TemplateSender:
                     message_id=response.get('message_id'),
                     message_text=self._extract_message_text(template_type, message_data)
                 )
-                logger.info(f"Successfully sent template '{template_name}' to {self.phone_number}")
+                logger.debug("Successfully sent template '%s' to %s", template_name, self.phone_number)
             
             return response
             
         except Exception as e:
-            logger.error(f"Error sending template '{template_name}': {str(e)}")
+            logger.error("Error sending template '%s': %s", template_name, e)
             frappe.log_error(
                 title=f"Template Send Error: {template_name}",
                 message=f"Phone: {self.phone_number}\nTemplate ID: {template_id}\nError: {str(e)}"
@@ -336,7 +271,7 @@ class TemplateSender:
         
         else:
             # Default to text message
-            logger.warning(f"Unknown template type '{template_type}', defaulting to text")
+            logger.warning("Unknown template type '%s', defaulting to text", template_type)
             return self._send_text(message_data)
     
     def _send_text(self, message_data: Any) -> Optional[Dict]:
@@ -479,10 +414,17 @@ class TemplateSender:
             message_doc.insert(ignore_permissions=True)
             frappe.db.commit()
             
-            logger.debug(f"Saved outgoing message {message_id} for template {template.get('id')}")
+            set_cursor(
+                self.phone_number,
+                template_id=template.get('id', ''),
+                message_level=settings.get('message_level', ''),
+                next_level=settings.get('next_level', '')
+            )
+            
+            logger.debug("Saved outgoing message %s for template %s", message_id, template.get('id'))
             
         except Exception as e:
-            logger.error(f"Failed to save outgoing message: {str(e)}")
+            logger.error("Failed to save outgoing message: %s", e)
             frappe.log_error(title="Save Outgoing Message Error", message=str(e))
 
 
@@ -0,0 +1,281 @@
+"""
+Precompiled routing index for the RoutingEngine
+
+Everything the RoutingEngine used to recompute on every message is built once
+per flow version:
+
+1. Per template routes: exact-match dict, Aho-Corasick automaton for the
+   "pattern contained in input" rule and one combined regex alternation
+2. Trigger patterns across all templates, compiled the same way
+3. message_level -> template dict and the start template
+
+Lookups keep the original first-match semantics: the earliest route / template
+in flow order that matches wins.
+"""
+
+import re
+from typing import Optional, Dict, Any, List, Tuple
+
+from frappe_pywce.pywce_logger import app_logger as logger
+
+_NO_MATCH = float("inf")
+
+# constructs that change meaning once a pattern is embedded in a bigger alternation
+_UNSAFE_TO_COMBINE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)")
+
+# flow version (chatbot dict identity) -> index, see CompiledRoutingIndex.for_chatbot
+_INDEX_CACHE: Dict[Any, "CompiledRoutingIndex"] = {}
+
+
+class AhoCorasick:
+    """
+    Multi-pattern substring matcher.
+
+    Each pattern carries a rank, `best(text)` returns the lowest rank among
+    all patterns contained in text in a single O(len(text)) pass.
+    """
+
+    def __init__(self, patterns: List[Tuple[str, int]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[float] = [_NO_MATCH]
+
+        for pattern, rank in patterns:
+            node = 0
+            for char in pattern:
+                nxt = self._goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(_NO_MATCH)
+                node = nxt
+
+            self._out[node] = min(self._out[node], rank)
+
+        self.min_rank = min((rank for _, rank in patterns), default=_NO_MATCH)
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = list(self._goto[0].values())
+
+        for node in queue:
+            for char, child in self._goto[node].items():
+                queue.append(child)
+
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = min(self._out[child], self._out[self._fail[child]])
+
+    def best(self, text: str) -> Optional[int]:
+        """Lowest rank of any pattern found in text, or None"""
+        goto, fail, out = self._goto, self._fail, self._out
+        best = _NO_MATCH
+        node = 0
+
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+
+            node = goto[node].get(char, 0)
+
+            if out[node] < best:
+                best = out[node]
+                if best <= self.min_rank:
+                    break
+
+        return None if best == _NO_MATCH else int(best)
+
+
+class RegexAlternation:
+    """
+    First-match over an ordered list of regex patterns using `re.match` semantics.
+
+    Patterns are joined into a single alternation so one match call finds the
+    earliest pattern that matches. Patterns that cannot be safely embedded
+    (backreferences, inline global flags, ...) fall back to one compiled
+    regex per pattern, still evaluated in order.
+    """
+
+    def __init__(self, patterns: List[Tuple[str, int]], flags=re.IGNORECASE):
+        valid: List[Tuple[str, int]] = []
+
+        for pattern, rank in patterns:
+            try:
+                re.compile(pattern, flags)
+                valid.append((pattern, rank))
+            except re.error as e:
+                logger.warning("Invalid regex pattern '%s': %s", pattern, e)
+
+        self._combined = None
+        self._ranks: Dict[str, int] = {}
+        self._sequential: List[Tuple[re.Pattern, int]] = []
+
+        if not valid:
+            return
+
+        if not any(_UNSAFE_TO_COMBINE.search(p) for p, _ in valid):
+            try:
+                self._combined = re.compile(
+                    "|".join(f"(?P<_r{i}>{pattern})" for i, (pattern, _) in enumerate(valid)),
+                    flags
+                )
+                self._ranks = {f"_r{i}": rank for i, (_, rank) in enumerate(valid)}
+                return
+            except re.error:
+                self._combined = None
+
+        self._sequential = [(re.compile(p, flags), rank) for p, rank in valid]
+
+    def first(self, text: str) -> Optional[int]:
+        """Rank of the first pattern that matches at the start of text, or None"""
+        if self._combined is not None:
+            m = self._combined.match(text)
+            return self._ranks[m.lastgroup] if m else None
+
+        for compiled, rank in self._sequential:
+            if compiled.match(text):
+                return rank
+
+        return None
+
+
+class _RouteMatcher:
+    """Compiled routes of a single template"""
+
+    def __init__(self, routes: List[Dict]):
+        self.routes = routes
+        self._exact: Dict[str, int] = {}
+        self._empty_rank: Optional[int] = None
+        contains: List[Tuple[str, int]] = []
+        regexes: List[Tuple[str, int]] = []
+
+        for i, route in enumerate(routes):
+            if route.get('isRegex', False):
+                pattern = route.get('pattern', '')
+                if pattern:
+                    regexes.append((pattern, i))
+                continue
+
+            pattern = (route.get('pattern') or "").strip().lower()
+
+            if not pattern:
+                # an empty pattern only ever matches an empty message
+                if self._empty_rank is None:
+                    self._empty_rank = i
+                continue
+
+            self._exact.setdefault(pattern, i)
+            contains.append((pattern, i))
+
+        self._contains = AhoCorasick(contains) if contains else None
+        self._regex = RegexAlternation(regexes) if regexes else None
+
+    def match(self, incoming_text: str) -> Optional[Dict]:
+        rank = self._match_plain(incoming_text)
+
+        if rank is None and self._regex is not None:
+            rank = self._regex.first(incoming_text)
+
+        return self.routes[rank] if rank is not None else None
+
+    def _match_plain(self, incoming_text: str) -> Optional[int]:
+        if not incoming_text:
+            return self._empty_rank
+
+        if self._contains is None:
+            return None
+
+        exact = self._exact.get(incoming_text)
+        if exact is not None and exact == self._contains.min_rank:
+            return exact
+
+        return self._contains.best(incoming_text)
+
+
+class CompiledRoutingIndex:
+    """
+    Lookup structures for one flow version, see module docstring.
+    """
+
+    def __init__(self, chatbot: Dict[str, Any]):
+        self.source = chatbot
+        self.templates: List[Dict] = chatbot.get('templates', []) if chatbot else []
+
+        self.template_map: Dict[str, Dict] = {t.get('id'): t for t in self.templates if t.get('id')}
+        self.level_map: Dict[Any, Dict] = {}
+        self.start_template: Optional[Dict] = None
+        self._route_matchers: Dict[str, _RouteMatcher] = {
+            template_id: _RouteMatcher(template.get('routes', []))
+            for template_id, template in self.template_map.items()
+        }
+
+        regex_triggers: List[Tuple[str, int]] = []
+        plain_triggers: List[Tuple[str, int]] = []
+
+        for i, template in enumerate(self.templates):
+            settings = template.get('settings', {})
+
+            level = settings.get('message_level')
+            if level is not None:
+                self.level_map.setdefault(level, template)
+
+            if self.start_template is None and settings.get('isStart'):
+                self.start_template = template
+
+            trigger = settings.get('trigger', '')
+            if not trigger:
+                continue
+
+            try:
+                re.compile(trigger, re.IGNORECASE)
+                regex_triggers.append((trigger, i))
+            except re.error:
+                # not a valid regex, matched as plain text contained in the input
+                plain_triggers.append((trigger.lower(), i))
+
+        self._regex_triggers = RegexAlternation(regex_triggers) if regex_triggers else None
+        self._plain_triggers = AhoCorasick(plain_triggers) if plain_triggers else None
+
+    @classmethod
+    def for_chatbot(cls, chatbot: Dict[str, Any]) -> "CompiledRoutingIndex":
+        """Get the index for a chatbot dict, compiled once per loaded flow version"""
+        key = chatbot.get('id') or chatbot.get('name') if chatbot else None
+        index = _INDEX_CACHE.get(key)
+
+        if index is None or index.source is not chatbot:
+            index = cls(chatbot)
+            _INDEX_CACHE[key] = index
+
+        return index
+
+    def find_route(self, template: Dict, incoming_text: str) -> Optional[Dict]:
+        """First route of template matching the normalized (lowercase, stripped) input"""
+        matcher = self._route_matchers.get(template.get('id'))
+
+        if matcher is None:
+            matcher = _RouteMatcher(template.get('routes', []))
+
+        return matcher.match(incoming_text)
+
+    def find_by_level(self, level: str) -> Optional[Dict]:
+        return self.level_map.get(level)
+
+    def find_by_trigger(self, incoming_text: str, original_message: str) -> Optional[Dict]:
+        """First template whose trigger matches, regex triggers against the raw message"""
+        best = None
+
+        if self._regex_triggers is not None:
+            best = self._regex_triggers.first(original_message or "")
+
+        if self._plain_triggers is not None:
+            plain = self._plain_triggers.best(incoming_text)
+            if plain is not None and (best is None or plain < best):
+                best = plain
+
+        return self.templates[best] if best is not None else None
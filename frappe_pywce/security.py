@@ -2,16 +2,14 @@ import hashlib
 import hmac
 import frappe
 
-from frappe_pywce.config import get_wa_config
-
 def verify_webhook_signature(request):
-    settings = frappe.get_single("ChatBot Config")
+    settings = frappe.get_cached_doc("ChatBot Config")
 
     if settings.env == "local":
         return True
     
     must_validate = frappe.utils.sbool(settings.validate_webhook_payload)
-    secret = get_wa_config(settings).config.app_secret
+    secret = settings.get_password('app_secret', raise_exception=False)
 
     if must_validate:
         if not secret:
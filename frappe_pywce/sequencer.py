@@ -0,0 +1,311 @@
+"""
+Per conversation sequencer
+
+wa_ids are sharded over a fixed number of ordered partitions with a
+consistent hash ring. Each partition is a Redis list drained by at most one
+job at a time, guarded by a drainer flag (SET NX with a lease) holding the
+drainer's token:
+
+1. `submit` RPUSHes the payload and starts a drain job only if no drainer
+   holds the partition
+2. the drainer processes entries head first, so one user's messages run FIFO
+   while different partitions run in parallel on different workers
+3. a handled entry is popped, and the lease refreshed, by a script that
+   first checks the flag still holds the drainer's token. A drainer whose
+   lease expired and was taken over stops without touching the list
+4. the drainer only releases the flag when the list is empty, checked in the
+   same script so a concurrent RPUSH is never stranded
+
+Nothing blocks on a lock and nothing is dropped on contention. A drainer that
+dies keeps its head entry, the scheduler restarts partitions whose lease
+expired (at-least-once).
+
+Inline processing (`process_in_background` off) handles only the caller's
+own entry in the request, and only when it is alone in the partition. Any
+backlog is left to a drain job.
+"""
+
+import bisect
+import hashlib
+import json
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import frappe
+from frappe.utils.background_jobs import get_redis_conn
+
+from frappe_pywce.util import CACHE_KEY_PREFIX
+from frappe_pywce.pywce_logger import app_logger as logger
+
+SEQUENCER_PARTITIONS = 32
+RING_REPLICAS = 64
+
+DRAIN_BATCH = 100
+DRAINER_LEASE_IN_SEC = 300
+
+# KEYS: drainer flag, list. ARGV: token, lease
+_POP_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('LPOP', KEYS[2])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+return 1
+"""
+
+# 1 released, 0 new entries arrived, -1 the lease is not ours anymore
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return -1
+end
+if redis.call('LLEN', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+RELEASED = 1
+LEASE_LOST = -1
+
+
+class HashRing:
+    """Consistent hash ring of `partitions` with virtual nodes, stable across processes"""
+
+    def __init__(self, partitions: int, replicas: int = RING_REPLICAS):
+        self.partitions = partitions
+        ring = sorted(
+            (self._hash(f"{partition}:{replica}"), partition)
+            for partition in range(partitions)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [partition for _, partition in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:8], 16)
+
+    def get(self, key: str) -> int:
+        i = bisect.bisect(self._points, self._hash(str(key or ""))) % len(self._points)
+        return self._owners[i]
+
+
+class Sequencer:
+    """
+    Ordered per partition processing.
+
+    Args:
+        handler: `handler(wa_id, payload)`, errors are logged and the entry is skipped
+        schedule: `schedule(partition, token)` starts a job calling `drain(partition, token)`
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, dict], None],
+        schedule: Callable[[int], None],
+        conn=None,
+        site: str = None,
+        partitions: int = SEQUENCER_PARTITIONS
+    ):
+        self.handler = handler
+        self.schedule = schedule
+        self.conn = conn or get_redis_conn()
+        self.site = site or frappe.local.site
+        self.ring = HashRing(partitions)
+        self._pop = self.conn.register_script(_POP_SCRIPT)
+        self._release_script = self.conn.register_script(_RELEASE_SCRIPT)
+
+    def _key(self, partition) -> str:
+        return f"{CACHE_KEY_PREFIX}seq:{self.site}:{partition}"
+
+    def _drainer_key(self, partition) -> str:
+        return f"{self._key(partition)}:drainer"
+
+    def _stats_key(self) -> str:
+        return f"{CACHE_KEY_PREFIX}seq:{self.site}:stats"
+
+    def submit(self, wa_id: str, payload: dict, inline: bool = False) -> int:
+        """
+        Queue payload behind earlier messages of wa_id, returns the partition.
+
+        With `inline` the entry is processed right away when it is the only
+        one in its partition, a backlog is always left to a drain job.
+        """
+        partition = self.ring.get(wa_id)
+
+        depth = self.conn.rpush(
+            self._key(partition),
+            json.dumps({"wa_id": wa_id, "payload": payload, "enqueued_at": time.time()})
+        )
+
+        token = self._acquire(partition)
+
+        if token is None:
+            # the running drainer gets to it
+            return partition
+
+        if inline and depth == 1:
+            self.drain(partition, token, batch_size=1)
+        else:
+            self.schedule(partition, token)
+
+        return partition
+
+    def _acquire(self, partition: int) -> Optional[str]:
+        """Token of a new drainer of partition, None while another one holds the lease"""
+        token = uuid.uuid4().hex
+
+        if self.conn.set(self._drainer_key(partition), token, nx=True, ex=DRAINER_LEASE_IN_SEC):
+            return token
+
+        return None
+
+    def _start_drainer(self, partition: int) -> bool:
+        token = self._acquire(partition)
+
+        if token is None:
+            return False
+
+        self.schedule(partition, token)
+        return True
+
+    def drain(self, partition: int, token: str, batch_size: int = DRAIN_BATCH) -> int:
+        """
+        Process up to batch_size entries of partition in order while holding the lease of token.
+
+        Re-schedules itself (still holding the flag) when the batch is full so
+        a busy partition does not pin one worker forever.
+        """
+        key = self._key(partition)
+        keys = [self._drainer_key(partition), key]
+        processed = 0
+
+        while True:
+            while processed < batch_size:
+                raw = self.conn.lindex(key, 0)
+
+                if raw is None:
+                    break
+
+                entry = json.loads(raw)
+
+                try:
+                    self.handler(entry["wa_id"], entry["payload"])
+                except Exception:
+                    logger.error("Sequencer handler failed for %s", entry.get("wa_id"), exc_info=True)
+
+                # only removed once handled, a crashed drainer leaves it for the next one
+                if not self._pop(keys=keys, args=[token, DRAINER_LEASE_IN_SEC]):
+                    # the lease expired and another drainer took over, the head is its to pop
+                    logger.warning("Sequencer partition %s lost its drainer lease", partition)
+                    return processed
+
+                pipe = self.conn.pipeline()
+                pipe.hincrby(self._stats_key(), f"processed:{partition}", 1)
+                pipe.hset(self._stats_key(), f"last_drain:{partition}", time.time())
+                pipe.execute()
+
+                processed += 1
+
+            if processed >= batch_size:
+                if self.conn.llen(key):
+                    self.schedule(partition, token)
+                    return processed
+
+            # 0: new entries arrived, keep going
+            if self._release_script(keys=keys, args=[token]) in (RELEASED, LEASE_LOST):
+                return processed
+
+    def kick_stalled(self) -> List[int]:
+        """Start drainers for non empty partitions whose drainer lease expired"""
+        started = []
+
+        for partition in range(self.ring.partitions):
+            if self.conn.llen(self._key(partition)) and self._start_drainer(partition):
+                started.append(partition)
+
+        return started
+
+    def stats(self) -> List[Dict]:
+        """Per partition depth, lag of the oldest queued entry and processed count"""
+        now = time.time()
+        counters = {
+            (k.decode() if isinstance(k, bytes) else k): v
+            for k, v in (self.conn.hgetall(self._stats_key()) or {}).items()
+        }
+
+        pipe = self.conn.pipeline()
+        for partition in range(self.ring.partitions):
+            pipe.llen(self._key(partition))
+            pipe.lindex(self._key(partition), 0)
+            pipe.exists(self._drainer_key(partition))
+        results = pipe.execute()
+
+        stats = []
+        for partition in range(self.ring.partitions):
+            depth, head, draining = results[partition * 3: partition * 3 + 3]
+            lag = now - json.loads(head)["enqueued_at"] if head else 0.0
+
+            stats.append({
+                "partition": partition,
+                "depth": depth,
+                "lag_seconds": round(lag, 3),
+                "draining": bool(draining),
+                "processed": int(counters.get(f"processed:{partition}", 0)),
+            })
+
+        return stats
+
+
+def _process_entry(wa_id: str, payload: dict) -> None:
+    from frappe_pywce.webhook import process_webhook_payload
+
+    try:
+        # the partition drainer already serializes wa_id, no lock needed
+        process_webhook_payload(wa_id, payload, lock=False)
+        frappe.db.commit()
+
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(title="Chatbot Webhook E.Handler")
+
+
+def _enqueue_drain(partition: int, token: str) -> None:
+    frappe.enqueue(
+        "frappe_pywce.sequencer.drain_partition",
+        partition=partition,
+        token=token
+    )
+
+
+def get_sequencer() -> Sequencer:
+    return Sequencer(_process_entry, schedule=_enqueue_drain)
+
+
+def submit(wa_id: str, payload: dict, now: bool = False) -> int:
+    """Queue a webhook payload, processed in this request when now is set and nothing is queued before it"""
+    return get_sequencer().submit(wa_id, payload, inline=now)
+
+
+def drain_partition(partition: int, token: str = None) -> int:
+    if token is None:
+        # queued before drainers had tokens, kick_stalled_partitions restarts it once the lease expires
+        return 0
+
+    return get_sequencer().drain(int(partition), token)
+
+
+def kick_stalled_partitions() -> None:
+    started = get_sequencer().kick_stalled()
+
+    if started:
+        logger.warning("Restarted stalled sequencer partitions: %s", started)
+
+
+@frappe.whitelist()
+def get_sequencer_stats() -> List[Dict]:
+    """Per partition queue depth and lag"""
+    frappe.only_for("System Manager")
+    return get_sequencer().stats()
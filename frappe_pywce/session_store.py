@@ -0,0 +1,670 @@
+"""
+Redis hash backed session storage
+
+Each session is one hash, `fpw:sess:<session_id>`, holding one field per
+session key. Reads and writes touch only the fields involved (HGET / HSET /
+HDEL / HGETALL) and are pipelined together with an EXPIRE, so every access
+refreshes the session TTL in the same round-trip and concurrent writers of
+different keys no longer overwrite each other.
+
+Field values are JSON encoded. Setting `whatsapp_session_codec` to `msgpack`
+in site config encodes new values with msgpack when it is installed, values
+of both codecs are read back transparently.
+
+Sessions written by older versions as one JSON blob under `fpw:<session_id>`
+are moved into the hash the first time a process touches the session.
+
+Global (bot wide) data lives in one hash, `fpw:global`, with a field per key.
+`GlobalStore` keeps a short lived copy of it in every process and drops that
+copy on a pub/sub invalidation whenever any worker changes a global key, so
+global reads rarely reach Redis.
+
+Within `session_scope(store, session_id)` (one webhook) a
+`SessionUnitOfWork` loads the session hash once, serves every read from
+memory and writes the changed fields back in a single pipeline when the
+scope ends or the database commits. Redis round-trips are counted per scope.
+"""
+
+import copy
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import frappe
+
+from frappe_pywce import pubsub
+from frappe_pywce.pywce_logger import app_logger as logger
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SESSION_KEY_PREFIX = "fpw:sess:"
+LEGACY_KEY_PREFIX = "fpw:"
+
+CODEC_JSON = "json"
+CODEC_MSGPACK = "msgpack"
+CODEC_CONF_KEY = "whatsapp_session_codec"
+
+# msgpack values start with this byte, it can never start a JSON document
+_MSGPACK_MARKER = b"\x01"
+
+# bound on the per process set of sessions already checked for a legacy blob
+MAX_MIGRATION_CHECKS = 10000
+
+STATS_KEY = "fpw:sess_stats"
+
+GLOBAL_KEY = "fpw:global"
+GLOBAL_TTL_IN_SEC = 86400
+GLOBAL_CACHE_TTL_IN_SEC = 5
+GLOBAL_CACHE_TOPIC = "session_global"
+
+
+def get_codec() -> str:
+    conf = getattr(frappe.local, "conf", None) or {}
+    codec = conf.get(CODEC_CONF_KEY) or CODEC_JSON
+    return CODEC_MSGPACK if codec == CODEC_MSGPACK and msgpack is not None else CODEC_JSON
+
+
+def encode(value: Any, codec: str = CODEC_JSON) -> bytes:
+    if codec == CODEC_MSGPACK:
+        return _MSGPACK_MARKER + msgpack.packb(value, use_bin_type=True, default=str)
+
+    return json.dumps(value, default=str).encode("utf-8")
+
+
+def decode(raw: Optional[bytes]) -> Any:
+    if raw is None:
+        return None
+
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+
+    if raw[:1] == _MSGPACK_MARKER:
+        return msgpack.unpackb(raw[1:], raw=False)
+
+    return json.loads(raw)
+
+
+def count_round_trip(count: int = 1) -> None:
+    """Count Redis round-trips made for the session of the running unit of work"""
+    uow = current_unit_of_work()
+
+    if uow is not None:
+        uow.round_trips += count
+
+
+def _field(name) -> str:
+    return name.decode("utf-8") if isinstance(name, bytes) else str(name)
+
+
+class SessionStore:
+    """Field level access to session hashes, see module docstring"""
+
+    _migration_checked = set()
+    _migration_lock = threading.Lock()
+
+    def __init__(self, ttl: int, conn=None, legacy_transform: Callable[[Dict], Dict] = None):
+        """legacy_transform maps a legacy blob to hash fields when the caller lays them out differently"""
+        self.ttl = ttl
+        self._conn = conn
+        self.legacy_transform = legacy_transform
+
+    @property
+    def conn(self):
+        return self._conn or frappe.cache
+
+    def make_key(self, key: str) -> str:
+        """Site prefixed key when the connection is frappe's cache"""
+        make_key = getattr(self.conn, "make_key", None)
+        return make_key(key) if make_key else key
+
+    def key(self, session_id: str) -> str:
+        return self.make_key(f"{SESSION_KEY_PREFIX}{session_id}")
+
+    def _pipeline(self, session_id: str):
+        self._migrate_legacy(session_id)
+        return self.conn.pipeline(transaction=False)
+
+    def _execute(self, pipe) -> list:
+        count_round_trip()
+        return pipe.execute()
+
+    def get(self, session_id: str, field: str) -> Any:
+        key = self.key(session_id)
+        pipe = self._pipeline(session_id)
+        pipe.hget(key, field)
+        pipe.expire(key, self.ttl)
+        return decode(self._execute(pipe)[0])
+
+    def get_many(self, session_id: str, fields: List[str]) -> Dict[str, Any]:
+        if not fields:
+            return {}
+
+        key = self.key(session_id)
+        pipe = self._pipeline(session_id)
+        pipe.hmget(key, fields)
+        pipe.expire(key, self.ttl)
+        values = self._execute(pipe)[0]
+        return {field: decode(raw) for field, raw in zip(fields, values) if raw is not None}
+
+    def get_all(self, session_id: str) -> Dict[str, Any]:
+        key = self.key(session_id)
+        pipe = self._pipeline(session_id)
+        pipe.hgetall(key)
+        pipe.expire(key, self.ttl)
+        return {_field(field): decode(raw) for field, raw in self._execute(pipe)[0].items()}
+
+    def exists(self, session_id: str, field: str) -> bool:
+        key = self.key(session_id)
+        pipe = self._pipeline(session_id)
+        pipe.hexists(key, field)
+        pipe.expire(key, self.ttl)
+        return bool(self._execute(pipe)[0])
+
+    def set_many(self, session_id: str, data: Dict[str, Any], delete: Iterable[str] = ()) -> None:
+        """HSET all of data and HDEL `delete` in one round-trip"""
+        self.write(session_id, data, delete)
+
+    def write(self, session_id: str, data: Dict[str, Any], delete: Iterable[str] = (), drop: bool = False) -> None:
+        """Optionally drop the hash, then HDEL `delete` and HSET data, all in one pipeline"""
+        delete = [field for field in delete if field not in data]
+
+        if not data and not delete and not drop:
+            return
+
+        key = self.key(session_id)
+        codec = get_codec()
+        pipe = self._pipeline(session_id)
+
+        if drop:
+            pipe.delete(key)
+
+        if delete:
+            pipe.hdel(key, *delete)
+
+        if data:
+            pipe.hset(key, mapping={field: encode(value, codec) for field, value in data.items()})
+            pipe.expire(key, self.ttl)
+
+        self._execute(pipe)
+
+    def set(self, session_id: str, field: str, value: Any) -> None:
+        self.set_many(session_id, {field: value})
+
+    def delete(self, session_id: str, fields: Iterable[str]) -> int:
+        fields = list(fields)
+
+        if not fields:
+            return 0
+
+        key = self.key(session_id)
+        pipe = self._pipeline(session_id)
+        pipe.hdel(key, *fields)
+        pipe.expire(key, self.ttl)
+        return self._execute(pipe)[0]
+
+    def fields(self, session_id: str) -> List[str]:
+        pipe = self._pipeline(session_id)
+        pipe.hkeys(self.key(session_id))
+        return [_field(field) for field in self._execute(pipe)[0]]
+
+    def drop(self, session_id: str) -> None:
+        self.write(session_id, {}, drop=True)
+
+    def _migrate_legacy(self, session_id: str) -> None:
+        """Move a pre hash session blob into the hash once, never overwriting newer fields"""
+        cls = type(self)
+
+        if session_id in cls._migration_checked:
+            return
+
+        with cls._migration_lock:
+            if len(cls._migration_checked) >= MAX_MIGRATION_CHECKS:
+                cls._migration_checked.clear()
+
+            cls._migration_checked.add(session_id)
+
+        legacy_key = f"{LEGACY_KEY_PREFIX}{session_id}"
+
+        try:
+            raw = frappe.cache.get_value(legacy_key, expires=True)
+            count_round_trip()
+
+            if raw is None:
+                return
+
+            data = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+
+            if isinstance(data, dict) and data:
+                key = self.key(session_id)
+                codec = get_codec()
+                pipe = self.conn.pipeline(transaction=False)
+
+                for field, value in (self.legacy_transform(data) if self.legacy_transform else data).items():
+                    pipe.hsetnx(key, field, encode(value, codec))
+
+                pipe.expire(key, self.ttl)
+                self._execute(pipe)
+
+            frappe.cache.delete_value(legacy_key)
+            logger.info("Migrated legacy session blob for %s", session_id)
+
+        except Exception:
+            cls._migration_checked.discard(session_id)
+            logger.warning("Failed to migrate legacy session for %s", session_id, exc_info=True)
+
+
+def _copy(value: Any) -> Any:
+    # callers may mutate what they get or saved, like they could with a decoded blob
+    return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+
+class SessionUnitOfWork:
+    """
+    In memory view of one session for the duration of a webhook.
+
+    Has the same methods as `SessionStore`, the session is loaded with one
+    HGETALL on first use and changes are kept as dirty / deleted fields until
+    `flush`. Global data read through the session manager is cached here too.
+    """
+
+    def __init__(self, store: SessionStore, session_id: str):
+        self.store = store
+        self.session_id = session_id
+
+        self._fields: Optional[Dict[str, Any]] = None
+        self._dirty = set()
+        self._deleted = set()
+        self._dropped = False
+
+        self.global_pending: Dict[str, Any] = {}
+        self.global_deleted = set()
+
+        self.round_trips = 0
+        self.reads = 0
+
+        # called on every change, session_scope uses it to register a flush on the next commit
+        self.on_change: Optional[Callable[[], None]] = None
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change()
+
+    def _load(self, read: bool = True) -> Dict[str, Any]:
+        if self._fields is None:
+            self._fields = self.store.get_all(self.session_id)
+
+        if read:
+            self.reads += 1
+
+        return self._fields
+
+    def get(self, session_id: str, field: str) -> Any:
+        return _copy(self._load().get(field))
+
+    def get_many(self, session_id: str, fields: List[str]) -> Dict[str, Any]:
+        data = self._load()
+        return {field: _copy(data[field]) for field in fields if field in data}
+
+    def get_all(self, session_id: str) -> Dict[str, Any]:
+        return {field: _copy(value) for field, value in self._load().items()}
+
+    def exists(self, session_id: str, field: str) -> bool:
+        return field in self._load()
+
+    def fields(self, session_id: str) -> List[str]:
+        return list(self._load())
+
+    def set_many(self, session_id: str, data: Dict[str, Any], delete: Iterable[str] = ()) -> None:
+        fields = self._load(read=False)
+
+        for field in delete:
+            if field not in data and field in fields:
+                del fields[field]
+                self._deleted.add(field)
+                self._dirty.discard(field)
+
+        for field, value in data.items():
+            fields[field] = _copy(value)
+            self._dirty.add(field)
+            self._deleted.discard(field)
+
+        self._changed()
+
+    def set(self, session_id: str, field: str, value: Any) -> None:
+        self.set_many(session_id, {field: value})
+
+    def delete(self, session_id: str, fields: Iterable[str]) -> int:
+        loaded = self._load(read=False)
+        present = [field for field in fields if field in loaded]
+        self.set_many(session_id, {}, delete=present)
+        return len(present)
+
+    def drop(self, session_id: str) -> None:
+        self._fields = {}
+        self._dirty.clear()
+        self._deleted.clear()
+        self._dropped = True
+        self._changed()
+
+    def get_global(self, global_store: "GlobalStore", key: str) -> Any:
+        self.reads += 1
+
+        if key in self.global_pending:
+            return _copy(self.global_pending[key])
+
+        if key in self.global_deleted:
+            return None
+
+        return global_store.get(key)
+
+    def set_global(self, key: str, value: Any) -> None:
+        self.global_pending[key] = _copy(value)
+        self.global_deleted.discard(key)
+        self._changed()
+
+    def delete_global(self, key: str) -> None:
+        self.global_pending.pop(key, None)
+        self.global_deleted.add(key)
+        self._changed()
+
+    def get_all_global(self, global_store: "GlobalStore") -> Dict[str, Any]:
+        self.reads += 1
+        data = {k: v for k, v in global_store.get_all().items() if k not in self.global_deleted}
+        data.update({k: _copy(v) for k, v in self.global_pending.items()})
+        return data
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._dirty or self._deleted or self._dropped)
+
+    def flush(self) -> None:
+        """Write pending changes in one pipelined round-trip"""
+        if not self.is_dirty:
+            return
+
+        self.store.write(
+            self.session_id,
+            {field: self._fields[field] for field in self._dirty},
+            delete=self._deleted,
+            drop=self._dropped
+        )
+
+        self._dirty.clear()
+        self._deleted.clear()
+        self._dropped = False
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"round_trips": self.round_trips, "reads": self.reads}
+
+
+def current_unit_of_work() -> Optional[SessionUnitOfWork]:
+    return getattr(frappe.local, "pywce_session_uow", None)
+
+
+def _discard_callback(manager, callback: Callable) -> None:
+    # frappe's CallbackManager has no remove, its deque does
+    try:
+        manager._functions.remove(callback)
+    except (AttributeError, ValueError):
+        pass
+
+
+@contextmanager
+def session_scope(store: SessionStore, session_id: str, global_store: "GlobalStore" = None):
+    """
+    Serve the session of session_id from memory until the block ends.
+
+    Pending changes are flushed when the block ends, even on error, like the
+    immediate writes they replace, and after every database commit inside it
+    that follows a change. Frappe runs an after_commit callback once and drops
+    it on rollback, so every change registers the flush again unless it still
+    is. Global keys changed through the unit of work are written to global_store.
+    """
+    if current_unit_of_work() is not None:
+        # nested scope, the outer one owns the flush
+        yield current_unit_of_work()
+        return
+
+    uow = SessionUnitOfWork(store, session_id)
+
+    def flush():
+        if current_unit_of_work() is not uow:
+            return
+
+        uow.flush()
+
+        if global_store is not None and (uow.global_pending or uow.global_deleted):
+            global_store.write(uow.global_pending, uow.global_deleted)
+            uow.global_pending = {}
+            uow.global_deleted = set()
+
+    registered = False
+
+    def after_commit():
+        nonlocal registered
+        registered = False
+        flush()
+
+    def after_rollback():
+        nonlocal registered
+        # frappe dropped the flush with the transaction, the next change or the scope end flushes
+        registered = False
+
+    def register():
+        nonlocal registered
+
+        if registered or current_unit_of_work() is not uow:
+            return
+
+        try:
+            frappe.db.after_commit.add(after_commit)
+            frappe.db.after_rollback.add(after_rollback)
+        except AttributeError:
+            return
+
+        registered = True
+
+    frappe.local.pywce_session_uow = uow
+    uow.on_change = register
+
+    try:
+        yield uow
+
+    finally:
+        uow.on_change = None
+
+        if registered:
+            _discard_callback(frappe.db.after_commit, after_commit)
+            _discard_callback(frappe.db.after_rollback, after_rollback)
+
+        try:
+            flush()
+        finally:
+            frappe.local.pywce_session_uow = None
+
+        _record_stats(store, uow)
+
+
+class GlobalStore:
+    """
+    Bot wide session data, one hash field per key.
+
+    Reads are served from a per process copy of the hash that lives at most
+    GLOBAL_CACHE_TTL_IN_SEC and is dropped on every write from any worker.
+    """
+
+    # {site: (loaded_at, fields)}
+    _cache: Dict[str, tuple] = {}
+    # bumped on invalidation, a load that raced a write does not store its result
+    _generation: Dict[str, int] = {}
+    _subscribed = False
+    _migrated = set()
+
+    def __init__(self, conn=None, ttl: int = GLOBAL_TTL_IN_SEC,
+                 cache_ttl: float = GLOBAL_CACHE_TTL_IN_SEC, legacy_key: str = None):
+        self._conn = conn
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.legacy_key = legacy_key
+
+    @property
+    def conn(self):
+        return self._conn or frappe.cache
+
+    @property
+    def key(self) -> str:
+        make_key = getattr(self.conn, "make_key", None)
+        return make_key(GLOBAL_KEY) if make_key else GLOBAL_KEY
+
+    @staticmethod
+    def _site() -> str:
+        return getattr(frappe.local, "site", None) or ""
+
+    @classmethod
+    def _on_invalidated(cls, site: str, data: dict) -> None:
+        cls._generation[site] = cls._generation.get(site, 0) + 1
+        cls._cache.pop(site, None)
+
+    @classmethod
+    def _ensure_subscribed(cls) -> None:
+        if not cls._subscribed:
+            cls._subscribed = True
+            pubsub.subscribe(GLOBAL_CACHE_TOPIC, cls._on_invalidated)
+
+    def _load(self) -> Dict[str, Any]:
+        self._ensure_subscribed()
+        site = self._site()
+        cached = self._cache.get(site)
+
+        if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+            return cached[1]
+
+        self._migrate_legacy()
+
+        generation = self._generation.get(site, 0)
+        count_round_trip()
+        fields = {_field(k): decode(v) for k, v in self.conn.pipeline(transaction=False).hgetall(self.key).execute()[0].items()}
+
+        if self._generation.get(site, 0) == generation:
+            self._cache[site] = (time.monotonic(), fields)
+
+        return fields
+
+    def get(self, key: str) -> Any:
+        return _copy(self._load().get(key))
+
+    def get_all(self) -> Dict[str, Any]:
+        return {k: _copy(v) for k, v in self._load().items()}
+
+    def write(self, data: Dict[str, Any], delete: Iterable[str] = ()) -> None:
+        """HSET data and HDEL delete in one pipeline, then invalidate every process"""
+        delete = [key for key in delete if key not in data]
+
+        if not data and not delete:
+            return
+
+        self._migrate_legacy()
+
+        codec = get_codec()
+        pipe = self.conn.pipeline(transaction=False)
+
+        if delete:
+            pipe.hdel(self.key, *delete)
+
+        if data:
+            pipe.hset(self.key, mapping={k: encode(v, codec) for k, v in data.items()})
+            pipe.expire(self.key, self.ttl)
+
+        count_round_trip()
+        pipe.execute()
+
+        self._invalidate(list(data) + delete)
+
+    def set(self, key: str, value: Any) -> None:
+        self.write({key: value})
+
+    def delete(self, key: str) -> None:
+        self.write({}, delete=[key])
+
+    def clear(self) -> None:
+        count_round_trip()
+        self.conn.delete(self.key)
+        self._invalidate([])
+
+    def _invalidate(self, keys: List[str]) -> None:
+        self._on_invalidated(self._site(), {})
+        pubsub.publish(GLOBAL_CACHE_TOPIC, {"keys": keys})
+
+    def _migrate_legacy(self) -> None:
+        """Move the old single JSON global value into the hash once per process and site"""
+        site = self._site()
+
+        if not self.legacy_key or site in self._migrated:
+            return
+
+        self._migrated.add(site)
+
+        try:
+            raw = frappe.cache.get_value(self.legacy_key, expires=True)
+
+            if raw is None:
+                return
+
+            data = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+
+            if isinstance(data, dict) and data:
+                codec = get_codec()
+                pipe = self.conn.pipeline(transaction=False)
+
+                for key, value in data.items():
+                    pipe.hsetnx(self.key, key, encode(value, codec))
+
+                pipe.expire(self.key, self.ttl)
+                pipe.execute()
+
+            frappe.cache.delete_value(self.legacy_key)
+            logger.info("Migrated legacy global session data")
+
+        except Exception:
+            self._migrated.discard(site)
+            logger.warning("Failed to migrate legacy global session data", exc_info=True)
+
+
+def _record_stats(store: SessionStore, uow: SessionUnitOfWork) -> None:
+    logger.debug("Session %s: %s", uow.session_id, uow.stats)
+
+    try:
+        pipe = store.conn.pipeline(transaction=False)
+        key = store.make_key(STATS_KEY)
+        pipe.hincrby(key, "webhooks", 1)
+        pipe.hincrby(key, "round_trips", uow.round_trips)
+        pipe.hincrby(key, "reads", uow.reads)
+        pipe.execute()
+
+    except Exception:
+        logger.debug("Failed to record session stats", exc_info=True)
+
+
+def get_stats(store: SessionStore) -> Dict[str, Any]:
+    raw = store.conn.pipeline(transaction=False).hgetall(store.make_key(STATS_KEY)).execute()[0]
+    stats = {_field(k): int(v) for k, v in raw.items()}
+    webhooks = stats.get("webhooks") or 0
+
+    if webhooks:
+        stats["round_trips_per_webhook"] = round(stats.get("round_trips", 0) / webhooks, 2)
+        stats["reads_per_webhook"] = round(stats.get("reads", 0) / webhooks, 2)
+
+    return stats
+
+
+@frappe.whitelist()
+def get_session_stats() -> Dict[str, Any]:
+    """Session round-trips and reads per webhook, summed over all scopes"""
+    frappe.only_for("System Manager")
+    return get_stats(SessionStore(ttl=0))
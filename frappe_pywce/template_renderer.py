@@ -0,0 +1,240 @@
+"""
+Cached rendering of template dicts
+
+`frappe.render_template` compiles its source again on every call and the
+recursive renderer used to call it for every string of a template, static
+or not. This module:
+
+1. classifies each string once: static strings are never rendered, strings
+   with Jinja markers are dynamic
+2. keeps the compiled Jinja code of dynamic strings in an LRU keyed by the
+   source hash (code objects, not `Template`s, since frappe builds a new
+   environment per request)
+3. caches a render plan per template dict shape, listing only the paths that
+   need rendering so static subtrees are returned as they are
+
+Results match `frappe.render_template`: Jinja's trailing newline stripping is
+applied to static strings and anything frappe treats specially (template
+paths, `.__`) is still delegated to it.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import frappe
+from frappe.utils.jinja import get_jenv, guess_is_path
+from jinja2 import TemplateError
+
+COMPILED_CACHE_SIZE = 2048
+PLAN_CACHE_SIZE = 512
+
+_JINJA_MARKERS = ("{{", "{%", "{#")
+
+# plan step kinds
+_CONST = 0
+_JINJA = 1
+_DELEGATE = 2
+
+
+class LRUCache:
+    """Small thread safe LRU with hit / miss counters"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+_compiled = LRUCache(COMPILED_CACHE_SIZE)
+_plans = LRUCache(PLAN_CACHE_SIZE)
+
+
+def _hash(source: str) -> str:
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+def is_dynamic(value: str) -> bool:
+    return any(marker in value for marker in _JINJA_MARKERS)
+
+
+def _classify(value: str) -> Optional[Tuple[int, Any]]:
+    """Plan step for one string, None when it renders to itself"""
+    if not value:
+        # frappe.render_template("") returns ""
+        return None
+
+    if ".__" in value or guess_is_path(value):
+        return _DELEGATE, value
+
+    if is_dynamic(value):
+        return _JINJA, value
+
+    if value.endswith("\n"):
+        # Jinja drops a single trailing newline
+        return _CONST, value[:-1]
+
+    return None
+
+
+def _compile(source: str):
+    key = _hash(source)
+    code = _compiled.get(key)
+
+    if code is None:
+        code = get_jenv().compile(source)
+        _compiled.set(key, code)
+
+    return code
+
+
+def render_string(source: str, context: Dict) -> str:
+    """frappe.render_template(source, context) with the compiled code cached"""
+    step = _classify(source)
+
+    if step is None:
+        return source
+
+    return _run_step(step, context)
+
+
+def _run_step(step: Tuple[int, Any], context: Dict):
+    kind, value = step
+
+    if kind == _CONST:
+        return value
+
+    if kind == _DELEGATE:
+        return frappe.render_template(value, context)
+
+    try:
+        jenv = get_jenv()
+        template = jenv.template_class.from_code(jenv, _compile(value), jenv.make_globals(None))
+        return template.render(context)
+
+    except TemplateError:
+        # let frappe raise its usual "Jinja Template Error"
+        return frappe.render_template(value, context)
+
+
+def _build_plan(value: Any, path: Tuple = ()) -> List[Tuple[Tuple, Tuple[int, Any]]]:
+    """(path, step) for every string below value that does not render to itself"""
+    if isinstance(value, str):
+        step = _classify(value)
+        return [(path, step)] if step is not None else []
+
+    if isinstance(value, dict):
+        return [item for key, child in value.items() for item in _build_plan(child, path + (key,))]
+
+    if isinstance(value, list):
+        return [item for i, child in enumerate(value) for item in _build_plan(child, path + (i,))]
+
+    return []
+
+
+def get_plan(template_dict: Dict) -> List[Tuple[Tuple, Tuple[int, Any]]]:
+    try:
+        key = _hash(json.dumps(template_dict, sort_keys=True, default=str))
+    except (TypeError, ValueError):
+        return _build_plan(template_dict)
+
+    plan = _plans.get(key)
+
+    if plan is None:
+        plan = _build_plan(template_dict)
+        _plans.set(key, plan)
+
+    return plan
+
+
+def render_template_dict(template_dict: Any, context: Dict) -> Any:
+    """
+    Render every string of template_dict with context.
+
+    Containers on the way to a rendered string are copied, static subtrees
+    are shared with the input.
+    """
+    if isinstance(template_dict, str):
+        return render_string(template_dict, context)
+
+    if not isinstance(template_dict, (dict, list)):
+        return template_dict
+
+    plan = get_plan(template_dict)
+
+    if not plan:
+        return _copy_container(template_dict)
+
+    result = _copy_container(template_dict)
+
+    for path, step in plan:
+        parent = result
+        source = template_dict
+
+        for key in path[:-1]:
+            source = source[key]
+
+            if parent[key] is source:
+                parent[key] = _copy_container(source)
+
+            parent = parent[key]
+
+        parent[path[-1]] = _run_step(step, context)
+
+    return result
+
+
+def _copy_container(value):
+    return dict(value) if isinstance(value, dict) else list(value)
+
+
+def warm(templates: Iterable[Any]) -> int:
+    """Compile the dynamic strings of a flow ahead of the first message, returns how many"""
+    count = 0
+
+    for template in templates:
+        for _, (kind, source) in _build_plan(template):
+            if kind == _JINJA:
+                _compile(source)
+                count += 1
+
+    return count
+
+
+def get_cache_stats() -> Dict:
+    return {
+        "compiled": {"size": len(_compiled), "hits": _compiled.hits, "misses": _compiled.misses},
+        "plans": {"size": len(_plans), "hits": _plans.hits, "misses": _plans.misses},
+    }
@@ -0,0 +1,119 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.campaign import CampaignSender, _build_payload, iter_recipients
+
+
+class _GraphStub(BaseHTTPRequestHandler):
+    """Graph style send endpoint, answers 429 once for recipients ending in 0 and 502 for those ending in 9"""
+
+    lock = threading.Lock()
+    seen = {}
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        to = payload["to"]
+
+        with type(self).lock:
+            attempts = type(self).seen.get(to, 0) + 1
+            type(self).seen[to] = attempts
+
+        if to.endswith("0") and attempts == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "0.01")
+            self.end_headers()
+            return
+
+        if to.endswith("9"):
+            self.send_response(502)
+            self.end_headers()
+            return
+
+        body = json.dumps({"messages": [{"id": f"wamid.{to}"}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCampaign(FrappeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _GraphStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}/v18.0"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_list_source_resumes_after_cursor(self):
+        source = {"recipients": ["2637001", {"phone": "2637002", "name": "B"}, "2637003"]}
+
+        self.assertEqual([c for c, _ in iter_recipients(source)], [0, 1, 2])
+        self.assertEqual([row["phone"] for _, row in iter_recipients(source, cursor=0)], ["2637002", "2637003"])
+        self.assertEqual(list(iter_recipients(source, cursor=2)), [])
+
+    def test_doctype_source_takes_dict_filters(self):
+        source = {"doctype": "User", "phone_field": "name", "filters": {"name": ["in", ["Administrator", "Guest"]]}}
+
+        self.assertEqual([c for c, _ in iter_recipients(source)], ["Administrator", "Guest"])
+        self.assertEqual([c for c, _ in iter_recipients(source, cursor="Administrator")], ["Guest"])
+
+    def test_build_payload(self):
+        spec = {"template_name": "promo", "language_code": "en_US", "components": [{"type": "body"}]}
+        payload = _build_payload(spec, {"phone": "2637001"})
+
+        self.assertEqual(payload["to"], "2637001")
+        self.assertEqual(payload["template"]["name"], "promo")
+        self.assertEqual(payload["template"]["components"], [{"type": "body"}])
+
+    def test_components_are_per_recipient(self):
+        spec = {
+            "template_name": "promo",
+            "components": [{"type": "body", "parameters": [{"type": "text", "text": "Hi {{ first_name }}"}]}]
+        }
+
+        first = _build_payload(spec, {"phone": "2637001", "first_name": "Tino"})
+        second = _build_payload(spec, {"phone": "2637002", "first_name": "Rudo"})
+
+        self.assertEqual(first["template"]["components"][0]["parameters"][0]["text"], "Hi Tino")
+        self.assertEqual(second["template"]["components"][0]["parameters"][0]["text"], "Hi Rudo")
+
+        spec = {"template_name": "promo", "components_by_phone": {"2637001": [{"type": "body"}]}}
+
+        self.assertEqual(_build_payload(spec, {"phone": "+263 7001"})["template"]["components"], [{"type": "body"}])
+        self.assertNotIn("components", _build_payload(spec, {"phone": "2637002"})["template"])
+
+    def test_unregistered_components_method_is_rejected(self):
+        with self.assertRaises(frappe.ValidationError):
+            _build_payload({"template_name": "promo", "components_method": "frappe.delete_doc"}, {"phone": "2637001"})
+
+    def test_send_batch_with_retries(self):
+        _GraphStub.seen = {}
+        sender = CampaignSender("123", "token", concurrency=5, base_url=self.base_url)
+
+        payloads = [{"to": f"26377{i:05d}"} for i in range(50)]
+        results = sender.send_batch(payloads)
+
+        self.assertEqual(
+            [r.get("message_id") for r in results],
+            [None if p["to"].endswith("9") else f"wamid.{p['to']}" for p in payloads]
+        )
+        self.assertEqual(_GraphStub.seen["2637700000"], 2)
+        self.assertEqual(_GraphStub.seen["2637700001"], 1)
+
+        # Graph may have accepted it before failing, a 5xx is recorded, not sent again
+        self.assertEqual(_GraphStub.seen["2637700009"], 1)
+        self.assertIn("error", results[9])
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.chat_history import fetch_page, make_cursor, parse_cursor
+from frappe_pywce.persistence import bulk_insert_messages
+
+PHONE = "26377880001"
+T0 = datetime(2026, 1, 1, 12, 0, 0)
+
+
+class TestChatHistory(FrappeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        frappe.db.delete("WhatsApp Chat Message", {"phone_number": PHONE})
+
+        # 25 messages, pairs share a timestamp so pages have to break ties on name
+        bulk_insert_messages(
+            [
+                {
+                    "phone_number": PHONE,
+                    "timestamp": T0 + timedelta(seconds=i // 2),
+                    "direction": "Incoming",
+                    "message_type": "text",
+                    "message_text": f"m{i}",
+                    "status": "delivered"
+                }
+                for i in range(25)
+            ],
+            ("phone_number", "timestamp", "direction", "message_type", "message_text", "status")
+        )
+
+    def _page(self, **kwargs):
+        return fetch_page("WhatsApp Chat Message", {"phone_number": PHONE}, ["message_text"], **kwargs)
+
+    def test_newest_page_first(self):
+        page = self._page(limit=10)
+
+        self.assertEqual([m.message_text for m in page["messages"]], [f"m{i}" for i in range(15, 25)])
+        self.assertTrue(page["has_more"])
+
+    def test_walk_back_and_forward(self):
+        page = self._page(limit=10)
+        seen = [m.message_text for m in page["messages"]]
+
+        while page["has_more"]:
+            page = self._page(limit=10, before=page["before"])
+            seen = [m.message_text for m in page["messages"]] + seen
+
+        self.assertEqual(seen, [f"m{i}" for i in range(25)])
+
+        newer = self._page(limit=10, after=page["after"])
+        self.assertEqual([m.message_text for m in newer["messages"]], [f"m{i}" for i in range(5, 15)])
+
+    def test_cursor_round_trip(self):
+        row = {"timestamp": T0, "name": "WCHAT-00042"}
+        self.assertEqual(parse_cursor(make_cursor(row)), (T0, "WCHAT-00042"))
+
+
+class TestBulkInsertMessages(FrappeTestCase):
+    PHONE = "26377880002"
+    FIELDS = ("phone_number", "message_id", "timestamp", "direction", "message_type", "message_text", "status")
+
+    def setUp(self):
+        frappe.db.delete("WhatsApp Chat Message", {"phone_number": self.PHONE})
+
+    def _row(self, message_id, text):
+        return {
+            "phone_number": self.PHONE,
+            "message_id": message_id,
+            "timestamp": T0,
+            "direction": "Incoming",
+            "message_type": "text",
+            "message_text": text,
+            "status": "delivered"
+        }
+
+    def test_stored_message_ids_are_skipped(self):
+        bulk_insert_messages([self._row("wamid.dup.1", "first")], self.FIELDS)
+
+        # a redelivery racing the prefilter: the unique index drops the row, not the batch
+        inserted = bulk_insert_messages(
+            [self._row("wamid.dup.1", "again"), self._row("wamid.dup.2", "second")], self.FIELDS
+        )
+
+        self.assertEqual([m["message_id"] for m in inserted], ["wamid.dup.2"])
+        self.assertEqual(
+            sorted(frappe.get_all(
+                "WhatsApp Chat Message", filters={"phone_number": self.PHONE}, pluck="message_text"
+            )),
+            ["first", "second"]
+        )
@@ -0,0 +1,112 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.frappe_pywce.doctype.whatsapp_chat_message.whatsapp_chat_message import (
+    CHAT_MESSAGE_INDEXES,
+    add_indexes,
+)
+
+SEED_ROWS = 1_000_000
+SEED_PHONES = 5000
+
+
+class TestChatMessageIndexes(FrappeTestCase):
+    """Query plans of the hot WhatsApp Chat Message queries on a seeded table, rolled back after the class"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        if frappe.db.db_type != "mariadb":
+            return
+
+        add_indexes()
+
+        # 1000 x 1000 cross join, spread over SEED_PHONES conversations
+        frappe.db.sql("CREATE TEMPORARY TABLE `tmp_pywce_seq` (`n` INT NOT NULL PRIMARY KEY)")
+        frappe.db.sql(
+            "INSERT INTO `tmp_pywce_seq` (`n`) VALUES " + ", ".join(f"({i})" for i in range(1000))
+        )
+
+        frappe.db.sql(
+            """
+            INSERT INTO `tabWhatsApp Chat Message`
+                (`name`, `phone_number`, `direction`, `status`, `message_type`, `message_text`,
+                 `timestamp`, `creation`, `modified`, `owner`, `modified_by`, `docstatus`)
+            SELECT
+                CONCAT('explain-', a.n * 1000 + b.n),
+                CONCAT('26377', LPAD((a.n * 1000 + b.n) %% %(phones)s, 7, '0')),
+                IF(b.n %% 2, 'Incoming', 'Outgoing'),
+                IF(b.n %% 50, 'read', 'delivered'),
+                'text',
+                'seeded',
+                NOW() - INTERVAL (a.n * 1000 + b.n) SECOND,
+                NOW(), NOW(), 'Administrator', 'Administrator', 0
+            FROM `tmp_pywce_seq` a CROSS JOIN `tmp_pywce_seq` b
+            WHERE a.n * 1000 + b.n < %(rows)s
+            """,
+            {"phones": SEED_PHONES, "rows": SEED_ROWS}
+        )
+
+        frappe.db.sql("DROP TEMPORARY TABLE `tmp_pywce_seq`")
+
+    def setUp(self):
+        if frappe.db.db_type != "mariadb":
+            self.skipTest("query plans are asserted for MariaDB only")
+
+    def _assert_uses_index(self, query, values, *index_names):
+        plan = frappe.db.sql(f"EXPLAIN {query}", values, as_dict=True)
+        keys = {row.get("key") for row in plan}
+
+        self.assertTrue(keys & set(index_names), f"expected one of {index_names}, plan: {plan}")
+        self.assertNotIn("ALL", {row.get("type") for row in plan}, f"full scan in plan: {plan}")
+
+    def test_indexes_exist(self):
+        indexes = {row.Key_name for row in frappe.db.sql("SHOW INDEX FROM `tabWhatsApp Chat Message`", as_dict=True)}
+        self.assertTrue(set(CHAT_MESSAGE_INDEXES) <= indexes)
+
+    def test_last_outgoing_message(self):
+        self._assert_uses_index(
+            """
+            SELECT `template_id`, `message_level`, `next_level`, `timestamp`
+            FROM `tabWhatsApp Chat Message`
+            WHERE `phone_number` = %s AND `direction` = 'Outgoing'
+            ORDER BY `timestamp` DESC LIMIT 1
+            """,
+            ("263770000042",),
+            "phone_direction_timestamp_index"
+        )
+
+    def test_conversation_messages(self):
+        self._assert_uses_index(
+            """
+            SELECT `name`, `message_text`, `timestamp`
+            FROM `tabWhatsApp Chat Message`
+            WHERE `phone_number` = %s
+            ORDER BY `timestamp` ASC LIMIT 100
+            """,
+            ("263770000042",),
+            "phone_timestamp_index", "phone_direction_timestamp_index"
+        )
+
+    def test_mark_conversation_read(self):
+        self._assert_uses_index(
+            """
+            UPDATE `tabWhatsApp Chat Message`
+            SET `status` = 'read'
+            WHERE `phone_number` = %s AND `direction` = 'Incoming' AND `status` != 'read'
+            """,
+            ("263770000042",),
+            "phone_direction_timestamp_index", "phone_timestamp_index"
+        )
+
+    def test_unread_count(self):
+        self._assert_uses_index(
+            """
+            SELECT COUNT(*)
+            FROM `tabWhatsApp Chat Message`
+            WHERE `status` != 'read' AND `direction` = 'Incoming'
+            """,
+            None,
+            "status_direction_index"
+        )
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce import conversation_summary
+from frappe_pywce.conversation_summary import summarize
+
+# far ahead so the seeded conversations are the newest on the test site
+T0 = datetime(2099, 1, 1, 12, 0, 0)
+
+
+def _row(phone, minutes, direction="Incoming", status="delivered", text="hi", contact_name=""):
+    return {
+        "phone_number": phone,
+        "timestamp": T0 + timedelta(minutes=minutes),
+        "direction": direction,
+        "status": status,
+        "message_text": text,
+        "contact_name": contact_name
+    }
+
+
+class TestSummarize(FrappeTestCase):
+    def test_latest_message_and_unread(self):
+        summaries = summarize([
+            _row("2637701", 2, text="second", contact_name="Ann"),
+            _row("2637701", 1, text="first"),
+            _row("2637701", 3, direction="Outgoing", status="sent", text="reply"),
+            _row("2637701", 0, status="read", text="old"),
+        ])
+
+        self.assertEqual(len(summaries), 1)
+        summary = summaries[0]
+
+        self.assertEqual(summary["last_message"], "reply")
+        self.assertEqual(summary["last_direction"], "Outgoing")
+        self.assertEqual(summary["last_message_time"], T0 + timedelta(minutes=3))
+        self.assertEqual(summary["contact_name"], "Ann")
+        self.assertEqual(summary["unread_count"], 2)
+
+    def test_sorted_by_phone_number(self):
+        summaries = summarize([_row("2637703", 0), _row("2637701", 0), _row("2637702", 0)])
+        self.assertEqual([s["phone_number"] for s in summaries], ["2637701", "2637702", "2637703"])
+
+
+class TestConversationSummary(FrappeTestCase):
+    PHONES = ["26377990001", "26377990002", "26377990003"]
+
+    def setUp(self):
+        frappe.db.delete("WhatsApp Conversation", {"name": ["in", self.PHONES]})
+
+    def test_incremental_updates(self):
+        conversation_summary.record_messages([_row(self.PHONES[0], 5, text="later", contact_name="Ann")])
+        # an older message arriving late only adds to the unread count
+        conversation_summary.record_messages([_row(self.PHONES[0], 1, text="earlier")])
+
+        doc = frappe.db.get_value(
+            "WhatsApp Conversation", self.PHONES[0],
+            ["last_message", "contact_name", "unread_count"], as_dict=True
+        )
+        self.assertEqual((doc.last_message, doc.contact_name, doc.unread_count), ("later", "Ann", 2))
+
+        conversation_summary.mark_read(self.PHONES[0])
+        self.assertEqual(frappe.db.get_value("WhatsApp Conversation", self.PHONES[0], "unread_count"), 0)
+
+    def test_keyset_pages(self):
+        conversation_summary.record_messages([
+            _row(phone, 1000 + i) for i, phone in enumerate(self.PHONES)
+        ])
+
+        first = conversation_summary.get_page(limit=2)
+        self.assertEqual([c.phone_number for c in first], self.PHONES[::-1][:2])
+
+        rest = conversation_summary.get_page(
+            limit=2, before_time=first[-1].last_message_time, before_phone=first[-1].phone_number
+        )
+        self.assertEqual(rest[0].phone_number, self.PHONES[0])
@@ -0,0 +1,113 @@
+import json
+from unittest.mock import patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce import flow_cache
+from frappe_pywce.managers import FrappeStorageManager
+
+
+class _Translator:
+    """Stands in for pywce's VisualTranslator, the flow json is {"templates": {name: template}}"""
+
+    calls = 0
+
+    START_MENU = "menu"
+    REPORT_MENU = None
+
+    def translate(self, flow_json):
+        type(self).calls += 1
+        return json.loads(flow_json)["templates"], []
+
+
+def _flow(**templates) -> str:
+    base = {
+        "menu": {"kind": "button", "message": "Hi", "routes": {"1": "order"}, "settings": {"isStart": True}},
+        "order": {"kind": "text", "message": "Your order", "routes": {}},
+    }
+    base.update(templates)
+    return json.dumps({"templates": base})
+
+
+class TestFlowCache(FrappeTestCase):
+    def setUp(self):
+        flow_cache.clear()
+        _Translator.calls = 0
+        self.compiled = []
+
+        def compile_template(manager, name, data):
+            self.compiled.append(name)
+            return {"template": data, "error": "broken" if data.get("broken") else None}
+
+        self.patches = [
+            patch("frappe_pywce.managers.VisualTranslator", _Translator),
+            patch.object(FrappeStorageManager, "_compile_template", compile_template),
+        ]
+
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+        flow_cache.clear()
+
+    def test_cold_load_comes_from_the_artifact(self):
+        first = FrappeStorageManager(_flow())
+        second = FrappeStorageManager(_flow())
+
+        self.assertEqual(_Translator.calls, 1)
+        self.assertEqual(sorted(self.compiled), ["menu", "order"])
+        self.assertEqual(second._TEMPLATES, first._TEMPLATES)
+        self.assertEqual(second.START_MENU, "menu")
+
+    def test_only_changed_templates_are_recompiled(self):
+        FrappeStorageManager(_flow())
+        self.compiled.clear()
+
+        FrappeStorageManager(_flow(order={"kind": "text", "message": "Your new order", "routes": {}}))
+
+        self.assertEqual(_Translator.calls, 2)
+        self.assertEqual(self.compiled, ["order"])
+
+    def test_entries_of_removed_templates_are_dropped(self):
+        FrappeStorageManager(_flow(extra={"kind": "text", "message": "Gone soon", "routes": {}}))
+        FrappeStorageManager(_flow())
+
+        menu = flow_cache.template_digest("menu", json.loads(_flow())["templates"]["menu"])
+        extra = flow_cache.template_digest("extra", {"kind": "text", "message": "Gone soon", "routes": {}})
+
+        self.assertIn(menu, flow_cache.get_compiled_templates([menu, extra]))
+        self.assertNotIn(extra, flow_cache.get_compiled_templates([menu, extra]))
+
+    def test_broken_routes_are_reported_for_changed_templates_only(self):
+        broken = {"kind": "text", "message": "Your order", "routes": {}, "broken": True}
+
+        with patch("frappe_pywce.managers.logger") as logger:
+            manager = FrappeStorageManager(_flow(order=broken))
+
+        self.assertNotIn("order", manager._TEMPLATES)
+        self.assertIn(("  - '%s' -> '%s' (route will fail at runtime)", "menu", "order"), _errors(logger))
+
+        # only menu changed, its route to the still broken order is reported again
+        with patch("frappe_pywce.managers.logger") as logger:
+            FrappeStorageManager(_flow(order=broken, menu={
+                "kind": "button", "message": "Hello", "routes": {"1": "order"}, "settings": {"isStart": True}
+            }))
+
+        self.assertEqual(self.compiled[-1:], ["menu"])
+        self.assertIn(("  - '%s' -> '%s' (route will fail at runtime)", "menu", "order"), _errors(logger))
+
+        # an unrelated change reports nothing
+        with patch("frappe_pywce.managers.logger") as logger:
+            FrappeStorageManager(_flow(order=broken, menu={
+                "kind": "button", "message": "Hello", "routes": {"1": "order"}, "settings": {"isStart": True}
+            }, extra={"kind": "text", "message": "New", "routes": {}}))
+
+        self.assertEqual(self.compiled[-1:], ["extra"])
+        self.assertNotIn(("  - '%s' -> '%s' (route will fail at runtime)", "menu", "order"), _errors(logger))
+
+
+def _errors(logger):
+    return [call.args for call in logger.error.call_args_list]
@@ -0,0 +1,105 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.graph_client import GraphClient
+
+
+class _GraphStub(BaseHTTPRequestHandler):
+    """Answers `failure_status` `failures` times, then a Graph style send response"""
+
+    failures = 0
+    failure_status = 429
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        type(self).requests.append((self.path, self.headers.get("Authorization"), json.loads(body)))
+
+        if type(self).failures > 0:
+            type(self).failures -= 1
+            self.send_response(type(self).failure_status)
+            self.end_headers()
+            return
+
+        response = json.dumps({"messages": [{"id": "wamid.stub"}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGraphClient(FrappeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(("127.0.0.1", 0), _GraphStub)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}/v18.0"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        _GraphStub.failures = 0
+        _GraphStub.failure_status = 429
+        _GraphStub.requests = []
+
+    def test_url_resolution(self):
+        client = GraphClient(base_url="http://emulator:3001/")
+        self.assertEqual(client.url("123/messages"), "http://emulator:3001/123/messages")
+        self.assertEqual(client.url("https://lookaside.fbsbx.com/x"), "https://lookaside.fbsbx.com/x")
+
+    def test_token_only_goes_to_graph_and_media_hosts(self):
+        client = GraphClient(base_url=self.base_url)
+
+        self.assertTrue(client.is_trusted(f"{self.base_url}/123"))
+        self.assertTrue(client.is_trusted("https://lookaside.fbsbx.com/whatsapp_business/attachments/?mid=1"))
+        self.assertFalse(client.is_trusted("https://attacker.example/fbsbx.com"))
+
+        with self.assertRaises(ValueError):
+            client.get("https://attacker.example/collect", "token")
+
+        self.assertEqual(_GraphStub.requests, [])
+
+    def test_send_message(self):
+        result = GraphClient(base_url=self.base_url).send_message("123", "token", {"to": "263770000001"})
+
+        self.assertEqual(result["messages"][0]["id"], "wamid.stub")
+        self.assertEqual(_GraphStub.requests, [("/v18.0/123/messages", "Bearer token", {"to": "263770000001"})])
+
+    def test_retries_on_429(self):
+        _GraphStub.failures = 2
+
+        result = GraphClient(base_url=self.base_url).send_message("123", "token", {"to": "263770000001"})
+
+        self.assertEqual(result["messages"][0]["id"], "wamid.stub")
+        self.assertEqual(len(_GraphStub.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        _GraphStub.failures = 10
+
+        with self.assertRaises(Exception):
+            GraphClient(base_url=self.base_url, retries=1).send_message("123", "token", {})
+
+        self.assertEqual(len(_GraphStub.requests), 2)
+
+    def test_send_is_not_repeated_on_5xx(self):
+        # Graph may have accepted the message before failing, a retry could deliver it twice
+        _GraphStub.failures = 1
+        _GraphStub.failure_status = 502
+
+        with self.assertRaises(Exception):
+            GraphClient(base_url=self.base_url).send_message("123", "token", {"to": "263770000001"})
+
+        self.assertEqual(len(_GraphStub.requests), 1)
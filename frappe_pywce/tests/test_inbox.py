@@ -0,0 +1,148 @@
+import json
+import unittest
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.inbox import (
+    INBOX_GROUP,
+    InboxConsumer,
+    dead_letter_key,
+    extract_wa_id,
+    partition_for,
+    push,
+    stream_key,
+)
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, fakeredis needs it for EVAL
+except ImportError:
+    fakeredis = None
+
+
+def _payload(wa_id, msg_id):
+    return {
+        "entry": [{
+            "changes": [{
+                "value": {
+                    "contacts": [{"wa_id": wa_id}],
+                    "messages": [{"from": wa_id, "id": msg_id, "type": "text", "text": {"body": "hi"}}]
+                }
+            }]
+        }]
+    }
+
+
+@unittest.skipUnless(fakeredis, "fakeredis[lua] is not installed")
+class TestInbox(FrappeTestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+        self.handled = []
+
+    def _push(self, wa_id, msg_id):
+        return push(wa_id, json.dumps(_payload(wa_id, msg_id)).encode(), conn=self.conn)
+
+    def _consumer(self, handler=None, consumer="test", **kwargs):
+        return InboxConsumer(
+            handler or (lambda wa_id, payload: self.handled.append((wa_id, payload))),
+            conn=self.conn,
+            consumer=consumer,
+            **kwargs
+        )
+
+    def test_extract_wa_id(self):
+        self.assertEqual(extract_wa_id(_payload("263770000001", "m1")), "263770000001")
+        self.assertEqual(
+            extract_wa_id({"entry": [{"changes": [{"value": {"statuses": [{"recipient_id": "2637"}]}}]}]}),
+            "2637"
+        )
+        self.assertIsNone(extract_wa_id({"entry": []}))
+
+    def test_same_wa_id_same_partition(self):
+        self._push("263770000001", "m1")
+        self._push("263770000001", "m2")
+
+        key = stream_key(partition_for("263770000001"))
+        self.assertEqual(self.conn.xlen(key), 2)
+
+    def test_processed_entries_are_acked_and_removed(self):
+        self._push("263770000001", "m1")
+        self._push("263770000002", "m2")
+
+        consumer = self._consumer()
+        self.assertEqual(consumer.drain_once(), 2)
+        self.assertEqual({wa_id for wa_id, _ in self.handled}, {"263770000001", "263770000002"})
+
+        for key in consumer.keys:
+            self.assertEqual(self.conn.xlen(key), 0)
+            self.assertEqual(self.conn.xpending(key, INBOX_GROUP)["pending"], 0)
+
+    def test_failed_entry_is_retried(self):
+        self._push("263770000001", "m1")
+        attempts = []
+
+        def flaky(wa_id, payload):
+            attempts.append(wa_id)
+            if len(attempts) == 1:
+                raise Exception("temporary failure")
+
+        consumer = self._consumer(flaky, claim_idle_ms=0)
+        consumer.drain_once()
+        consumer.drain_once()
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.conn.xlen(stream_key(partition_for("263770000001"))), 0)
+
+    def test_dead_letter_after_max_deliveries(self):
+        self._push("263770000001", "m1")
+
+        def broken(wa_id, payload):
+            raise Exception("permanent failure")
+
+        consumer = self._consumer(broken, claim_idle_ms=0, max_deliveries=2)
+
+        for _ in range(4):
+            consumer.drain_once()
+
+        dead = self.conn.xrange(dead_letter_key())
+        self.assertEqual(len(dead), 1)
+        self.assertEqual(dead[0][1][b"wa_id"], b"263770000001")
+        self.assertEqual(self.conn.xlen(stream_key(partition_for("263770000001"))), 0)
+
+    def test_failed_entry_blocks_later_entries_of_its_partition(self):
+        self._push("263770000001", "m1")
+        self._push("263770000001", "m2")
+        handled = []
+
+        def flaky(wa_id, payload):
+            msg_id = payload["entry"][0]["changes"][0]["value"]["messages"][0]["id"]
+            if msg_id == "m1" and "m1-failed" not in handled:
+                handled.append("m1-failed")
+                raise Exception("temporary failure")
+            handled.append(msg_id)
+
+        consumer = self._consumer(flaky)
+
+        self.assertEqual(consumer.drain_once(), 0)
+        self.assertEqual(handled, ["m1-failed"])
+
+        self.assertEqual(consumer.drain_once(), 2)
+        self.assertEqual(handled, ["m1-failed", "m1", "m2"])
+
+    def test_partition_is_drained_by_one_consumer(self):
+        self._push("263770000001", "m1")
+
+        first = self._consumer(lambda wa_id, payload: None, consumer="first")
+        second = self._consumer(consumer="second")
+
+        # first holds every partition, even those it found empty
+        first.drain_once()
+        self._push("263770000001", "m2")
+
+        self.assertEqual(second.drain_once(), 0)
+        self.assertEqual(self.handled, [])
+
+        first.release()
+
+        self.assertEqual(second.drain_once(), 1)
+        self.assertEqual(len(self.handled), 1)
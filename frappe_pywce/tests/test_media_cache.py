@@ -0,0 +1,40 @@
+import hashlib
+import os
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.media_cache import MediaTooLargeError, cache_dir, check_media_id, content_path, stream_to_cache
+
+
+class TestMediaCache(FrappeTestCase):
+    def tearDown(self):
+        path = frappe.get_site_path(content_path(hashlib.sha256(b"hello media").hexdigest()))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def test_stream_is_content_addressed_and_deduplicated(self):
+        first = stream_to_cache(iter([b"hello ", b"", b"media"]))
+        second = stream_to_cache(iter([b"hello media"]))
+
+        self.assertEqual(first, second)
+        self.assertEqual(first["sha256"], hashlib.sha256(b"hello media").hexdigest())
+        self.assertEqual(first["size"], 11)
+
+        with open(frappe.get_site_path(first["file_path"]), "rb") as f:
+            self.assertEqual(f.read(), b"hello media")
+
+        self.assertFalse([name for name in os.listdir(cache_dir()) if name.startswith(".download-")])
+
+    def test_oversized_stream_leaves_nothing_behind(self):
+        with self.assertRaises(MediaTooLargeError):
+            stream_to_cache(iter([b"x" * 8, b"x" * 8]), max_size=10)
+
+        self.assertFalse([name for name in os.listdir(cache_dir()) if name.startswith(".download-")])
+
+    def test_media_id_must_not_be_a_url(self):
+        self.assertEqual(check_media_id(" 1234567890 "), "1234567890")
+
+        for media_id in ("https://attacker.example/x", "//attacker.example/x", "123/../me", "unknown-media"):
+            with self.assertRaises(frappe.PermissionError):
+                check_media_id(media_id)
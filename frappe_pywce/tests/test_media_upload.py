@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.media_upload import StreamBody, multipart_body
+
+
+class TestMediaUpload(FrappeTestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        self.content = os.urandom(200_000)
+
+        with os.fdopen(handle, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_stream_body_reads_and_rewinds_across_parts(self):
+        with StreamBody([b"head", (self.path, 10, 100_000), b"tail"]) as body:
+            self.assertEqual(len(body), 100_008)
+
+            first = b"".join(iter(lambda: body.read(8192), b""))
+            self.assertEqual(first, b"head" + self.content[10:100_010] + b"tail")
+
+            # a retried request starts over
+            body.seek(0)
+            self.assertEqual(body.read(), first)
+            self.assertEqual(body.read(), b"")
+
+    def test_multipart_body_wraps_the_file(self):
+        body, content_type = multipart_body(
+            {"messaging_product": "whatsapp"}, 'bro"chure.pdf', "application/pdf", (self.path, 0, len(self.content))
+        )
+        boundary = content_type.split("boundary=")[1]
+
+        with body:
+            data = body.read()
+
+        self.assertEqual(len(data), len(body))
+        self.assertIn(b'name="file"; filename="brochure.pdf"', data)
+        self.assertIn(b"\r\n\r\n" + self.content + f"\r\n--{boundary}--\r\n".encode(), data)
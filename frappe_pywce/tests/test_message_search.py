@@ -0,0 +1,22 @@
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.message_search import boolean_query, query_terms, snippet
+
+
+class TestMessageSearch(FrappeTestCase):
+    def test_boolean_query_skips_unindexed_words(self):
+        terms = query_terms("Is my ORDER ok, order status?")
+
+        self.assertEqual(terms, ["is", "my", "order", "ok", "status"])
+        self.assertEqual(boolean_query(terms), "+order* +status*")
+        self.assertEqual(boolean_query(query_terms("is it ok")), "")
+
+    def test_snippet_highlights_and_escapes(self):
+        text = "x" * 100 + " Your <b>order</b> ORDERS are ready " + "y" * 100
+
+        result = snippet(text, ["order"], radius=20)
+
+        self.assertTrue(result.startswith("…") and result.endswith("…"))
+        self.assertIn("&lt;b&gt;<mark>order</mark>&lt;/b&gt;", result)
+        self.assertIn("<mark>ORDERS</mark>", result)
+        self.assertNotIn("<b>", result)
@@ -0,0 +1,204 @@
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.delayed_send import DeferringWhatsApp, defer_next_send, on_deferred_sent, schedule_send
+from frappe_pywce.outbound import (
+    LANE_BULK,
+    LANE_INTERACTIVE,
+    WAIT_NONE,
+    WAIT_PAIR,
+    WAIT_PHONE,
+    OutboundDispatcher,
+    RateLimiter,
+    SendThrottledError,
+    throttle,
+)
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, fakeredis needs it for EVAL
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipUnless(fakeredis, "fakeredis[lua] is not installed")
+class TestRateLimiter(FrappeTestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+
+    def _limiter(self, **kwargs):
+        options = dict(rate=1, burst=5, pair_rate=0.001, pair_burst=100, bulk_reserve=0.4)
+        options.update(kwargs)
+        return RateLimiter(conn=self.conn, **options)
+
+    def test_burst_then_phone_limit(self):
+        limiter = self._limiter()
+
+        for i in range(5):
+            self.assertEqual(limiter.try_acquire("phone", f"user{i}")[1], WAIT_NONE)
+
+        wait, reason = limiter.try_acquire("phone", "user9")
+        self.assertEqual(reason, WAIT_PHONE)
+        self.assertGreater(wait, 0)
+
+    def test_pair_limit_is_per_recipient(self):
+        limiter = self._limiter(rate=100, burst=100, pair_burst=2)
+
+        self.assertEqual(limiter.try_acquire("phone", "user1")[1], WAIT_NONE)
+        self.assertEqual(limiter.try_acquire("phone", "user1")[1], WAIT_NONE)
+        self.assertEqual(limiter.try_acquire("phone", "user1")[1], WAIT_PAIR)
+        self.assertEqual(limiter.try_acquire("phone", "user2")[1], WAIT_NONE)
+
+    def test_bulk_leaves_headroom_for_interactive(self):
+        limiter = self._limiter()
+
+        # burst 5 with 40% reserved: bulk stops with 2 tokens left
+        granted = 0
+        while limiter.try_acquire("phone", f"bulk{granted}", LANE_BULK)[1] == WAIT_NONE:
+            granted += 1
+
+        self.assertEqual(granted, 3)
+        self.assertEqual(limiter.try_acquire("phone", "reply1", LANE_INTERACTIVE)[1], WAIT_NONE)
+        self.assertEqual(limiter.try_acquire("phone", "reply2", LANE_INTERACTIVE)[1], WAIT_NONE)
+
+    def test_throttle_fails_fast_on_a_limited_pair(self):
+        limiter = self._limiter(rate=100, burst=100, pair_rate=1 / 6, pair_burst=1)
+
+        with patch("frappe_pywce.outbound.RateLimiter", return_value=limiter):
+            throttle("phone", "user1")
+
+            started = time.monotonic()
+            with self.assertRaises(SendThrottledError):
+                throttle("phone", "user1")
+
+            # a 6 s pair wait is refused up front, not slept through
+            self.assertLess(time.monotonic() - started, 1)
+
+
+@unittest.skipUnless(fakeredis, "fakeredis[lua] is not installed")
+class TestOutboundDispatcher(FrappeTestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+        self.sent = []
+        limiter = RateLimiter(conn=self.conn, rate=1000, burst=1000, pair_rate=1000, pair_burst=1, bulk_reserve=0)
+        self.dispatcher = OutboundDispatcher(self.sent.append, conn=self.conn, limiter=limiter, site="test")
+
+    def _drain(self):
+        while self.dispatcher.dispatch_once():
+            pass
+
+    def test_interactive_lane_first(self):
+        self.dispatcher.enqueue("phone", {"to": "user1", "n": 1}, lane=LANE_BULK)
+        self.dispatcher.enqueue("phone", {"to": "user2", "n": 2}, lane=LANE_BULK)
+        self.dispatcher.enqueue("phone", {"to": "user3", "n": 3}, lane=LANE_INTERACTIVE)
+
+        self._drain()
+
+        self.assertEqual([e["payload"]["n"] for e in self.sent], [3, 1, 2])
+
+    def test_pair_limited_entry_does_not_block_lane(self):
+        self.dispatcher.limiter.pair_rate = 0.001
+
+        self.dispatcher.enqueue("phone", {"to": "user1", "n": 1})
+        self.dispatcher.enqueue("phone", {"to": "user1", "n": 2})
+        self.dispatcher.enqueue("phone", {"to": "user2", "n": 3})
+
+        self._drain()
+
+        self.assertEqual([e["payload"]["n"] for e in self.sent], [1, 3])
+        self.assertEqual(self.dispatcher.depth()["delayed"], 1)
+        self.assertEqual(self.dispatcher.stats["deferred"], 1)
+
+    def test_scheduled_entry_waits_until_due(self):
+        now = time.time()
+        self.dispatcher.schedule("phone", {"to": "user1", "n": 1}, now + 60)
+        self.dispatcher.schedule("phone", {"to": "user2", "n": 2}, now - 1)
+
+        self._drain()
+
+        self.assertEqual([e["payload"]["n"] for e in self.sent], [2])
+        self.assertEqual(self.sent[0]["lane"], LANE_INTERACTIVE)
+        self.assertEqual(self.dispatcher.depth()["delayed"], 1)
+
+    def test_worker_keeps_a_heartbeat_while_running(self):
+        alive = []
+        self.dispatcher.sender = lambda entry: alive.append(self.dispatcher.worker_alive())
+        self.dispatcher.enqueue("phone", {"to": "user1", "n": 1})
+
+        self.dispatcher.run(max_s=0.01)
+
+        self.assertEqual(alive, [True])
+        self.assertFalse(self.dispatcher.worker_alive())
+
+    def test_flush_overdue_only_without_worker(self):
+        now = time.time()
+        self.dispatcher.schedule("phone", {"to": "user1", "n": 1}, now - 1)
+
+        self.assertEqual(self.dispatcher.flush_overdue(grace_s=30), 0)
+
+        self.dispatcher.schedule("phone", {"to": "user2", "n": 2}, now - 60)
+
+        self.assertEqual(self.dispatcher.flush_overdue(grace_s=30), 2)
+        self.assertEqual([e["payload"]["n"] for e in self.sent], [2, 1])
+
+
+@unittest.skipUnless(fakeredis, "fakeredis[lua] is not installed")
+class TestDeferredSend(FrappeTestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+        self.sent = []
+
+        limiter = RateLimiter(conn=self.conn, rate=1000, burst=1000, pair_rate=1000, pair_burst=100, bulk_reserve=0)
+        self.dispatcher = OutboundDispatcher(self._send, conn=self.conn, limiter=limiter)
+
+        self.client = DeferringWhatsApp.__new__(DeferringWhatsApp)
+        self.client.config = SimpleNamespace(phone_number_id="phone", use_emulator=False)
+
+        self.patches = [
+            patch("frappe_pywce.delayed_send.get_redis_conn", return_value=self.conn),
+            patch("frappe_pywce.delayed_send.get_dispatcher", return_value=self.dispatcher),
+            patch("frappe_pywce.outbound.frappe.enqueue"),
+        ]
+
+        # the mock of the last patch, frappe.enqueue
+        self.enqueue = [p.start() for p in self.patches][-1]
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def _send(self, entry):
+        self.sent.append(entry)
+        on_deferred_sent(entry, {})
+
+    def test_send_after_a_delayed_one_keeps_recipient_order(self):
+        defer_next_send("user1", 0.2)
+        self.client._send_request("text", "user1", {"to": "user1", "n": 1})
+
+        # not delayed itself, but must not overtake the delayed one
+        self.client._send_request("text", "user1", {"to": "user1", "n": 2})
+
+        self.assertFalse(self.dispatcher.dispatch_once())
+        self.assertEqual(self.dispatcher.depth()["delayed"], 2)
+
+        # no worker heartbeat, the fallback job is started
+        self.assertEqual(self.enqueue.call_args[0][0], "frappe_pywce.outbound.dispatch_due")
+
+        time.sleep(0.3)
+        self.dispatcher.run(burst=True)
+
+        self.assertEqual([e["payload"]["n"] for e in self.sent], [1, 2])
+        self.assertLess(self.sent[0]["due"], self.sent[1]["due"])
+
+        # both are out, the next send goes straight to Graph again
+        self.assertIsNone(schedule_send("phone", "user1", {"to": "user1", "n": 3}))
+
+    def test_worker_heartbeat_skips_the_fallback_job(self):
+        self.conn.set(self.dispatcher._heartbeat_key(), 1)
+
+        self.assertIsNotNone(schedule_send("phone", "user1", {"to": "user1", "n": 1}, delay=5))
+        self.enqueue.assert_not_called()
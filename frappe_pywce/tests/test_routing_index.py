@@ -0,0 +1,190 @@
+import random
+import re
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.routing_engine import RoutingEngine
+from frappe_pywce.routing_index import AhoCorasick, CompiledRoutingIndex
+
+
+# the RoutingEngine lookups before they moved to the precompiled index, kept as the reference
+
+def _reference_route(template, incoming_text):
+    routes = template.get('routes', [])
+
+    for route in routes:
+        pattern = (route.get('pattern') or "").strip().lower()
+
+        if not route.get('isRegex', False):
+            if pattern == incoming_text:
+                return route
+            if pattern and pattern in incoming_text:
+                return route
+
+    for route in routes:
+        pattern = route.get('pattern', '')
+
+        if route.get('isRegex', False) and pattern:
+            try:
+                if re.match(pattern, incoming_text, re.IGNORECASE):
+                    return route
+            except re.error:
+                continue
+
+    return None
+
+
+def _reference_trigger(templates, incoming_text, original_message):
+    for template in templates:
+        trigger = template.get('settings', {}).get('trigger', '')
+
+        if not trigger:
+            continue
+
+        try:
+            if re.match(trigger, original_message, re.IGNORECASE):
+                return template
+        except re.error:
+            if trigger.lower() in incoming_text:
+                return template
+
+    return None
+
+
+def _route(pattern, connected_to, is_regex=False):
+    return {"pattern": pattern, "isRegex": is_regex, "connectedTo": connected_to}
+
+
+MENU_ROUTES = [
+    _route(r"(yes|yeah|yep)\b", "confirm", is_regex=True),
+    _route(r"^\d{3}$", "code"),
+    _route("Order", "order"),
+    _route("order status", "status"),
+    _route("help", "help"),
+    _route(r"^\d+$", "number", is_regex=True),
+    _route(r"([a-z])\1", "double", is_regex=True),
+    _route("[unclosed", "broken", is_regex=True),
+    _route(r"y.*", "any_y", is_regex=True),
+    _route("", "empty"),
+]
+
+CHATBOT = {
+    "id": "flow-test",
+    "templates": [
+        {"id": "menu", "routes": MENU_ROUTES, "settings": {"isStart": True, "message_level": "1"}},
+        # no backreference, its regex routes are matched as one alternation
+        {"id": "ask", "routes": [
+            _route(r"(yes|yeah|yep)\b", "confirm", is_regex=True),
+            _route(r"^\d+$", "number", is_regex=True),
+            _route(r"y.*", "any_y", is_regex=True),
+            _route("no", "decline"),
+        ], "settings": {}},
+        {"id": "greet", "routes": [], "settings": {"trigger": r"^(hi|hello)\b", "message_level": "2"}},
+        {"id": "plain", "routes": [], "settings": {"trigger": "need (help"}},
+        {"id": "start", "routes": [], "settings": {"trigger": "start"}},
+        {"id": "late_hi", "routes": [], "settings": {"trigger": "hi", "message_level": "2"}},
+        {"id": "late_plain", "routes": [], "settings": {"trigger": "(help"}},
+    ]
+}
+
+MESSAGES = [
+    "", "order", "ORDER", "my order status please", "order status", "help", "i need help",
+    "yes", "Yeah sure", "yep", "y", "you", "123", "12345", "aab", "book", "hi", "Hello there",
+    "hithere", "yes, help", "yes or no", "no", "start", "Start now", "need (help", "I need (help now", "(help",
+    "hi, I need (help", "nothing matches",
+]
+
+
+class TestCompiledRoutingIndex(FrappeTestCase):
+    def setUp(self):
+        self.index = CompiledRoutingIndex(CHATBOT)
+        self.menu = CHATBOT["templates"][0]
+
+    def _route(self, text):
+        route = self.index.find_route(self.menu, text)
+        return route and route["connectedTo"]
+
+    def test_routes_match_the_reference(self):
+        for template in CHATBOT["templates"][:2]:
+            for message in MESSAGES:
+                text = message.strip().lower()
+                with self.subTest(template=template["id"], message=message):
+                    self.assertIs(self.index.find_route(template, text), _reference_route(template, text))
+
+    def test_triggers_match_the_reference(self):
+        templates = CHATBOT["templates"]
+
+        for message in MESSAGES:
+            text = message.strip().lower()
+            with self.subTest(message=message):
+                self.assertIs(
+                    self.index.find_by_trigger(text, message),
+                    _reference_trigger(templates, text, message)
+                )
+
+    def test_route_precedence(self):
+        # plain routes win over regex routes, whatever their position
+        self.assertEqual(self._route("yes, help"), "help")
+        self.assertEqual(self._route("yes"), "confirm")
+
+        # plain patterns are literals, not regexes
+        self.assertEqual(self._route("123"), "number")
+        self.assertEqual(self._route(r"^\d{3}$"), "code")
+
+        # the first contained pattern wins over a later exact one
+        self.assertEqual(self._route("order status"), "order")
+
+        # among regex routes the first match in route order, combined or one by one
+        ask = CHATBOT["templates"][1]
+        self.assertEqual(self._route("yeah"), "confirm")
+        self.assertEqual(self._route("you"), "any_y")
+        self.assertEqual(self.index.find_route(ask, "yeah")["connectedTo"], "confirm")
+        self.assertEqual(self.index.find_route(ask, "you")["connectedTo"], "any_y")
+        self.assertEqual(self.index.find_route(ask, "yes or no")["connectedTo"], "decline")
+
+        # a backreference keeps its meaning, an invalid pattern is skipped
+        self.assertEqual(self._route("aab"), "double")
+        self.assertIsNone(self._route("[unclosed"))
+
+        self.assertEqual(self._route(""), "empty")
+
+    def test_trigger_precedence(self):
+        def trigger(message):
+            template = self.index.find_by_trigger(message.strip().lower(), message)
+            return template and template["id"]
+
+        # regex and plain (invalid regex) triggers compete in template order
+        self.assertEqual(trigger("hi"), "greet")
+        self.assertEqual(trigger("need (help"), "plain")
+        self.assertEqual(trigger("(help"), "late_plain")
+        self.assertEqual(trigger("hi, I need (help"), "greet")
+
+        # regex triggers match the raw message from its start, plain ones anywhere
+        self.assertEqual(trigger("Hello there"), "greet")
+        self.assertEqual(trigger("please start"), None)
+        self.assertEqual(trigger("I need (help now"), "plain")
+
+    def test_level_and_start_templates(self):
+        self.assertEqual(self.index.find_by_level("2")["id"], "greet")
+        self.assertIsNone(self.index.find_by_level("9"))
+        self.assertEqual(self.index.start_template["id"], "menu")
+
+    def test_engine_routes_through_the_index(self):
+        engine = RoutingEngine(CHATBOT)
+
+        self.assertIs(engine.index, CompiledRoutingIndex.for_chatbot(CHATBOT))
+        self.assertEqual(engine._find_route_match(self.menu, "yes")["connectedTo"], "confirm")
+        self.assertEqual(engine._find_template_by_trigger("start", "start")["id"], "start")
+
+
+class TestAhoCorasick(FrappeTestCase):
+    def test_lowest_rank_of_contained_patterns(self):
+        rng = random.Random(7)
+
+        for _ in range(200):
+            patterns = [("".join(rng.choice("ab") for _ in range(rng.randint(1, 4))), rank) for rank in range(6)]
+            text = "".join(rng.choice("abc") for _ in range(rng.randint(0, 12)))
+
+            expected = min((rank for pattern, rank in patterns if pattern in text), default=None)
+            with self.subTest(patterns=patterns, text=text):
+                self.assertEqual(AhoCorasick(patterns).best(text), expected)
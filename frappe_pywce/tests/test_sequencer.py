@@ -0,0 +1,155 @@
+import queue
+import random
+import threading
+import unittest
+from collections import defaultdict
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.sequencer import HashRing, Sequencer
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, fakeredis needs it for EVAL
+except ImportError:
+    fakeredis = None
+
+
+class TestHashRing(FrappeTestCase):
+    def test_stable_and_spread(self):
+        ring = HashRing(32)
+        wa_ids = [f"2637700{i:05d}" for i in range(2000)]
+
+        self.assertEqual([ring.get(w) for w in wa_ids], [HashRing(32).get(w) for w in wa_ids])
+        self.assertEqual(len({ring.get(w) for w in wa_ids}), 32)
+
+    def test_adding_partitions_moves_few_keys(self):
+        wa_ids = [f"2637700{i:05d}" for i in range(2000)]
+        before, after = HashRing(32), HashRing(33)
+
+        moved = sum(1 for w in wa_ids if before.get(w) != after.get(w))
+        self.assertLess(moved, len(wa_ids) * 0.2)
+
+
+@unittest.skipUnless(fakeredis, "fakeredis[lua] is not installed")
+class TestSequencer(FrappeTestCase):
+    USERS = 50
+    MESSAGES = 1000
+    WORKERS = 8
+
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+        self.jobs = queue.Queue()
+        self.handled = defaultdict(list)
+        self.active = set()
+        self.overlaps = []
+        self.guard = threading.Lock()
+
+    def _handler(self, wa_id, payload):
+        partition = self.sequencer.ring.get(wa_id)
+
+        with self.guard:
+            if partition in self.active:
+                self.overlaps.append(partition)
+            self.active.add(partition)
+
+        self.handled[wa_id].append(payload["seq"])
+
+        with self.guard:
+            self.active.discard(partition)
+
+    def _schedule(self, partition, token):
+        self.jobs.put((partition, token))
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            self.sequencer.drain(*job, batch_size=7)
+            self.jobs.task_done()
+
+    def test_interleaved_messages_keep_order_without_drops(self):
+        self.sequencer = Sequencer(self._handler, schedule=self._schedule, conn=self.conn, site="test")
+
+        workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        rng = random.Random(7)
+        sent = defaultdict(list)
+
+        for i in range(self.MESSAGES):
+            wa_id = f"26377000{rng.randrange(self.USERS):04d}"
+            sent[wa_id].append(i)
+            self.sequencer.submit(wa_id, {"seq": i})
+
+        self.jobs.join()
+
+        for _ in workers:
+            self.jobs.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+
+        self.assertEqual(sum(len(v) for v in self.handled.values()), self.MESSAGES)
+        self.assertEqual(dict(self.handled), dict(sent))
+        self.assertEqual(self.overlaps, [])
+
+        stats = self.sequencer.stats()
+        self.assertEqual(sum(s["depth"] for s in stats), 0)
+        self.assertEqual(sum(s["processed"] for s in stats), self.MESSAGES)
+        self.assertFalse(any(s["draining"] for s in stats))
+
+    def test_stats_report_lag(self):
+        self.sequencer = Sequencer(self._handler, schedule=lambda partition, token: None, conn=self.conn, site="test")
+        partition = self.sequencer.submit("263770000001", {"seq": 1})
+
+        stats = {s["partition"]: s for s in self.sequencer.stats()}
+        self.assertEqual(stats[partition]["depth"], 1)
+        self.assertTrue(stats[partition]["draining"])
+        self.assertGreaterEqual(stats[partition]["lag_seconds"], 0)
+
+    def test_expired_drainer_does_not_pop_for_its_successor(self):
+        scheduled = []
+        self.sequencer = Sequencer(
+            self._handler, schedule=lambda partition, token: scheduled.append(token), conn=self.conn, site="test"
+        )
+
+        partition = self.sequencer.submit("263770000001", {"seq": 1})
+        self.sequencer.submit("263770000001", {"seq": 2})
+        stale = scheduled.pop()
+
+        # the lease runs out under a backlog and the scheduler starts a second drainer
+        self.conn.delete(self.sequencer._drainer_key(partition))
+        self.assertEqual(self.sequencer.kick_stalled(), [partition])
+        current = scheduled.pop()
+
+        # handles the head, finds its lease gone and leaves the list alone
+        self.assertEqual(self.sequencer.drain(partition, stale), 0)
+        self.assertEqual(self.conn.llen(self.sequencer._key(partition)), 2)
+
+        self.sequencer.drain(partition, current)
+
+        # the head is handled twice (at-least-once), nothing is dropped
+        self.assertEqual(self.handled["263770000001"], [1, 1, 2])
+        self.assertEqual(self.conn.llen(self.sequencer._key(partition)), 0)
+        self.assertFalse(self.conn.exists(self.sequencer._drainer_key(partition)))
+
+    def test_inline_submit_only_handles_its_own_entry(self):
+        scheduled = []
+        self.sequencer = Sequencer(
+            self._handler, schedule=lambda partition, token: scheduled.append(partition), conn=self.conn, site="test"
+        )
+
+        partition = self.sequencer.submit("263770000001", {"seq": 1}, inline=True)
+
+        self.assertEqual(self.handled["263770000001"], [1])
+        self.assertEqual(scheduled, [])
+
+        # a backlog from another user of the partition is left to a drain job
+        self.conn.rpush(self.sequencer._key(partition), '{"wa_id": "other", "payload": {"seq": 0}, "enqueued_at": 0}')
+        self.sequencer.submit("263770000001", {"seq": 2}, inline=True)
+
+        self.assertEqual(self.handled["263770000001"], [1])
+        self.assertEqual(scheduled, [partition])
@@ -0,0 +1,131 @@
+import json
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce.managers import FrappeRedisSessionManager
+from frappe_pywce.session_store import SessionStore
+
+SESSION_ID = "263770000001"
+
+
+class TestFrappeRedisSessionManager(FrappeTestCase):
+    def setUp(self):
+        self.manager = FrappeRedisSessionManager()
+        self.manager.clear(SESSION_ID)
+        SessionStore._migration_checked.discard(SESSION_ID)
+
+    def tearDown(self):
+        self.manager.clear(SESSION_ID)
+        frappe.cache.delete_value(f"fpw:{SESSION_ID}")
+
+    def test_save_get_evict(self):
+        self.manager.save_all(SESSION_ID, {"stage": "menu", "cart": [1, 2], "meta": {"a": 1}})
+        self.manager.save(SESSION_ID, "stage", "checkout")
+
+        self.assertEqual(self.manager.get(SESSION_ID, "stage"), "checkout")
+        self.assertEqual(self.manager.get(SESSION_ID, "cart"), [1, 2])
+
+        self.manager.evict_all(SESSION_ID, ["cart", "meta"])
+        self.assertEqual(self.manager.fetch_all(SESSION_ID), {"stage": "checkout"})
+        self.assertFalse(self.manager.key_in_session(SESSION_ID, "cart", check_global=False))
+
+    def test_props_are_fields(self):
+        self.manager.save_prop(SESSION_ID, "name", "Tino")
+        self.manager.save_prop(SESSION_ID, "age", 30)
+
+        self.assertEqual(self.manager.get_user_props(SESSION_ID), {"name": "Tino", "age": 30})
+        self.assertEqual(self.manager.get_from_props(SESSION_ID, "age"), 30)
+        self.assertTrue(self.manager.evict_prop(SESSION_ID, "age"))
+        self.assertFalse(self.manager.evict_prop(SESSION_ID, "age"))
+
+        self.manager.save(SESSION_ID, self.manager.prop_key, {"city": "Harare"})
+        self.assertEqual(self.manager.get(SESSION_ID, self.manager.prop_key), {"city": "Harare"})
+
+    def test_clear_retains_keys(self):
+        self.manager.save_all(SESSION_ID, {"auth:user": "x", "auth:expiry": 1, "stage": "menu"})
+        self.manager.save_prop(SESSION_ID, "name", "Tino")
+
+        self.manager.clear(SESSION_ID, retain_keys=["auth", "props"])
+
+        self.assertEqual(
+            self.manager.fetch_all(SESSION_ID),
+            {"auth:user": "x", "auth:expiry": 1, self.manager.prop_key: {"name": "Tino"}}
+        )
+
+    def test_legacy_blob_is_migrated(self):
+        legacy = {"stage": "menu", self.manager.prop_key: {"name": "Tino"}}
+        frappe.cache.set_value(f"fpw:{SESSION_ID}", json.dumps(legacy), expires_in_sec=60)
+
+        self.assertEqual(self.manager.fetch_all(SESSION_ID), legacy)
+        self.assertEqual(self.manager.get_from_props(SESSION_ID, "name"), "Tino")
+        self.assertIsNone(frappe.cache.get_value(f"fpw:{SESSION_ID}", expires=True))
+
+    def test_ttl_is_refreshed(self):
+        self.manager.save(SESSION_ID, "stage", "menu")
+        key = self.manager.store.key(SESSION_ID)
+
+        frappe.cache.expire(key, 5)
+        self.manager.get(SESSION_ID, "stage")
+
+        self.assertGreater(frappe.cache.ttl(key), 5)
+
+    def test_scope_serves_reads_from_memory_and_flushes_once(self):
+        self.manager.save_all(SESSION_ID, {"stage": "menu", "cart": [1]})
+
+        with self.manager.scope(SESSION_ID) as uow:
+            for _ in range(10):
+                self.manager.get(SESSION_ID, "stage")
+                self.manager.get_user_props(SESSION_ID)
+                self.manager.key_in_session(SESSION_ID, "stage", check_global=False)
+
+            self.manager.save(SESSION_ID, "stage", "checkout")
+            self.manager.save_prop(SESSION_ID, "name", "Tino")
+            self.manager.evict(SESSION_ID, "cart")
+
+            # nothing written yet
+            self.assertEqual(self.manager.store.get(SESSION_ID, "stage"), "menu")
+            self.assertEqual(self.manager.get(SESSION_ID, "stage"), "checkout")
+
+        # one HGETALL, the read above and one pipelined flush
+        self.assertEqual(uow.round_trips, 3)
+        self.assertEqual(
+            self.manager.fetch_all(SESSION_ID),
+            {"stage": "checkout", self.manager.prop_key: {"name": "Tino"}}
+        )
+
+    def test_scope_flushes_after_every_commit(self):
+        self.manager.save(SESSION_ID, "stage", "menu")
+
+        with self.manager.scope(SESSION_ID):
+            self.manager.save(SESSION_ID, "stage", "cart")
+            frappe.db.commit()
+            self.assertEqual(self.manager.store.get(SESSION_ID, "stage"), "cart")
+
+            # after_commit callbacks run once, the next change registers the flush again
+            self.manager.save(SESSION_ID, "stage", "checkout")
+            frappe.db.commit()
+            self.assertEqual(self.manager.store.get(SESSION_ID, "stage"), "checkout")
+
+            self.manager.save(SESSION_ID, "stage", "paid")
+            frappe.db.rollback()
+            self.manager.save(SESSION_ID, "stage", "done")
+            frappe.db.commit()
+            self.assertEqual(self.manager.store.get(SESSION_ID, "stage"), "done")
+
+    def test_global_keys_are_hash_fields(self):
+        self.manager.clear_global()
+        self.manager.save_global("menu", {"items": 3})
+        self.manager.save_global("banner", "hello")
+
+        # a second manager, as in another worker
+        other = FrappeRedisSessionManager()
+        self.assertEqual(other.get_global("menu"), {"items": 3})
+
+        self.manager.evict_global("menu")
+        self.assertIsNone(self.manager.get_global("menu"))
+        self.assertEqual(self.manager.fetch_all(SESSION_ID, is_global=True), {"banner": "hello"})
+        self.assertTrue(self.manager.key_in_session(SESSION_ID, "banner"))
+
+        self.manager.clear_global()
+        self.assertEqual(self.manager.fetch_all(SESSION_ID, is_global=True), {})
@@ -0,0 +1,59 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce import template_renderer
+from frappe_pywce.template_renderer import render_template_dict
+
+
+def _naive(value, context):
+    if isinstance(value, str):
+        return frappe.render_template(value, context)
+    if isinstance(value, dict):
+        return {k: _naive(v, context) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_naive(v, context) for v in value]
+    return value
+
+
+TEMPLATE = {
+    "id": "welcome",
+    "kind": "button",
+    "message": {
+        "title": "Welcome",
+        "body": "Hi {{ name }}, you have {{ orders | length }} orders",
+        "footer": "Powered by pywce\n",
+        "buttons": ["Menu", "{% if admin %}Admin{% else %}Help{% endif %}"],
+    },
+    "settings": {"message_level": "1", "delay": 0, "isStart": True, "tags": ["a", "b"]},
+    "routes": [{"pattern": "menu", "isRegex": False}],
+}
+
+
+class TestTemplateRenderer(FrappeTestCase):
+    def setUp(self):
+        self.context = {"name": "Tino", "orders": [1, 2, 3], "admin": False}
+
+    def test_matches_frappe_render_template(self):
+        self.assertEqual(render_template_dict(TEMPLATE, self.context), _naive(TEMPLATE, self.context))
+
+    def test_static_subtrees_are_not_copied(self):
+        rendered = render_template_dict(TEMPLATE, self.context)
+
+        self.assertIs(rendered["settings"], TEMPLATE["settings"])
+        self.assertIs(rendered["routes"], TEMPLATE["routes"])
+        self.assertIsNot(rendered["message"], TEMPLATE["message"])
+        self.assertEqual(TEMPLATE["message"]["body"], "Hi {{ name }}, you have {{ orders | length }} orders")
+
+    def test_compiled_code_and_plans_are_reused(self):
+        render_template_dict(TEMPLATE, self.context)
+        before = template_renderer.get_cache_stats()
+
+        render_template_dict(TEMPLATE, {**self.context, "name": "Rudo"})
+        after = template_renderer.get_cache_stats()
+
+        self.assertEqual(after["plans"]["misses"], before["plans"]["misses"])
+        self.assertEqual(after["compiled"]["misses"], before["compiled"]["misses"])
+
+    def test_illegal_template_still_rejected(self):
+        with self.assertRaises(frappe.ValidationError):
+            render_template_dict({"body": "{{ ''.__class__ }}"}, {})
@@ -0,0 +1,53 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_pywce import tracing
+
+
+class TestTracing(FrappeTestCase):
+    def setUp(self):
+        tracing.reset_metrics()
+
+    def tearDown(self):
+        tracing.reset_metrics()
+
+    def test_job_id_from_payload(self):
+        payload = {"entry": [{"changes": [{"value": {"messages": [{"id": "wamid.1", "from": "263"}]}}]}]}
+
+        self.assertEqual(tracing.job_id("263", payload), "263:wamid.1")
+        self.assertEqual(tracing.job_id("263", {}), "263:-")
+
+    def test_spans_count_queries_and_feed_metrics(self):
+        with tracing.trace("263:wamid.trace"):
+            with tracing.span("save"):
+                frappe.db.sql("SELECT 1")
+                frappe.db.sql("SELECT 2")
+                tracing.get_redis_conn().get("pywce-trace-test")
+
+            with tracing.span("engine"):
+                pass
+
+        with self.assertRaises(ValueError), tracing.trace("263:wamid.failed"):
+            raise ValueError
+
+        trace = tracing.get_trace("263:wamid.trace")[0]
+        spans = {s["name"]: s for s in trace["spans"]}
+
+        self.assertEqual(spans["save"]["db_queries"], 2)
+        self.assertGreaterEqual(spans["save"]["redis_commands"], 1)
+        self.assertEqual(spans["save"]["parent"], 0)
+        self.assertGreaterEqual(spans["webhook"]["duration"], spans["save"]["duration"])
+
+        raw = {k.decode(): v.decode() for k, v in tracing.get_redis_conn().hgetall(tracing._metrics_key()).items()}
+        body = tracing.render_metrics(raw)
+
+        self.assertIn('pywce_stage_duration_seconds_count{stage="webhook"} 2', body)
+        self.assertIn('pywce_stage_duration_seconds_bucket{stage="save",le="+Inf"} 1', body)
+        self.assertIn('pywce_stage_db_queries_total{stage="save"} 2', body)
+        self.assertIn('pywce_traces_total{status="error"} 1', body)
+
+    def test_spans_are_noops_outside_a_trace(self):
+        with tracing.span("save"):
+            frappe.db.sql("SELECT 1")
+
+        self.assertEqual(tracing.get_trace(), [])
@@ -0,0 +1,452 @@
+"""
+Per-webhook tracing of the processing pipeline
+
+`trace(job_id)` wraps one webhook job, correlated by its `wa_id:msg_id` job
+id. Stages inside it are timed with `span(name)` (or `@traced(name)`); each
+span records its monotonic duration and the DB queries and Redis commands
+issued while it was open. Spans nest, a span's counts include its children.
+Outside a trace, spans cost one context variable lookup.
+
+When a trace ends:
+
+- its stages are folded into per-site Prometheus aggregates in Redis, one
+  pipelined round trip. `metrics` serves them in the Prometheus text format
+- the trace is kept in a short list of recent traces, see `get_trace`
+- with `pywce_otel_endpoint` set (an OTLP/HTTP traces URL, e.g.
+  http://localhost:4318/v1/traces) and the opentelemetry-sdk and
+  opentelemetry-exporter-otlp-proto-http packages installed, the spans are
+  also exported to that collector
+
+Site config:
+
+- `pywce_tracing`: fraction of webhook jobs traced, 0 turns tracing off
+  (default 1)
+- `pywce_metrics_token`: bearer token that lets a Prometheus scraper read
+  `metrics` as a guest, System Managers can always read it
+"""
+
+import contextvars
+import functools
+import hmac
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import frappe
+import frappe.utils
+import redis
+from frappe.utils.background_jobs import get_redis_conn
+from werkzeug.wrappers import Response
+
+from frappe_pywce.util import CACHE_KEY_PREFIX
+from frappe_pywce.pywce_logger import app_logger as logger
+
+TRACING_CONF_KEY = "pywce_tracing"
+METRICS_TOKEN_CONF_KEY = "pywce_metrics_token"
+OTEL_ENDPOINT_CONF_KEY = "pywce_otel_endpoint"
+
+OTEL_SERVICE_NAME = "frappe_pywce"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RECENT_TRACES = 200
+
+_FIELD_SEPARATOR = "|"
+
+_current = contextvars.ContextVar("pywce_trace", default=None)
+_redis_commands = contextvars.ContextVar("pywce_redis_commands", default=None)
+
+_redis_counter_lock = threading.Lock()
+_redis_counter_installed = False
+
+# endpoint -> opentelemetry tracer, None when the packages are missing
+_otel_tracers: Dict[str, object] = {}
+_otel_lock = threading.Lock()
+
+
+def install_redis_counter() -> None:
+    """Count Redis round trips (commands and pipeline executions) of contexts that called redis_command_count"""
+    global _redis_counter_installed
+
+    with _redis_counter_lock:
+        if _redis_counter_installed:
+            return
+
+        def counted(method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                counter = _redis_commands.get()
+                if counter is not None:
+                    counter[0] += 1
+
+                return method(*args, **kwargs)
+
+            return wrapper
+
+        redis.client.Redis.execute_command = counted(redis.client.Redis.execute_command)
+        redis.client.Pipeline.execute = counted(redis.client.Pipeline.execute)
+        _redis_counter_installed = True
+
+
+def redis_command_count() -> int:
+    """Redis round trips of the current context so far, counting starts at the first call"""
+    counter = _redis_commands.get()
+
+    if counter is None:
+        counter = [0]
+        _redis_commands.set(counter)
+
+    return counter[0]
+
+
+class Trace:
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.wall_start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.spans: List[Dict] = []
+        self.stack: List[int] = []
+        self.db_queries = 0
+
+    def offset(self) -> float:
+        return time.perf_counter() - self.start
+
+
+def _tracing_rate() -> float:
+    conf = getattr(frappe.local, "conf", None) or {}
+    return frappe.utils.flt(conf.get(TRACING_CONF_KEY, 1))
+
+
+def job_id(wa_id: str, payload: dict) -> str:
+    """`wa_id:msg_id` of the first message (or status) in a webhook payload"""
+    for entry in payload.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+
+            for item in (value.get("messages") or []) + (value.get("statuses") or []):
+                if item.get("id"):
+                    return f"{wa_id}:{item['id']}"
+
+    return f"{wa_id}:-"
+
+
+@contextmanager
+def span(name: str):
+    """Time a stage of the current trace, a no-op outside one"""
+    current = _current.get()
+
+    if current is None:
+        yield
+        return
+
+    record = {"name": name, "parent": current.stack[-1] if current.stack else None, "error": False}
+    index = len(current.spans)
+    current.spans.append(record)
+    current.stack.append(index)
+
+    db_before = current.db_queries
+    redis_before = redis_command_count()
+    record["start"] = current.offset()
+
+    try:
+        yield
+
+    except BaseException:
+        record["error"] = True
+        raise
+
+    finally:
+        record["duration"] = current.offset() - record["start"]
+        record["db_queries"] = current.db_queries - db_before
+        record["redis_commands"] = redis_command_count() - redis_before
+        current.stack.pop()
+
+
+def traced(name: str):
+    """Decorator form of `span`"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace(job_id: str, name: str = "webhook"):
+    """
+    Trace one webhook job. Nested in an active trace it is a plain span, a
+    job skipped by the `pywce_tracing` rate is not traced at all.
+    """
+    if _current.get() is not None:
+        with span(name):
+            yield
+        return
+
+    rate = _tracing_rate()
+
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        yield
+        return
+
+    db = frappe.db
+
+    if db is None:
+        yield
+        return
+
+    install_redis_counter()
+
+    current = Trace(job_id)
+    token = _current.set(current)
+
+    original_sql = db.sql
+
+    def counting_sql(*args, **kwargs):
+        current.db_queries += 1
+        return original_sql(*args, **kwargs)
+
+    db.sql = counting_sql
+
+    try:
+        with span(name):
+            yield
+
+    finally:
+        db.sql = original_sql
+        _current.reset(token)
+        _finish(current)
+
+
+def _finish(current: Trace) -> None:
+    try:
+        record_trace(current)
+    except Exception:
+        logger.warning("Failed to record trace %s", current.job_id, exc_info=True)
+
+    try:
+        _export_otel(current)
+    except Exception:
+        logger.warning("Failed to export trace %s", current.job_id, exc_info=True)
+
+    root = current.spans[0]
+    logger.debug(
+        "Traced %s", current.job_id,
+        seconds=round(root["duration"], 4), queries=root["db_queries"], redis=root["redis_commands"]
+    )
+
+
+def _metrics_key() -> str:
+    return f"{CACHE_KEY_PREFIX}metrics:{frappe.local.site}"
+
+
+def _traces_key() -> str:
+    return f"{CACHE_KEY_PREFIX}traces:{frappe.local.site}"
+
+
+def _bucket(duration: float) -> str:
+    for le in DURATION_BUCKETS:
+        if duration <= le:
+            return repr(le)
+
+    return "+Inf"
+
+
+def _field(*parts) -> str:
+    return _FIELD_SEPARATOR.join(parts)
+
+
+def record_trace(current: Trace) -> None:
+    """Fold a finished trace into the site's metrics and recent traces, one pipelined round trip"""
+    conn = get_redis_conn()
+    key = _metrics_key()
+    failed = any(s["error"] for s in current.spans)
+
+    with conn.pipeline(transaction=False) as pipe:
+        for s in current.spans:
+            # non cumulative buckets, `metrics` sums them up
+            pipe.hincrby(key, _field("bucket", s["name"], _bucket(s["duration"])), 1)
+            pipe.hincrbyfloat(key, _field("seconds", s["name"]), s["duration"])
+            pipe.hincrby(key, _field("count", s["name"]), 1)
+            pipe.hincrby(key, _field("db_queries", s["name"]), s["db_queries"])
+            pipe.hincrby(key, _field("redis_commands", s["name"]), s["redis_commands"])
+
+        pipe.hincrby(key, _field("traces", "error" if failed else "ok"), 1)
+
+        pipe.lpush(_traces_key(), json.dumps({
+            "job_id": current.job_id,
+            "timestamp": current.wall_start_ns / 1e9,
+            "spans": [{**s, "start": round(s["start"], 6), "duration": round(s["duration"], 6)} for s in current.spans]
+        }))
+        pipe.ltrim(_traces_key(), 0, RECENT_TRACES - 1)
+        pipe.execute()
+
+
+def _otel_tracer(endpoint: str):
+    with _otel_lock:
+        if endpoint in _otel_tracers:
+            return _otel_tracers[endpoint]
+
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        except ImportError:
+            logger.warning(
+                "%s is set but opentelemetry-sdk / opentelemetry-exporter-otlp-proto-http are not installed",
+                OTEL_ENDPOINT_CONF_KEY
+            )
+            _otel_tracers[endpoint] = None
+            return None
+
+        # a provider of our own, the process wide one is left alone
+        provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+
+        tracer = _otel_tracers[endpoint] = provider.get_tracer(__name__)
+        return tracer
+
+
+def _export_otel(current: Trace) -> None:
+    conf = getattr(frappe.local, "conf", None) or {}
+    endpoint = conf.get(OTEL_ENDPOINT_CONF_KEY)
+
+    if not endpoint:
+        return
+
+    tracer = _otel_tracer(endpoint)
+    if tracer is None:
+        return
+
+    from opentelemetry.trace import Status, StatusCode, set_span_in_context
+
+    exported = []
+
+    for s in current.spans:
+        start_ns = current.wall_start_ns + int(s["start"] * 1e9)
+        parent = exported[s["parent"]] if s["parent"] is not None else None
+
+        otel_span = tracer.start_span(
+            s["name"],
+            context=set_span_in_context(parent) if parent is not None else None,
+            start_time=start_ns,
+            attributes={
+                "pywce.job_id": current.job_id,
+                "pywce.site": frappe.local.site,
+                "db.queries": s["db_queries"],
+                "redis.commands": s["redis_commands"],
+            }
+        )
+
+        if s["error"]:
+            otel_span.set_status(Status(StatusCode.ERROR))
+
+        exported.append(otel_span)
+
+    # children end before their parents
+    for s, otel_span in reversed(list(zip(current.spans, exported))):
+        otel_span.end(end_time=current.wall_start_ns + int((s["start"] + s["duration"]) * 1e9))
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(raw: Dict[str, str]) -> str:
+    """Prometheus text exposition of the aggregates stored by record_trace"""
+    stages: Dict[str, Dict] = {}
+    traces: Dict[str, int] = {}
+
+    for field, value in raw.items():
+        parts = field.split(_FIELD_SEPARATOR)
+
+        if parts[0] == "traces":
+            traces[parts[1]] = int(value)
+            continue
+
+        stage = stages.setdefault(parts[1], {"buckets": {}})
+
+        if parts[0] == "bucket":
+            stage["buckets"][parts[2]] = int(value)
+        else:
+            stage[parts[0]] = float(value) if parts[0] == "seconds" else int(value)
+
+    lines = [
+        "# HELP pywce_stage_duration_seconds Time spent in a webhook pipeline stage",
+        "# TYPE pywce_stage_duration_seconds histogram",
+    ]
+
+    for name in sorted(stages):
+        stage = stages[name]
+        label = _label(name)
+        cumulative = 0
+
+        for le in (*(repr(b) for b in DURATION_BUCKETS), "+Inf"):
+            cumulative += stage["buckets"].get(le, 0)
+            lines.append(f'pywce_stage_duration_seconds_bucket{{stage="{label}",le="{le}"}} {cumulative}')
+
+        lines.append(f'pywce_stage_duration_seconds_sum{{stage="{label}"}} {stage.get("seconds", 0.0)}')
+        lines.append(f'pywce_stage_duration_seconds_count{{stage="{label}"}} {stage.get("count", 0)}')
+
+    for metric, help_text in (
+        ("db_queries", "DB queries issued in a webhook pipeline stage"),
+        ("redis_commands", "Redis round trips issued in a webhook pipeline stage"),
+    ):
+        lines.append(f"# HELP pywce_stage_{metric}_total {help_text}")
+        lines.append(f"# TYPE pywce_stage_{metric}_total counter")
+
+        for name in sorted(stages):
+            lines.append(f'pywce_stage_{metric}_total{{stage="{_label(name)}"}} {stages[name].get(metric, 0)}')
+
+    lines.append("# HELP pywce_traces_total Traced webhook jobs by outcome")
+    lines.append("# TYPE pywce_traces_total counter")
+
+    for status in sorted(traces):
+        lines.append(f'pywce_traces_total{{status="{_label(status)}"}} {traces[status]}')
+
+    return "\n".join(lines) + "\n"
+
+
+def _check_metrics_access() -> None:
+    conf = getattr(frappe.local, "conf", None) or {}
+    token = conf.get(METRICS_TOKEN_CONF_KEY)
+    authorization = frappe.get_request_header("Authorization") or ""
+
+    if token and hmac.compare_digest(authorization, f"Bearer {token}"):
+        return
+
+    frappe.only_for("System Manager")
+
+
+@frappe.whitelist(allow_guest=True, methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint"""
+    _check_metrics_access()
+
+    raw = get_redis_conn().hgetall(_metrics_key())
+    body = render_metrics({k.decode(): v.decode() for k, v in raw.items()})
+
+    return Response(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@frappe.whitelist()
+def get_trace(job_id: Optional[str] = None) -> List[Dict]:
+    """Recent traces, newest first, only those of `job_id` (`wa_id:msg_id`) when given"""
+    frappe.only_for("System Manager")
+
+    traces = [json.loads(t) for t in get_redis_conn().lrange(_traces_key(), 0, -1)]
+
+    return [t for t in traces if t["job_id"] == job_id] if job_id else traces
+
+
+@frappe.whitelist(methods=["POST"])
+def reset_metrics() -> None:
+    frappe.only_for("System Manager")
+    get_redis_conn().delete(_metrics_key(), _traces_key())
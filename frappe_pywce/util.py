@@ -9,6 +9,7 @@ from pywce import HookUtil, SessionConstants
 
 from frappe_pywce.managers import FrappeRedisSessionManager
 from frappe_pywce.pywce_logger import app_logger as logger
+from frappe_pywce.template_renderer import render_template_dict
 
 # constants
 LOGIN_LINK_EXPIRE_AFTER_IN_MIN = 5
@@ -120,8 +121,8 @@ def frappe_recursive_renderer(template_dict: dict, hook_path: str, hook_arg: obj
     It does two things:
     1. Gets the business context from the hook.
     2. Gets the dt, dn from template or params 
-    3. Recursively renders the template using frappe.render_template, which
-       adds the global Frappe context automatically.
+    3. Recursively renders the template with the frappe Jinja environment,
+       which adds the global Frappe context automatically.
     """
     
     # Get Business Context (from the template hook)
@@ -163,16 +164,5 @@ def frappe_recursive_renderer(template_dict: dict, hook_path: str, hook_arg: obj
         **business_context
     }
 
-    def render_recursive(value):
-        if isinstance(value, str):
-            return frappe.render_template(value, final_context)
-        
-        elif isinstance(value, dict):
-            return {key: render_recursive(val) for key, val in value.items()}
-        
-        elif isinstance(value, list):
-            return [render_recursive(item) for item in value]
-        
-        return value
-
-    return render_recursive(template_dict)
\ No newline at end of file
+    # static strings are skipped, dynamic ones use cached compiled templates
+    return render_template_dict(template_dict, final_context)
\ No newline at end of file
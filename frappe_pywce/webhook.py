@@ -1,5 +1,4 @@
 import json
-from datetime import datetime
 
 import redis
 import redis.exceptions
@@ -9,10 +8,19 @@ import frappe.utils
 import re
 import os
 
-from frappe_pywce.config import get_engine_config, get_wa_config
+from frappe_pywce import tracing
+from frappe_pywce.config import get_engine_config, get_wa_config, invalidate_engine_cache
+from frappe_pywce.conversation_cursor import get_cursor
+from frappe_pywce.inbox import INGRESS_MODE_STREAM, extract_wa_id, push
+from frappe_pywce.persistence import save_webhook_payload
 from frappe_pywce.util import CACHE_KEY_PREFIX, LOCK_WAIT_TIME, LOCK_LEASE_TIME, bot_settings, create_cache_key
 from frappe_pywce.pywce_logger import app_logger as logger
 from frappe_pywce.routing_engine import RoutingEngine, send_matched_template
+from frappe_pywce.security import verify_webhook_signature
+from frappe_pywce.sequencer import submit
+
+# path -> ((path, mtime), parsed chatbot config)
+_CHATBOT_CONFIG_CACHE = {}
 
 
 def _verifier():
@@ -32,206 +40,6 @@ def _verifier():
     frappe.throw("Webhook verification challenge failed", exc=frappe.PermissionError)
 
 
-def _save_incoming_message(payload: dict):
-    """
-    Save incoming WhatsApp message to database for chat interface
-    
-    Args:
-        payload (dict): WhatsApp webhook payload
-    """
-    try:
-        # Extract message from payload
-        if not payload.get('entry'):
-            return
-        
-        for entry in payload.get('entry', []):
-            for change in entry.get('changes', []):
-                value = change.get('value', {})
-                messages = value.get('messages', [])
-                
-                for message in messages:
-                    # Normalize phone number - remove all non-numeric characters
-                    raw_phone = message.get('from', '')
-                    phone_number = ''.join(filter(str.isdigit, raw_phone))
-                    
-                    message_id = message.get('id', '')
-                    timestamp = message.get('timestamp')
-                    message_type = message.get('type', 'text')
-                    
-                    # Get message text based on type
-                    message_text = ''
-                    media_url = None
-                    media_type = None
-                    
-                    if message_type == 'text':
-                        message_text = message.get('text', {}).get('body', '')
-                    
-                    elif message_type == 'image':
-                        image_data = message.get('image', {})
-                        message_text = image_data.get('caption', '')
-                        media_url = image_data.get('id', '')
-                        media_type = 'image'
-                    
-                    elif message_type == 'video':
-                        video_data = message.get('video', {})
-                        message_text = video_data.get('caption', '')
-                        media_url = video_data.get('id', '')
-                        media_type = 'video'
-                    
-                    elif message_type == 'audio':
-                        audio_data = message.get('audio', {})
-                        media_url = audio_data.get('id', '')
-                        media_type = 'audio'
-                        message_text = f"Audio message ({audio_data.get('mime_type', 'audio')})"
-                    
-                    elif message_type == 'voice':
-                        voice_data = message.get('voice', {})
-                        media_url = voice_data.get('id', '')
-                        media_type = 'voice'
-                        message_text = "Voice message"
-                    
-                    elif message_type == 'document':
-                        doc_data = message.get('document', {})
-                        message_text = doc_data.get('filename', 'Document')
-                        media_url = doc_data.get('id', '')
-                        media_type = 'document'
-                    
-                    elif message_type == 'sticker':
-                        sticker_data = message.get('sticker', {})
-                        media_url = sticker_data.get('id', '')
-                        media_type = 'sticker'
-                        message_text = "Sticker"
-                    
-                    elif message_type == 'location':
-                        location_data = message.get('location', {})
-                        message_text = f"Location: {location_data.get('name', 'Shared location')}"
-                    
-                    elif message_type == 'contacts':
-                        contacts_data = message.get('contacts', [])
-                        if contacts_data:
-                            contact = contacts_data[0]
-                            name = contact.get('name', {}).get('formatted_name', 'Contact')
-                            message_text = f"Contact: {name}"
-                    
-                    elif message_type == 'button':
-                        button_data = message.get('button', {})
-                        message_text = f"Button: {button_data.get('text', 'Button clicked')}"
-                    
-                    elif message_type == 'interactive':
-                        interactive_data = message.get('interactive', {})
-                        interactive_type = interactive_data.get('type', '')
-                        
-                        if interactive_type == 'button_reply':
-                            button_reply = interactive_data.get('button_reply', {})
-                            message_text = f"Button: {button_reply.get('title', 'Button clicked')}"
-                        elif interactive_type == 'list_reply':
-                            list_reply = interactive_data.get('list_reply', {})
-                            message_text = f"Selected: {list_reply.get('title', 'List item')}"
-                        else:
-                            message_text = "Interactive message"
-                    
-                    else:
-                        message_text = f"Unsupported message type: {message_type}"
-                    
-                    # Get contact name from contacts in payload
-                    contact_name = ''
-                    contacts = value.get('contacts', [])
-                    for contact in contacts:
-                        contact_wa_id = ''.join(filter(str.isdigit, contact.get('wa_id', '')))
-                        if contact_wa_id == phone_number:
-                            profile = contact.get('profile', {})
-                            contact_name = profile.get('name', '')
-                            break
-                    
-                    # Check if message already exists
-                    existing = frappe.db.exists('WhatsApp Chat Message', {'message_id': message_id})
-                    if existing:
-                        continue
-                    
-                    # Create message document
-                    msg_doc = frappe.get_doc({
-                        "doctype": "WhatsApp Chat Message",
-                        "phone_number": phone_number,
-                        "message_id": message_id,
-                        "timestamp": datetime.fromtimestamp(int(timestamp)) if timestamp else datetime.now(),
-                        "direction": "Incoming",
-                        "message_type": message_type,
-                        "message_text": message_text,
-                        "media_url": media_url,
-                        "media_type": media_type,
-                        "contact_name": contact_name,
-                        "status": "delivered",
-                        "metadata": json.dumps(message)
-                    })
-                    msg_doc.insert(ignore_permissions=True)
-                    
-                    # Publish realtime event for chat interface
-                    frappe.publish_realtime(
-                        event='whatsapp_message_received',
-                        message={
-                            'phone_number': phone_number,
-                            'message_id': message_id,
-                            'message_text': message_text
-                        },
-                        after_commit=True
-                    )
-                    
-                    logger.info(f"Saved incoming message from {phone_number}: {message_id}")
-        
-        frappe.db.commit()
-        
-    except Exception as e:
-        logger.error(f"Error saving incoming message: {str(e)}")
-        frappe.log_error(title="WhatsApp Chat Message Save Error", message=str(e))
-
-
-def _save_message_status(payload: dict):
-    """
-    Update message status from webhook status updates
-    
-    Args:
-        payload (dict): WhatsApp webhook payload
-    """
-    try:
-        if not payload.get('entry'):
-            return
-        
-        for entry in payload.get('entry', []):
-            for change in entry.get('changes', []):
-                value = change.get('value', {})
-                statuses = value.get('statuses', [])
-                
-                for status in statuses:
-                    message_id = status.get('id', '')
-                    new_status = status.get('status', '')
-                    
-                    # Map WhatsApp status to our status
-                    status_map = {
-                        'sent': 'sent',
-                        'delivered': 'delivered',
-                        'read': 'read',
-                        'failed': 'failed'
-                    }
-                    
-                    mapped_status = status_map.get(new_status, 'sent')
-                    
-                    # Update message status
-                    frappe.db.set_value(
-                        'WhatsApp Chat Message',
-                        {'message_id': message_id},
-                        'status',
-                        mapped_status
-                    )
-                    
-                    logger.info(f"Updated message status: {message_id} -> {mapped_status}")
-        
-        frappe.db.commit()
-        
-    except Exception as e:
-        logger.error(f"Error updating message status: {str(e)}")
-        frappe.log_error(title="WhatsApp Message Status Update Error", message=str(e))
-
-
 def _get_message_template_type(message: dict) -> str:
     """Determine the message template type from message data
     
@@ -302,16 +110,18 @@ def _process_message_templates(payload: dict):
                     else:
                         _process_generic_template(message, payload)
                     
-                    logger.debug(f"Processed {template_type} template for message {message.get('id', '')}")
+                    logger.sample("webhook.processed").debug(
+                        "Processed %s template for message %s", template_type, message.get('id', '')
+                    )
         
     except Exception as e:
-        logger.error(f"Error processing message templates: {str(e)}")
+        logger.error("Error processing message templates: %s", e)
         frappe.log_error(title="Message Template Processing Error", message=str(e))
 
 
 def _process_text_template(message: dict, payload: dict):
     """Process text message template"""
-    logger.debug(f"Processing text template: {message.get('id', '')}")
+    logger.debug("Processing text template: %s", message.get('id', ''))
     
     # Extract phone number and message text
     phone_number = message.get('from', '')
@@ -323,7 +133,7 @@ def _process_text_template(message: dict, payload: dict):
 
 def _process_button_template(message: dict, payload: dict):
     """Process button message template"""
-    logger.debug(f"Processing button template: {message.get('id', '')}")
+    logger.debug("Processing button template: %s", message.get('id', ''))
     
     # Extract phone number and button response
     phone_number = message.get('from', '')
@@ -336,32 +146,32 @@ def _process_button_template(message: dict, payload: dict):
 
 def _process_list_template(message: dict, payload: dict):
     """Process list message template"""
-    logger.debug(f"Processing list template: {message.get('id', '')}")
+    logger.debug("Processing list template: %s", message.get('id', ''))
 
 
 def _process_flow_template(message: dict, payload: dict):
     """Process flow message template"""
-    logger.debug(f"Processing flow template: {message.get('id', '')}")
+    logger.debug("Processing flow template: %s", message.get('id', ''))
 
 
 def _process_media_template(message: dict, payload: dict):
     """Process media message template (image, video, audio, document, etc.)"""
-    logger.debug(f"Processing media template: {message.get('id', '')}")
+    logger.debug("Processing media template: %s", message.get('id', ''))
 
 
 def _process_location_template(message: dict, payload: dict):
     """Process location message template"""
-    logger.debug(f"Processing location template: {message.get('id', '')}")
+    logger.debug("Processing location template: %s", message.get('id', ''))
 
 
 def _process_cta_template(message: dict, payload: dict):
     """Process call-to-action (contacts) message template"""
-    logger.debug(f"Processing CTA template: {message.get('id', '')}")
+    logger.debug("Processing CTA template: %s", message.get('id', ''))
 
 
 def _process_dynamic_template(message: dict, payload: dict):
     """Process dynamic/interactive message template"""
-    logger.debug(f"Processing dynamic template: {message.get('id', '')}")
+    logger.debug("Processing dynamic template: %s", message.get('id', ''))
     
     # Extract phone number and interactive response
     phone_number = message.get('from', '')
@@ -384,11 +194,17 @@ def _process_dynamic_template(message: dict, payload: dict):
 
 def _process_generic_template(message: dict, payload: dict):
     """Process generic/unknown message template"""
-    logger.debug(f"Processing generic template: {message.get('id', '')}")
+    logger.debug("Processing generic template: %s", message.get('id', ''))
 
 
+@tracing.traced("load_chatbot_config")
 def _load_chatbot_config():
-    """Load chatbot configuration from JSON file"""
+    """Load chatbot configuration from JSON file
+
+    The parsed config is kept per (path, mtime) so the same dict is returned
+    until the file changes, which lets the routing index compile once per
+    flow version.
+    """
     try:
         # Try to find the chatbot config file
         config_paths = [
@@ -400,9 +216,16 @@ def _load_chatbot_config():
         config_data = None
         for path in config_paths:
             if os.path.exists(path):
+                version = (path, os.stat(path).st_mtime_ns)
+                cached = _CHATBOT_CONFIG_CACHE.get(path)
+
+                if cached and cached[0] == version:
+                    return cached[1]
+
                 with open(path, 'r', encoding='utf-8') as f:
                     config_data = json.load(f)
-                logger.info(f"Loaded chatbot config from: {path}")
+                _CHATBOT_CONFIG_CACHE[path] = (version, config_data)
+                logger.info("Loaded chatbot config from: %s", path)
                 break
         
         if not config_data:
@@ -411,7 +234,7 @@ def _load_chatbot_config():
             
         return config_data
     except Exception as e:
-        logger.error(f"Error loading chatbot config: {str(e)}")
+        logger.error("Error loading chatbot config: %s", e)
         return None
 
 
@@ -476,20 +299,11 @@ def _find_template_by_level(chatbot, phone_number):
         return None
     
     try:
-        # Get the last message for this phone number
-        last_message = frappe.get_all(
-            "WhatsApp Chat Message",
-            filters={
-                "phone_number": phone_number,
-                "direction": "Outgoing"
-            },
-            fields=["next_level"],
-            order_by="timestamp desc",
-            limit=1
-        )
+        # Get the routing state of the last message for this phone number
+        last_message = get_cursor(phone_number)
         
-        if last_message and last_message[0].get('next_level'):
-            next_level = last_message[0].get('next_level')
+        if last_message and last_message.get('next_level'):
+            next_level = last_message.get('next_level')
             
             # Find template with matching message_level
             for template in chatbot.get('templates', []):
@@ -498,7 +312,7 @@ def _find_template_by_level(chatbot, phone_number):
                     return template
                     
     except Exception as e:
-        logger.error(f"Error finding template by level: {str(e)}")
+        logger.error("Error finding template by level: %s", e)
     
     return None
 
@@ -612,11 +426,11 @@ def _send_template_response(phone_number, template):
                 }
             )
         
-        logger.info(f"Sent {template_type} template response to {phone_number}")
+        logger.debug("Sent %s template response to %s", template_type, phone_number)
         return response
         
     except Exception as e:
-        logger.error(f"Error sending template response: {str(e)}")
+        logger.error("Error sending template response: %s", e)
         frappe.log_error(title="Template Response Error", message=str(e))
         return None
 
@@ -642,38 +456,71 @@ def _process_chatbot_message(phone_number, message_text):
         
         # If template found, send the response using the new TemplateSender
         if template:
-            logger.info(f"Found template {template.get('id')} for message from {phone_number}")
+            logger.debug("Found template %s for message from %s", template.get('id'), phone_number)
             send_matched_template(phone_number, template)
         else:
-            logger.info(f"No matching template found for message from {phone_number}")
+            logger.debug("No matching template found for message from %s", phone_number)
             
     except Exception as e:
-        logger.error(f"Error processing chatbot message: {str(e)}")
+        logger.error("Error processing chatbot message: %s", e)
         frappe.log_error(title="Chatbot Processing Error", message=str(e))
 
 
+def process_webhook_payload(wa_id: str, payload: dict, lock: bool = True):
+    """Run the full webhook pipeline for one payload
+
+    With lock set, runs under the per wa_id lock and raises
+    redis.exceptions.LockError when it cannot be acquired in time. Callers
+    that already serialize wa_id (the sequencer) pass lock=False.
+    """
+    with tracing.trace(tracing.job_id(wa_id, payload)):
+        if not lock:
+            return _run_webhook_pipeline(wa_id, payload)
+
+        wa_lock = frappe.cache().lock(
+            create_cache_key(f"lock:{wa_id}"), timeout=LOCK_LEASE_TIME, blocking_timeout=LOCK_WAIT_TIME
+        )
+
+        with tracing.span("lock_wait"):
+            if not wa_lock.acquire():
+                raise redis.exceptions.LockError("Unable to acquire lock within the time specified")
+
+        try:
+            _run_webhook_pipeline(wa_id, payload)
+        finally:
+            wa_lock.release()
+
+
+def _run_webhook_pipeline(wa_id: str, payload: dict):
+    # Save incoming messages and status updates in one transaction
+    with tracing.span("save_webhook_payload"):
+        save_webhook_payload(payload)
+
+    # Process message templates
+    with tracing.span("message_templates"):
+        _process_message_templates(payload)
+
+    # Process with existing engine, session reads are served from memory
+    # and written back in one pipeline when the engine is done
+    with tracing.span("engine_config"):
+        engine = get_engine_config()
+
+    with tracing.span("engine"), engine.config.session_manager.scope(wa_id):
+        engine.process_webhook(payload)
+
+
 def _internal_webhook_handler(wa_id: str, payload: dict):
     """Process webhook data internally
 
+    Kept for jobs enqueued before the sequencer, new payloads go through
+    frappe_pywce.sequencer.submit
+
     Args:
         wa_id (str): WhatsApp user ID
         payload (dict): webhook raw payload data to process
     """
     try:
-        lock_key = create_cache_key(f"lock:{wa_id}")
-        
-        with frappe.cache().lock(lock_key, timeout=LOCK_LEASE_TIME, blocking_timeout=LOCK_WAIT_TIME):
-            # Save incoming messages to chat database
-            _save_incoming_message(payload)
-            
-            # Update message statuses
-            _save_message_status(payload)
-            
-            # Process message templates
-            _process_message_templates(payload)
-            
-            # Process with existing engine
-            get_engine_config().process_webhook(payload)
+        process_webhook_payload(wa_id, payload)
 
     except redis.exceptions.LockError:
         logger.critical("FIFO Enforcement: Dropped concurrent message for %s due to lock error.", wa_id)
@@ -682,12 +529,19 @@ def _internal_webhook_handler(wa_id: str, payload: dict):
         frappe.log_error(title="Chatbot Webhook E.Handler")
 
 
-def _on_job_success(*args, **kwargs):
-    logger.debug("Webhook job completed successfully, args: %s, kwargs %s", args, kwargs)
+def _handle_webhook_stream(payload: bytes, payload_dict: dict):
+    """Fast-ack ingress, verify and append the raw body to the durable inbox"""
+    if not verify_webhook_signature(frappe.request):
+        frappe.throw("Invalid webhook signature", exc=frappe.PermissionError)
+
+    wa_id = extract_wa_id(payload_dict)
+
+    if wa_id is None:
+        return "Invalid user"
 
+    push(wa_id, payload)
 
-def _on_job_error(*args, **kwargs):
-    logger.debug("Webhook job failed, args: %s, kwargs %s", args, kwargs)
+    return "OK"
 
 
 def _handle_webhook():
@@ -698,27 +552,23 @@ def _handle_webhook():
     except json.JSONDecodeError:
         frappe.throw("Invalid webhook data", exc=frappe.ValidationError)
 
-    should_run_in_bg = frappe.db.get_single_value("ChatBot Config", "process_in_background")
+    settings = frappe.get_cached_doc("ChatBot Config")
+
+    if settings.ingress_mode == INGRESS_MODE_STREAM:
+        return _handle_webhook_stream(payload, payload_dict)
+
+    should_run_in_bg = frappe.utils.cint(settings.process_in_background)
 
-    wa_user = get_wa_config(bot_settings()).util.get_wa_user(payload_dict)
+    wa_user = get_engine_config().whatsapp.util.get_wa_user(payload_dict)
 
     if wa_user is None:
         return "Invalid user"
     
-    job_id = f"{wa_user.wa_id}:{wa_user.msg_id}"
-    
-    logger.debug("Starting a new webhook job id: %s", job_id)
-
-    frappe.enqueue(
-        _internal_webhook_handler,
-        now=should_run_in_bg == 0,
-
-        payload=payload_dict,
-        wa_id=wa_user.wa_id,
+    # ordered per wa_id partition, nothing waits on a lock
+    partition = submit(wa_user.wa_id, payload_dict, now=should_run_in_bg == 0)
 
-        job_id=create_cache_key(job_id),
-        on_success=_on_job_success,
-        on_failure=_on_job_error
+    logger.sample("webhook.queued").debug(
+        "Queued webhook %s:%s on partition %s", wa_user.wa_id, wa_user.msg_id, partition
     )
 
     return "OK"
@@ -732,6 +582,7 @@ def get_webhook():
 @frappe.whitelist()
 def clear_session():
     frappe.cache.delete_keys(CACHE_KEY_PREFIX)
+    invalidate_engine_cache()
 
 
 @frappe.whitelist(allow_guest=True, methods=["GET", "POST"])